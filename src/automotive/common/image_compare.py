@@ -10,7 +10,7 @@ import shutil
 from typing import Sequence, Optional
 
 from .typehints import Position, RGB
-from ..logger.logger import logger
+from ..logger.logger import logger, lazy_logger
 from ..utils.utils import Utils
 from ..common.enums import CompareTypeEnum
 from ..utils.images import Images
@@ -116,8 +116,9 @@ class ImageCompare(object):
 
             False: 小于阈值
         """
-        logger.debug(
-            f"compare template_image[{template_image}] and target_image={target_image} in position[{position}]")
+        # 图片可能是数组，只有需要输出的时候才格式化
+        lazy_logger.debug("compare template_image[{}] and target_image={} in position[{}]", lambda: template_image,
+                          lambda: target_image, lambda: position)
         x, y, width, height = position
         template_position = self.__images.convert_position(x, y, width=width, height=height)
         target_position = self.__images.convert_position(0, 0, width=width,
@@ -209,7 +210,8 @@ class ImageCompare(object):
         if len(target_images) == 0:
             return False
         for image in target_images:
-            logger.debug(f"now compare template_image[{template_image}] and target_image [{image}]")
+            lazy_logger.debug("now compare template_image[{}] and target_image [{}]", lambda: template_image,
+                              lambda: image)
             if self.__compare_image(template_image, image, positions, gray, threshold, similarity, is_area):
                 if light_or_dark:
                     if is_break:
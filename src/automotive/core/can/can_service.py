@@ -6,26 +6,37 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:42
 # --------------------------------------------------------
-import time
 import random
-import copy
 from time import sleep
-from typing import Tuple, Union, Dict, Optional, Sequence, List
+from typing import Tuple, Union, Dict, Optional, Sequence, List, Iterable, FrozenSet, Callable
 
-from .common.typehints import MessageType, FilterNode, MessageIdentity
-from .message import Message, get_message
+import numpy as np
+
+from .common.typehints import MessageType, FilterNode, MessageIdentity, Number
+from .message import Message, get_message, get_frame_array
 from .common.interfaces import BaseCanBus
+from .common.stack import StackView
+from .common.recorder import CanRecorder, CanLog
+from .common.subscription import Subscription, WaitResult, parse_condition
+from .common.scheduler import JitterStatistics
+from .common.monitor import CycleStatistics
+from .common.isotp import IsoTpTransport, LatencyStatistics
+from .common.session import CanSession
+from .common.receive_filter import ReceiveFilter, FilterStatistics
 from .common.enums import CanBoxDeviceEnum, BaudRateEnum
 from automotive.common.singleton import Singleton
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level, hex_list
+
+# 信号分析的数据来源，可以是栈中消息，也可以是录制的日志文件或者CanLog
+Stack = Union[Sequence[Message], CanLog, str]
 
 
 def __get_can_bus(can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum, data_rate: BaudRateEnum,
                   channel_index: int, can_fd: bool, max_workers: int, need_receive: bool,
-                  is_uds_can_fd: bool) -> BaseCanBus:
+                  is_uds_can_fd: bool, use_scheduler: bool) -> BaseCanBus:
     params = {"baud_rate": baud_rate, "data_rate": data_rate,
               "channel_index": channel_index, "can_fd": can_fd, "max_workers": max_workers,
-              "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd}
+              "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd, "use_scheduler": use_scheduler}
     if can_box_device == CanBoxDeviceEnum.PEAKCAN:
         logger.debug("use pcan")
         from .hardware.peakcan.pcan_bus import PCanBus
@@ -43,6 +54,10 @@ def __get_can_bus(can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum, dat
         params["can_box_device"] = can_box_device
         from .hardware.usbcan.usb_can_bus import UsbCanBus
         return UsbCanBus(**params)
+    elif can_box_device == CanBoxDeviceEnum.VIRTUAL:
+        logger.debug("use virtual")
+        from .hardware.virtual.virtual_bus import VirtualCanBus
+        return VirtualCanBus(**params)
     else:
         raise RuntimeError(f"{can_box_device.value} not support")
 
@@ -50,18 +65,22 @@ def __get_can_bus(can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum, dat
 def get_can_box_device(can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum,
                        data_rate: BaudRateEnum, channel_index: int, can_fd: bool,
                        max_workers: int, need_receive: bool,
-                       is_uds_can_fd: bool = False) -> Tuple[CanBoxDeviceEnum, BaseCanBus]:
+                       is_uds_can_fd: bool = False,
+                       use_scheduler: bool = False) -> Tuple[CanBoxDeviceEnum, BaseCanBus]:
     """
     获取can盒子的类型， 依次从PCan找到CANALYST然后到USBCAN
     :return: can盒类型
     """
     params = {"can_box_device": can_box_device, "baud_rate": baud_rate, "data_rate": data_rate,
               "channel_index": channel_index, "can_fd": can_fd, "max_workers": max_workers,
-              "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd}
+              "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd, "use_scheduler": use_scheduler}
     if can_box_device:
         return can_box_device, __get_can_bus(**params)
     else:
         for key, value in CanBoxDeviceEnum.__members__.items():
+            # 虚拟设备总是能打开，需要明确指定才使用
+            if value == CanBoxDeviceEnum.VIRTUAL:
+                continue
             name, can_type = value.value
             params["can_box_device"] = value
             if can_fd is True and can_type is True:
@@ -87,6 +106,55 @@ def get_can_box_device(can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum
         raise RuntimeError("No device found, is can box connected")
 
 
+def get_can_session(can_box_device: Union[CanBoxDeviceEnum, str],
+                    channels: Sequence[int] = (1, 2),
+                    baud_rate: Union[BaudRateEnum, int] = BaudRateEnum.HIGH,
+                    data_rate: Union[BaudRateEnum, int] = BaudRateEnum.DATA,
+                    can_fd: bool = False,
+                    max_workers: int = 300,
+                    is_uds_can_fd: bool = False,
+                    use_scheduler: bool = True) -> CanSession:
+    """
+    获取多通道会话，同一个CAN盒的多个通道共用设备句柄、接收线程、发送调度线程和线程池，不需要每个通道一个进程
+
+    目前支持同星、周立功和虚拟设备，会话不是单例，打开以后通过session[channel]获取每个通道的总线
+
+    :param can_box_device: CAN盒类型，必须指定
+
+    :param channels: 通道列表
+
+    :param baud_rate: 所有通道的速率
+
+    :param data_rate: 所有通道的数据速率，仅CANFD有用
+
+    :param can_fd: 是否CANFD
+
+    :param max_workers: 共用的线程池的最大线程数
+
+    :param is_uds_can_fd: UDS是否使用CANFD模式
+
+    :param use_scheduler: 是否使用共用的发送调度线程
+
+    :return: 多通道会话
+    """
+    if isinstance(can_box_device, str):
+        can_box_device = CanBoxDeviceEnum.from_name(can_box_device)
+    if isinstance(baud_rate, int):
+        baud_rate = BaudRateEnum.from_value(baud_rate)
+    if isinstance(data_rate, int):
+        data_rate = BaudRateEnum.from_value(data_rate)
+    if can_box_device not in (CanBoxDeviceEnum.TSMASTER, CanBoxDeviceEnum.ZLGUSBCAN, CanBoxDeviceEnum.VIRTUAL):
+        raise RuntimeError(f"{can_box_device} not support multi channel session")
+    if len(set(channels)) != len(channels):
+        raise ValueError(f"channels {channels} is duplicated")
+    buses = dict()
+    for channel in channels:
+        # 接收线程、调度线程和线程池在打开会话的时候替换成共用的
+        buses[channel] = __get_can_bus(can_box_device, baud_rate, data_rate, channel, can_fd, max_workers, False,
+                                       is_uds_can_fd, False)
+    return CanSession(buses, use_scheduler, max_workers)
+
+
 class Can(metaclass=Singleton):
     """
     CAN设备操作的父类，实现CAN的最基本的操作， 如打开、关闭设备, 传输、接收CAN消息，停止传输CAN消息，查看CAN设备打开状态等
@@ -100,7 +168,8 @@ class Can(metaclass=Singleton):
                  can_fd: bool = False,
                  max_workers: int = 300,
                  need_receive: bool = True,
-                 is_uds_can_fd: bool = False):
+                 is_uds_can_fd: bool = False,
+                 use_scheduler: bool = False):
         if isinstance(can_box_device, str):
             can_box_device = CanBoxDeviceEnum.from_name(can_box_device)
         if isinstance(baud_rate, int):
@@ -109,7 +178,7 @@ class Can(metaclass=Singleton):
             data_rate = BaudRateEnum.from_value(data_rate)
         params = {"can_box_device": can_box_device, "baud_rate": baud_rate, "data_rate": data_rate,
                   "channel_index": channel_index, "can_fd": can_fd, "max_workers": max_workers,
-                  "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd}
+                  "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd, "use_scheduler": use_scheduler}
         self._can_box_device, self._can = get_can_box_device(**params)
 
     def __enter__(self):
@@ -171,6 +240,14 @@ class Can(metaclass=Singleton):
         """
         self._can.transmit_one(message)
 
+    def transmit_many(self, messages: Sequence[Message]):
+        """
+        一次发送多帧数据
+
+        :param messages: CAN消息帧列表
+        """
+        self._can.transmit_many(messages)
+
     def receive(self, message_id: int) -> Message:
         """
         接收CAN消息
@@ -195,16 +272,180 @@ class Can(metaclass=Singleton):
         """
         return self._can.get_stack()
 
+    def get_stack_by_id(self, msg_id: int, since: Optional[Number] = None) -> List[Message]:
+        """
+        获取当前栈中某个msg id的消息
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :return: 按照接收顺序排列的消息
+        """
+        return self._can.get_stack_by_id(msg_id, since)
+
+    def get_jitter_statistics(self, msg_id: Optional[int] = None) -> Dict[int, JitterStatistics]:
+        """
+        获取周期信号实际发送间隔和周期之间的误差统计，仅use_scheduler为True的时候可用
+
+        :param msg_id: msg id，默认获取所有
+
+        :return: 其中key是msg id，value是JitterStatistics(次数, 平均值, 标准差, 最小值, 最大值)，单位毫秒
+        """
+        return self._can.get_jitter_statistics(msg_id)
+
+    def get_cycle_statistics(self, msg_id: Optional[int] = None) -> Dict[int, CycleStatistics]:
+        """
+        获取接收周期统计的快照，每一帧收到的时候增量计算，不需要遍历栈
+
+        :param msg_id: msg id，默认获取所有收到过的
+
+        :return: 其中key是msg id，value是CycleStatistics(帧数, 周期, 平均值, 最小值, 最大值, p99, 丢失的周期数,
+            最后收到的系统时间, 距离最后一次收到的时间)，周期相关的单位是毫秒
+        """
+        return self._can.get_cycle_statistics(msg_id)
+
+    def get_lost_messages(self, lost_period: int = 10) -> List[int]:
+        """
+        获取设置了周期，但是超过lost_period个周期没有收到的msg id
+
+        :param lost_period: 丢失的周期数
+
+        :return: msg id列表
+        """
+        return self._can.monitor.get_lost_messages(lost_period)
+
+    def set_receive_filter(self, ids: Optional[Sequence[int]] = None,
+                           ranges: Optional[Sequence[Tuple[int, int]]] = None,
+                           masks: Optional[Sequence[Tuple[int, int]]] = None) -> ReceiveFilter:
+        """
+        设置接收滤波，只接收满足任意一个条件的帧，设备支持的时候同时设置硬件验收滤波，使用诊断的时候需要包含诊断的响应ID
+
+        :param ids: 接收的ID
+
+        :param ranges: 接收的ID范围，(起始ID, 结束ID)，包含两端
+
+        :param masks: (code, mask)，(ID & mask) == (code & mask)的时候接收
+
+        :return: ReceiveFilter
+        """
+        return self._can.set_receive_filter(ids, ranges, masks)
+
+    def clear_receive_filter(self):
+        """
+        取消接收滤波
+        """
+        self._can.clear_receive_filter()
+
+    def get_receive_filter_statistics(self) -> Optional[FilterStatistics]:
+        """
+        获取接收滤波的统计
+
+        :return: FilterStatistics(接收的帧数, 过滤掉的帧数, 是否设置了硬件滤波)，没有设置滤波的时候返回None
+        """
+        return self._can.get_receive_filter_statistics()
+
+    def subscribe(self, msg_id: Optional[int] = None, callback: Optional[Callable[[Message], None]] = None,
+                  mask: Optional[int] = None, predicate: Optional[Callable[[Message], bool]] = None,
+                  queue_size: int = 1000, edge: bool = False) -> Subscription:
+        """
+        订阅接收到的帧，回调函数在接收线程中执行，不传回调函数的时候通过返回的Subscription.get等待
+
+        :param msg_id: 订阅的msg id，为None的时候订阅所有的帧
+
+        :param callback: 回调函数，参数是收到的Message
+
+        :param mask: ID掩码，(收到的ID & mask) == (msg_id & mask)的时候匹配，默认需要ID相同
+
+        :param predicate: 帧的条件，返回True的时候才通知
+
+        :param queue_size: 队列的最大长度，满了以后丢弃最早的帧
+
+        :param edge: 为True的时候只在predicate从False变成True的时候通知一次
+
+        :return: Subscription，调用cancel取消订阅
+        """
+        return self._can.subscribe(msg_id, callback, mask, predicate, queue_size, edge)
+
+    def unsubscribe(self, subscription: Optional[Subscription] = None):
+        """
+        取消订阅
+
+        :param subscription: 订阅，为None的时候取消所有订阅
+        """
+        self._can.unsubscribe(subscription)
+
+    def wait_for_message(self, msg_id: Optional[int] = None, timeout: float = 5, mask: Optional[int] = None,
+                         predicate: Optional[Callable[[Message], bool]] = None) -> WaitResult:
+        """
+        等待调用之后收到的第一帧满足条件的消息，收到以后立即返回，不需要等到超时
+
+        :param msg_id: msg id，为None的时候等待任意一帧
+
+        :param timeout: 超时时间，单位秒
+
+        :param mask: ID掩码，(收到的ID & mask) == (msg_id & mask)的时候匹配，默认需要ID相同
+
+        :param predicate: 帧的条件
+
+        :return: WaitResult(是否收到, 收到的帧, 从调用到收到的时间)，可以直接用于if判断
+        """
+        return self._can.wait_for_message(msg_id, timeout, mask, predicate)
+
+    def wait_for_silence(self, msg_id: Optional[int] = None, duration: float = 1, timeout: float = 10,
+                         mask: Optional[int] = None) -> WaitResult:
+        """
+        等待某个msg id(为None的时候是整个总线)连续duration秒没有收到消息，满足以后立即返回
+
+        :param msg_id: msg id，为None的时候是任意帧
+
+        :param duration: 需要持续静默的时间，单位秒
+
+        :param timeout: 超时时间，单位秒，不能小于duration
+
+        :param mask: ID掩码，参考wait_for_message
+
+        :return: WaitResult(是否静默, 最后收到的帧, 从调用到开始静默的时间)
+        """
+        return self._can.wait_for_silence(msg_id, duration, timeout, mask)
+
+    def start_record(self, file: str, flush_interval: float = 0.1, append: bool = False) -> CanRecorder:
+        """
+        开始录制收发的帧到二进制日志文件，录制的文件可以直接用于回放以及check_signal_value等信号分析的方法
+
+        :param file: 日志文件
+
+        :param flush_interval: 批量写入文件的间隔，单位秒
+
+        :param append: 文件已经存在的时候是否追加，默认覆盖
+
+        :return: 录制器
+        """
+        return self._can.start_record(file, flush_interval, append)
+
+    def stop_record(self) -> Optional[str]:
+        """
+        停止录制
+
+        :return: 日志文件，没有录制的时候返回None
+        """
+        return self._can.stop_record()
+
     def is_can_bus_lost(self, continue_time: int = 5) -> bool:
         """
         can总线是否数据丢失，如果检测周期内有一帧can信号表示can网络没有中断
 
-        :param continue_time: 清空数据，10s内收不到任何的CAN消息表示CAN总线丢失
+        :param continue_time: 最近continue_time秒内收不到任何的CAN消息表示CAN总线丢失
+
+            根据接收周期监控立即判断，只有打开CAN的时间不足continue_time且没有收到过消息的时候才会等待
         """
-        # 清空栈数据
-        self.clear_stack_data()
-        time.sleep(continue_time)
-        return len(self._can.get_stack()) == 0
+        monitor = self._can.monitor
+        silent_time = monitor.get_silent_time()
+        if silent_time >= continue_time:
+            return True
+        if monitor.is_received():
+            return False
+        return not self._can.wait_for_message(timeout=continue_time - silent_time)
 
     def init_uds(self, request_id: int, response_id: int, function_id: int):
         """
@@ -218,11 +459,35 @@ class Can(metaclass=Singleton):
     def send_and_receive_uds_message(self, message: List[int]) -> List[int]:
         """
         发送UDS诊断消息
-        :param message:
-        :return:
+
+        只需要响应数据的时候使用get_transport获取的IsoTpTransport
+        :param message: 请求数据
+        :return: 单帧响应返回收到的整帧数据(包含PCI和填充字节)，多帧响应返回不包含PCI的数据
         """
         return self._can.send_and_receive_uds_message(message)
 
+    def get_transport(self, request_id: int, response_id: int, **kwargs) -> IsoTpTransport:
+        """
+        获取一对诊断ID上的ISO-TP收发，提供同步的request和asyncio的request_async
+
+        :param request_id: 请求ID
+
+        :param response_id: 响应ID
+
+        :param kwargs: IsoTpTransport的其他参数
+
+        :return: IsoTpTransport
+        """
+        return self._can.get_transport(request_id, response_id, **kwargs)
+
+    def get_uds_latency_statistics(self) -> LatencyStatistics:
+        """
+        获取send_and_receive_uds_message的往返时间统计
+
+        :return: LatencyStatistics(次数, 平均值, 最小值, 最大值, p50, p90, p99)，单位毫秒
+        """
+        return self._can.get_uds_latency_statistics()
+
 
 class CANService(Can):
     """
@@ -262,16 +527,27 @@ class CANService(Can):
                  can_fd: bool = False,
                  max_workers: int = 300,
                  need_receive: bool = True,
-                 is_uds_can_fd: bool = False):
+                 is_uds_can_fd: bool = False,
+                 use_scheduler: bool = False):
         params = {"can_box_device": can_box_device, "baud_rate": baud_rate, "data_rate": data_rate,
                   "channel_index": channel_index, "can_fd": can_fd, "max_workers": max_workers,
-                  "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd}
+                  "need_receive": need_receive, "is_uds_can_fd": is_uds_can_fd, "use_scheduler": use_scheduler}
         super().__init__(**params)
         logger.debug(f"read message from file {messages}")
+        # message的定义(schema)是只读共享的，每个message只保存自己的数据和修改过的signal
         self.__messages, self.__name_messages = get_message(messages, encoding=encoding)
-        # 备份message, 可以作为初始值发送
-        self.__backup_messages = copy.deepcopy(self.__messages)
-        self.__backup_name_messages = copy.deepcopy(self.__name_messages)
+        # signal名字对应的(msg id, signal名字)，同时支持Msg.Signal的形式
+        self.__signal_index = dict()  # type: Dict[str, Tuple[int, str]]
+        # 节点(小写)对应的msg id
+        self.__sender_ids = dict()  # type: Dict[str, FrozenSet[int]]
+        self.__nm_ids = frozenset()  # type: FrozenSet[int]
+        self.__diag_ids = frozenset()  # type: FrozenSet[int]
+        # __filter_messages的结果
+        self.__filter_cache = dict()  # type: Dict[Tuple, Tuple[Message, ...]]
+        self.__build_index()
+        # DBC中定义的周期用于接收周期监控
+        self._can.set_cycle_times(dict((msg_id, message.cycle_time) for msg_id, message in self.__messages.items()
+                                       if message.cycle_time > 0))
 
     @property
     def name_messages(self) -> Dict[str, Message]:
@@ -281,36 +557,58 @@ class CANService(Can):
     def messages(self) -> Dict[int, Message]:
         return self.__messages
 
-    def __restore_default_message(self):
+    def __build_index(self):
         """
-        恢复初始的message值
+        加载message的时候建立signal名字的索引以及节点、网络管理帧、诊断帧的集合，避免每次调用都遍历所有的message
         """
-        self.__messages = copy.deepcopy(self.__backup_messages)
-        self.__name_messages = copy.deepcopy(self.__backup_name_messages)
-
-    def __set_message(self, msg_id: int, data: list) -> Message:
+        duplicates = dict()
+        senders = dict()
+        nm_ids, diag_ids = set(), set()
+        for msg_id, message in self.__messages.items():
+            for signal_name in message.signals:
+                self.__signal_index[f"{message.msg_name}.{signal_name}"] = msg_id, signal_name
+                if signal_name in self.__signal_index:
+                    duplicates.setdefault(signal_name, [self.__messages[self.__signal_index[signal_name][0]].msg_name])
+                    duplicates[signal_name].append(message.msg_name)
+                else:
+                    # 重名的时候和原来一样使用第一个message中的signal
+                    self.__signal_index[signal_name] = msg_id, signal_name
+            if message.sender:
+                senders.setdefault(message.sender.lower(), set()).add(msg_id)
+            if message.nm_message:
+                nm_ids.add(msg_id)
+            if message.diag_request or message.diag_response or message.diag_state:
+                diag_ids.add(msg_id)
+        self.__sender_ids = dict((key, frozenset(value)) for key, value in senders.items())
+        self.__nm_ids = frozenset(nm_ids)
+        self.__diag_ids = frozenset(diag_ids)
+        for signal_name, msg_names in duplicates.items():
+            logger.warning(f"signal {signal_name} is in messages {msg_names}, "
+                           f"use {msg_names[0]}.{signal_name} style name to specify the message")
+
+    def __resolve_signal(self, signal_name: str, msg_id: Optional[int] = None) -> Tuple[int, str]:
         """
-        :param msg_id: 消息ID
+        根据signal名字找到所在的message
 
-        :param data: 数据
+        :param signal_name: signal名字，重名的时候可以使用Msg.Signal的形式
 
-        :return: Message对象
+        :param msg_id: 已经指定的msg id，默认根据signal名字查找
+
+        :return: (msg id, message中的signal名字)
         """
-        msg = self.messages[msg_id]
-        msg.data = data
-        msg.update(False)
-        return msg
+        if signal_name not in self.__signal_index:
+            if msg_id is not None:
+                return msg_id, signal_name
+            raise RuntimeError(f"{signal_name} can not be found in messages")
+        index_msg_id, name = self.__signal_index[signal_name]
+        return index_msg_id if msg_id is None else msg_id, name
 
-    @staticmethod
-    def __is_message_in_node(message: Message, filter_sender: FilterNode) -> bool:
-        sender = message.sender.lower()
-        if isinstance(filter_sender, str):
-            return sender == filter_sender.lower()
-        elif isinstance(filter_sender, (tuple, list)):
-            for item in filter_sender:
-                if sender == item.lower():
-                    return True
-            return False
+    def __restore_default_message(self):
+        """
+        恢复初始的message值
+        """
+        for message in self.__messages.values():
+            message.reset()
 
     def __filter_messages(self,
                           filter_sender: Optional[FilterNode] = None,
@@ -327,17 +625,23 @@ class CANService(Can):
 
         :return: 过滤后的消息
         """
-        messages = []
-        for msg_id, message in self.messages.items():
-            if filter_sender:
-                is_filter_sender = self.__is_message_in_node(message, filter_sender)
-            else:
-                is_filter_sender = False
-            is_diag_message = filter_nm and (message.diag_request or message.diag_response or message.diag_state)
-            is_nm_message = filter_diag and message.nm_message
-            if not (is_filter_sender or is_diag_message or is_nm_message):
-                messages.append(message)
-        return messages
+        if isinstance(filter_sender, str):
+            senders = frozenset((filter_sender.lower(),))
+        elif filter_sender:
+            senders = frozenset(x.lower() for x in filter_sender)
+        else:
+            senders = frozenset()
+        key = senders, filter_nm, filter_diag
+        if key not in self.__filter_cache:
+            excluded = set()
+            for sender in senders:
+                excluded.update(self.__sender_ids.get(sender, ()))
+            if filter_nm:
+                excluded.update(self.__nm_ids)
+            if filter_diag:
+                excluded.update(self.__diag_ids)
+            self.__filter_cache[key] = tuple(x for x in self.__messages.values() if x.msg_id not in excluded)
+        return self.__filter_cache[key]
 
     def __send_message(self,
                        message: Message,
@@ -368,7 +672,8 @@ class CANService(Can):
                     logger.trace(f"value is [{value}]")
                     sig.value = value
         logger.trace(f"sender is {message.sender}")
-        logger.debug(f"{hex(message.msg_id)} = {message.data}")
+        if log_level.debug:
+            logger.debug(f"{hex(message.msg_id)} = {hex_list(message.data)}")
         self.send_can_message(message)
         # # 避免错误发生后不再发送数据，容错处理
         # try:
@@ -387,11 +692,33 @@ class CANService(Can):
         if interval > 0:
             sleep(interval)
 
-    def __get_msg_id_from_signal_name(self, signal_name: str) -> int:
-        for msg_name, msg in self.messages.items():
-            if signal_name in msg.signals:
-                return msg.msg_id
-        raise RuntimeError(f"{signal_name} can not be found in messages")
+    def __decode_signal(self, stack: Stack, msg_id: int, signal_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量计算栈中某个msg id所有帧的signal值
+
+        :param stack: 栈中消息，也可以是录制的日志文件或者CanLog
+
+        :param msg_id: msg id
+
+        :param signal_name: 信号名称
+
+        :return: (总线值数组, 物理值数组)
+        """
+        message = self.messages[msg_id]
+        if signal_name not in message.signals:
+            raise RuntimeError(f"{signal_name} is not in {msg_id}")
+        if isinstance(stack, str):
+            stack = CanLog(stack)
+        if isinstance(stack, (StackView, CanLog)):
+            # 直接从栈的数据列或者日志文件中取出
+            frames = stack.get_frames(msg_id)
+        else:
+            frames = get_frame_array(list(filter(lambda x: x.msg_id == msg_id, stack)))
+        logger.debug(f"filter messages length is {len(frames)}")
+        if len(frames) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return message.decode_frames(frames, (signal_name,))[signal_name]
 
     def send_can_message_by_id_or_name(self, msg: MessageIdentity):
         """
@@ -450,7 +777,8 @@ class CANService(Can):
         if not type_:
             logger.debug("now update message")
             send_msg.update(True)
-        logger.debug(f"msg Id {hex(send_msg.msg_id)}, msg data is {list(map(lambda x: hex(x), send_msg.data))}")
+        if log_level.debug:
+            logger.debug(f"msg Id {hex(send_msg.msg_id)}, msg data is {hex_list(send_msg.data)}")
         self.transmit(send_msg)
 
     def receive_can_message(self, message_id: int) -> Message:
@@ -481,14 +809,105 @@ class CANService(Can):
 
         :return: 查到的指定信号的物理值
         """
+        _, signal_name = self.__resolve_signal(signal_name, message_id)
         return self.receive_can_message(message_id).signals[signal_name].physical_value
 
+    def subscribe_signal(self, condition: str, predicate: Optional[Callable[[float], bool]] = None,
+                         callback: Optional[Callable[[Message], None]] = None, queue_size: int = 1000,
+                         edge: bool = False) -> Subscription:
+        """
+        按照信号的物理值订阅接收到的帧，只解析该信号
+
+        :param condition: 条件表达式，如"VehicleSpeed > 50"，也可以只传信号名字(可以是Msg.Signal)，配合predicate使用
+
+        :param predicate: 物理值的判断函数，condition中没有条件的时候使用，都没有的时候每一帧都通知
+
+        :param callback: 回调函数，参数是收到的Message，为None的时候通过Subscription.get等待
+
+        :param queue_size: 队列的最大长度，满了以后丢弃最早的帧
+
+        :param edge: 为True的时候只在条件从不满足变成满足的时候通知一次
+
+        :return: Subscription，调用cancel取消订阅
+        """
+        msg_id, message_predicate = self.__get_signal_predicate(condition, predicate)
+        return self.subscribe(msg_id, callback, predicate=message_predicate, queue_size=queue_size, edge=edge)
+
+    def wait_for_signal(self, signal: str, predicate: Optional[Callable[[float], bool]] = None, timeout: float = 5,
+                        include_current: bool = False) -> WaitResult:
+        """
+        等待信号满足条件，满足以后立即返回，不需要等到超时
+
+        :param signal: 条件表达式，如"VehicleSpeed > 50"，也可以只传信号名字(可以是Msg.Signal)，配合predicate使用
+
+        :param predicate: 物理值的判断函数，signal中没有条件的时候使用，都没有的时候收到该message就返回
+
+        :param timeout: 超时时间，单位秒
+
+        :param include_current: 是否先检查最后收到的值，默认只检查调用之后收到的帧
+
+        :return: WaitResult(是否满足, 满足条件的帧, 从调用到收到的时间)，可以直接用于if判断
+        """
+        msg_id, message_predicate = self.__get_signal_predicate(signal, predicate)
+        if include_current:
+            try:
+                current = self.receive(msg_id)
+                if message_predicate is None or message_predicate(current):
+                    return WaitResult(True, current, 0.0)
+            except RuntimeError:
+                logger.debug(f"message {hex(msg_id)} not receive yet")
+        return self._can.wait_for_message(msg_id, timeout, predicate=message_predicate)
+
+    def __get_signal_predicate(self, condition: str, predicate: Optional[Callable[[float], bool]] = None) \
+            -> Tuple[int, Optional[Callable[[Message], bool]]]:
+        """
+        把信号的条件转换成帧的条件，只解析该信号
+
+        :return: (msg id, 帧的条件)，没有条件的时候帧的条件为None
+        """
+        name, condition_predicate = parse_condition(condition)
+        if condition_predicate is not None:
+            predicate = condition_predicate
+        msg_id, signal_name = self.__resolve_signal(name)
+        if predicate is None:
+            return msg_id, None
+        schema = self.messages[msg_id].schema
+        codec = schema.codec
+        names = signal_name,
+        signal = schema.signals[signal_name]
+        factor, offset = float(signal.factor), float(signal.offset)
+
+        def message_predicate(message: Message) -> bool:
+            value = codec.decode(message.data, names)[signal_name]
+            # 和Signal.physical_value的计算方式保持一致
+            return predicate(int(value * factor + offset))
+
+        return msg_id, message_predicate
+
+    def get_signals(self, signals: Iterable[str]) -> Dict[str, float]:
+        """
+        一次获取多个signal在CAN上最后收到的物理值，同一个message的signal只接收和解析一次
+
+        :param signals: signal名字，重名的时候可以使用Msg.Signal的形式，也可以是{"sig": ...}这样的字典(只使用key)
+
+            如： ["signal_name1", "MSG_NAME.signal_name2"]
+
+        :return: 其中key是传入的signal名字，value是物理值
+        """
+        resolved = [(name, ) + self.__resolve_signal(name) for name in signals]
+        messages = dict()
+        for _, msg_id, _ in resolved:
+            if msg_id not in messages:
+                messages[msg_id] = self.receive_can_message(msg_id)
+        return dict((name, messages[msg_id].signals[signal_name].physical_value)
+                    for name, msg_id, signal_name in resolved)
+
     @staticmethod
-    def is_msg_value_changed(stack: Sequence[Message], msg_id: int) -> bool:
+    def is_msg_value_changed(stack: Stack, msg_id: int) -> bool:
         """
         检测某个msg是否有变化，只能检测到整个8byte数据是否有变化
 
-        :param stack: 记录下来的CAN消息
+        :param stack: 记录下来的CAN消息，也可以是录制的日志文件或者CanLog
 
         :param msg_id: 信号ID
 
@@ -497,17 +916,22 @@ class CANService(Can):
 
             False: 没有变化
         """
+        if isinstance(stack, str):
+            stack = CanLog(stack)
+        if isinstance(stack, CanLog):
+            frames = stack.get_frames(msg_id)
+            return len(frames) > 1 and bool(np.any(frames != frames[0]))
         # 过滤掉没有用的数据
         data_list = list(filter(lambda x: x.msg_id == msg_id, stack))
         duplicate = set()
         for message in data_list:
             data = message.data
-            duplicate.add(data)
+            duplicate.add(tuple(data))
         return len(duplicate) > 1
 
     def is_lost_message(self,
                         msg_id: int,
-                        cycle_time: int,
+                        cycle_time: Optional[int] = None,
                         continue_time: int = 5,
                         lost_period: Optional[int] = None,
                         bus_time: Optional[int] = None) -> bool:
@@ -518,15 +942,17 @@ class CANService(Can):
 
         1、总线是否丢失
 
-        2、最后两帧收到的消息间隔时间大于信号周期间隔时间且收到的消息小于应该收到的消息去掉信号丢失周期应该收到的消息数量
+        2、超过lost_period个周期没有收到该message
+
+        根据接收周期监控立即判断，只有打开CAN以后一直没有收到该message且监控的时间不足lost_period个周期的时候才会等待
 
         :param msg_id: message id值
 
-        :param lost_period: 信号丢失周期（默认为10个周期)
+        :param cycle_time: 信号周期 单位ms，默认使用DBC中的周期
 
-        :param continue_time: 检测时间（当不为空的时候，会清空数据并等待time ms，然后再检测数据)
+        :param continue_time: 最长的等待时间，单位秒
 
-        :param cycle_time: 信号周期 单位ms
+        :param lost_period: 信号丢失周期（默认为10个周期)
 
         :param bus_time: 总线丢失检测时间,默认不检测
         """
@@ -535,40 +961,25 @@ class CANService(Can):
             logger.info(f"judge bus status")
             if self.is_can_bus_lost(bus_time):
                 return True
-        logger.debug(f"sleep {continue_time}")
-        # 清空栈数据，继续接收数据
-        self.clear_stack_data()
-        time.sleep(continue_time)
-        stack = self._can.get_stack()
-        logger.debug(f"stack size is {len(stack)}")
-        # 过滤掉没有用的数据
-        msg_stack_list = list(filter(lambda x: x.msg_id == msg_id, stack))
-        msg_stack_size = len(msg_stack_list)
-        logger.debug(f"msg_stack_size is {msg_stack_size}")
-        # 计算continue_time时间内应该受到的帧数量
-        receive_msg_size = (continue_time * 1000) / cycle_time
-        logger.debug(f"receive_msg_size is {receive_msg_size}")
-        if lost_period:
-            logger.debug(f"lost_period exist")
-            # 确保至少收到两个以上的信号
-            if msg_stack_size < 2:
-                return True
-            else:
-                pass_time = (int(msg_stack_list[-1].time_stamp, 16) - int(msg_stack_list[-2].time_stamp, 16)) / 1000
-                judge_time = cycle_time * lost_period
-                logger.info(f"pass time is {pass_time} and judge time is {judge_time}")
-                # 最后两帧的间隔时间大于信号周期间隔时间且收到的消息小于应该收到的消息去掉信号丢失周期应该收到的消息
-                max_lost_receive_msg_size = receive_msg_size - (lost_period * 1000) / cycle_time
-                logger.info(f"msg_stack_size is {msg_stack_size} and max_size is {max_lost_receive_msg_size}")
-                return pass_time > judge_time and msg_stack_size < max_lost_receive_msg_size
-        else:
-            logger.info(f"need receive msg size [{receive_msg_size}] and actual receive size is [{msg_stack_size}]")
-            return msg_stack_size < receive_msg_size
+        monitor = self._can.monitor
+        if cycle_time is None:
+            cycle_time = monitor.get_cycle_time(msg_id)
+            if cycle_time == 0:
+                raise ValueError(f"cycle time of message {hex(msg_id)} is not defined")
+        judge_time = cycle_time * (lost_period if lost_period else 10) / 1000
+        silent_time = monitor.get_silent_time(msg_id)
+        logger.info(f"silent time is {silent_time} and judge time is {judge_time}")
+        if silent_time > judge_time:
+            return True
+        if monitor.is_received(msg_id):
+            return False
+        # 监控的时间不够，等待剩下的时间
+        return not self._can.wait_for_message(msg_id, min(judge_time - silent_time, continue_time))
 
     @staticmethod
-    def is_signal_value_changed(stack: Sequence[Message], msg_id: int, signal_name: str) -> bool:
+    def is_signal_value_changed(stack: Stack, msg_id: int, signal_name: str) -> bool:
         """
-        检测某个msg中某个signal是否有变化
+        检测某个msg中某个signal是否有变化，使用已经创建的CANService中矩阵表的定义
 
         :param stack: 记录下来的CAN消息
 
@@ -581,69 +992,53 @@ class CANService(Can):
 
             False: 没有变化
         """
-        # 过滤掉没有用的数据
-        data_list = list(filter(lambda x: x.msg_id == msg_id, stack))
-        duplicate = set()
-        for message in data_list:
-            signal = message.signals[signal_name]
-            duplicate.add(signal.value)
-        return len(duplicate) > 1
+        service = CANService._instance
+        if service is None:
+            raise RuntimeError("please create CANService first")
+        msg_id, signal_name = service.__resolve_signal(signal_name, msg_id)
+        values, _ = service.__decode_signal(stack, msg_id, signal_name)
+        return bool(np.any(values != values[0])) if len(values) > 0 else False
 
     def get_receive_signal_values(self,
-                                  stack: Sequence[Message],
+                                  stack: Stack,
                                   signal_name: str,
-                                  msg_id: Optional[str] = None) -> Sequence[int]:
+                                  msg_id: Optional[int] = None) -> Sequence[int]:
         """
         所有曾经出现的信号值
         :param stack:
         :param msg_id:
         :param signal_name:
-        :return:
+        :return: 按照出现的先后顺序排列的物理值
         """
-        if msg_id is None:
-            msg_id = self.__get_msg_id_from_signal_name(signal_name)
-        result = []
-        filter_messages = list(filter(lambda x: x.msg_id == msg_id, stack))
-        for msg in filter_messages:
-            message = self.__set_message(msg.msg_id, msg.data)
-            if signal_name not in message.signals:
-                raise RuntimeError(f"{signal_name} is not in {msg_id}")
-            else:
-                signal = message.signals[signal_name]
-                if signal.physical_value not in result:
-                    result.append(signal.physical_value)
-        return result
+        msg_id, signal_name = self.__resolve_signal(signal_name, msg_id)
+        _, physical_values = self.__decode_signal(stack, msg_id, signal_name)
+        values, indexes = np.unique(physical_values, return_index=True)
+        return values[np.argsort(indexes)].tolist()
 
     def count_signal_value(self,
-                           stack: Sequence[Message],
+                           stack: Stack,
                            signal_name: str,
-                           expect_value: int) -> int:
+                           expect_value: int,
+                           msg_id: Optional[int] = None) -> int:
         """
        检查signal的值是否符合要求
 
-       :param signal_name:  sig name
+       :param signal_name:  sig name，重名的时候可以使用Msg.Signal的形式
 
        :param expect_value: expect value
 
        :param stack: 栈中消息
+
+       :param msg_id: msg id，默认根据signal名字查找
        """
-        msg_id = self.__get_msg_id_from_signal_name(signal_name)
-        # 过滤需要的msg
-        filter_messages = list(filter(lambda x: x.msg_id == msg_id, stack))
-        logger.debug(f"filter messages length is {len(filter_messages)}")
-        msg_count = 0
-        for msg in filter_messages:
-            logger.debug(f"msg data = {msg.data}")
-            # 此时的msg只有data，需要调用方法更新内容
-            message = self.__set_message(msg.msg_id, msg.data)
-            actual_value = message.signals[signal_name].physical_value
-            logger.debug(f"actual_value = {actual_value}")
-            if actual_value == expect_value:
-                msg_count += 1
+        msg_id, signal_name = self.__resolve_signal(signal_name, msg_id)
+        _, physical_values = self.__decode_signal(stack, msg_id, signal_name)
+        msg_count = int(np.count_nonzero(physical_values == expect_value))
+        logger.debug(f"actual count = {msg_count}")
         return msg_count
 
     def check_signal_value(self,
-                           stack: Sequence[Message],
+                           stack: Stack,
                            signal_name: str,
                            expect_value: int,
                            msg_id: Optional[int] = None,
@@ -656,7 +1051,7 @@ class CANService(Can):
 
         :param msg_id: msg id
 
-        :param signal_name:  sig name
+        :param signal_name:  sig name，重名的时候可以使用Msg.Signal的形式
 
         :param expect_value: expect value
 
@@ -664,10 +1059,9 @@ class CANService(Can):
 
         :param stack: 栈中消息
         """
-        if msg_id is None:
-            msg_id = self.__get_msg_id_from_signal_name(signal_name)
+        msg_id, signal_name = self.__resolve_signal(signal_name, msg_id)
         if count:
-            msg_count = self.count_signal_value(stack, signal_name, expect_value)
+            msg_count = self.count_signal_value(stack, signal_name, expect_value, msg_id)
             logger.info(f"except count is {count}, actual count = {msg_count}")
             if exact:
                 return msg_count == count
@@ -0,0 +1,257 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        codec.py
+# @Author:      lizhe
+# @Created:     2023/3/20 - 21:15
+# --------------------------------------------------------
+from typing import Dict, Sequence, Tuple, Optional, Iterable, List
+
+import numpy as np
+
+"""
+信号编解码器
+
+message.py中的set_data/get_data通过二进制字符串的方式计算signal的值，每次调用都需要bin()、补齐、切片、int(x, 2)等操作，
+
+当周期信号较多的时候会占用大量的CPU。
+
+本模块在加载message的时候根据signal的start_bit、bit_length、byte_type和is_sign预先计算出位移和掩码，
+
+编码和解码的时候只需要对int.from_bytes得到的整数做位运算即可。
+
+对于栈中大量的同一个message的数据，可以组成(N, dlc)的uint8数组，通过decode_array一次性计算出所有帧的signal值。
+
+set_data/get_data仍然保留，作为本模块计算结果的参照实现。
+"""
+
+# 位长度
+_bit_length = 8
+
+# 字节序
+_little = "little"
+_big = "big"
+
+
+class SignalCodec(object):
+    """
+    单个signal的编解码计划
+
+    Intel模式下，signal在小端整数中是连续的，位移即start_bit
+
+    Motorola MSB模式下，signal在大端整数中是连续的，位移需要根据数据长度计算
+    """
+
+    __slots__ = ("name", "start_bit", "bit_length", "byte_type", "is_sign", "mask", "segments", "__sign_bit",
+                 "__shifts")
+
+    def __init__(self, name: str, start_bit: int, bit_length: int, byte_type: bool, is_sign: bool):
+        self.name = name
+        self.start_bit = start_bit
+        self.bit_length = bit_length
+        self.byte_type = byte_type
+        self.is_sign = is_sign
+        self.mask = (1 << bit_length) - 1
+        self.__sign_bit = 1 << (bit_length - 1)
+        # 按byte拆分后的位置信息，每一项是(byte_index, bit_offset, width, value_shift)
+        self.segments = self.__get_segments()
+        # 不同数据长度对应的位移
+        self.__shifts = dict()
+
+    def __get_segments(self) -> Tuple[Tuple[int, int, int, int], ...]:
+        """
+        计算signal占据的每个byte的位置
+
+        :return: ((byte_index, bit_offset, width, value_shift), ...)，value_shift是该段在signal值中的起始位
+        """
+        segments = []
+        byte_index, bit_offset = divmod(self.start_bit, _bit_length)
+        rest_length = self.bit_length
+        if self.byte_type:
+            # Intel从低位开始，依次往高字节填充
+            value_shift = 0
+            while rest_length > 0:
+                width = min(_bit_length - bit_offset, rest_length)
+                segments.append((byte_index, bit_offset, width, value_shift))
+                value_shift += width
+                rest_length -= width
+                byte_index += 1
+                bit_offset = 0
+        else:
+            # Motorola MSB从start_bit所在的高位开始，依次往高字节（低位）填充
+            top = bit_offset
+            while rest_length > 0:
+                width = min(top + 1, rest_length)
+                rest_length -= width
+                segments.append((byte_index, top - width + 1, width, rest_length))
+                byte_index += 1
+                top = _bit_length - 1
+        return tuple(segments)
+
+    def shift(self, byte_length: int) -> int:
+        """
+        获取signal在整数中的位移
+
+        :param byte_length: 数据长度
+
+        :return: 位移
+        """
+        try:
+            return self.__shifts[byte_length]
+        except KeyError:
+            if self.byte_type:
+                shift = self.start_bit
+            else:
+                byte_index, bit_offset = divmod(self.start_bit, _bit_length)
+                shift = (byte_length - 1 - byte_index) * _bit_length + bit_offset - (self.bit_length - 1)
+            if shift < 0 or shift + self.bit_length > byte_length * _bit_length:
+                raise ValueError(f"signal[{self.name}] start bit[{self.start_bit}] and bit length[{self.bit_length}] "
+                                 f"is out of data length[{byte_length}]")
+            self.__shifts[byte_length] = shift
+            return shift
+
+    def to_signed(self, value: int) -> int:
+        """
+        把总线上的无符号值转换成有符号值(仅is_sign为True时)
+
+        :param value: 无符号值
+
+        :return: 信号值
+        """
+        if self.is_sign and value & self.__sign_bit:
+            return value - (self.mask + 1)
+        return value
+
+
+class MessageCodec(object):
+    """
+    一个message中所有signal的编解码器
+
+    编码和解码都只做一次int.from_bytes和to_bytes的转换，Intel信号和Motorola信号分别在小端和大端整数上做位运算
+    """
+
+    def __init__(self, codecs: Iterable[SignalCodec]):
+        self.__codecs = dict()
+        for codec in codecs:
+            self.__codecs[codec.name] = codec
+        # 不同数据长度对应的编译结果
+        self.__plans = dict()
+
+    @property
+    def codecs(self) -> Dict[str, SignalCodec]:
+        return self.__codecs
+
+    def compile(self, byte_length: int) -> Tuple[List[Tuple], List[Tuple]]:
+        """
+        预先计算指定数据长度下每个signal的位移和掩码
+
+        :param byte_length: 数据长度
+
+        :return: (intel计划, motorola计划)，每一项是(name, shift, mask, clear_mask, codec)
+        """
+        try:
+            return self.__plans[byte_length]
+        except KeyError:
+            full_mask = (1 << (byte_length * _bit_length)) - 1
+            intel = []
+            motorola = []
+            for name, codec in self.__codecs.items():
+                shift = codec.shift(byte_length)
+                field = codec.mask << shift
+                plan = name, shift, codec.mask, full_mask ^ field, codec
+                if codec.byte_type:
+                    intel.append(plan)
+                else:
+                    motorola.append(plan)
+            self.__plans[byte_length] = intel, motorola
+            return intel, motorola
+
+    def encode(self, data: Sequence[int], values: Dict[str, int]) -> bytes:
+        """
+        把signal的值编码到数据中
+
+        :param data: 原始数据
+
+        :param values: signal的值，其中key是signal名字，value是总线值
+
+        :return: 编码后的数据
+        """
+        byte_length = len(data)
+        payload = bytes(data)
+        intel, motorola = self.compile(byte_length)
+        if intel:
+            raw = int.from_bytes(payload, _little)
+            for name, shift, mask, clear_mask, _ in intel:
+                if name in values:
+                    raw = (raw & clear_mask) | ((int(values[name]) & mask) << shift)
+            payload = raw.to_bytes(byte_length, _little)
+        if motorola:
+            raw = int.from_bytes(payload, _big)
+            for name, shift, mask, clear_mask, _ in motorola:
+                if name in values:
+                    raw = (raw & clear_mask) | ((int(values[name]) & mask) << shift)
+            payload = raw.to_bytes(byte_length, _big)
+        return payload
+
+    def decode(self, data: Sequence[int], names: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        从数据中解码出signal的值
+
+        :param data: 数据
+
+        :param names: 需要解码的signal名字，默认解码全部
+
+        :return: signal的值，其中key是signal名字，value是总线值
+        """
+        byte_length = len(data)
+        payload = bytes(data)
+        intel, motorola = self.compile(byte_length)
+        names = None if names is None else set(names)
+        values = dict()
+        if intel:
+            raw = int.from_bytes(payload, _little)
+            for name, shift, mask, _, codec in intel:
+                if names is None or name in names:
+                    values[name] = codec.to_signed((raw >> shift) & mask)
+        if motorola:
+            raw = int.from_bytes(payload, _big)
+            for name, shift, mask, _, codec in motorola:
+                if names is None or name in names:
+                    values[name] = codec.to_signed((raw >> shift) & mask)
+        return values
+
+    def decode_array(self, frames: np.ndarray, names: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        批量解码，一次性计算出所有帧中signal的值
+
+        :param frames: (N, dlc)的uint8数组，每一行是一帧数据
+
+        :param names: 需要解码的signal名字，默认解码全部
+
+        :return: signal的值，其中key是signal名字，value是长度为N的总线值数组
+        """
+        frames = np.asarray(frames, dtype=np.uint8)
+        if frames.ndim != 2:
+            raise ValueError(f"frames must be (N, dlc) array, but now shape is {frames.shape}")
+        size, width = frames.shape
+        names = self.__codecs.keys() if names is None else names
+        values = dict()
+        for name in names:
+            codec = self.__codecs[name]
+            raw = np.zeros(size, dtype=np.uint64)
+            for byte_index, bit_offset, bit_width, value_shift in codec.segments:
+                if byte_index >= width:
+                    raise ValueError(f"signal[{name}] need byte[{byte_index}], but frame length is {width}")
+                part = (frames[:, byte_index] >> np.uint8(bit_offset)) & np.uint8((1 << bit_width) - 1)
+                raw |= part.astype(np.uint64) << np.uint64(value_shift)
+            if codec.is_sign:
+                # 左移到最高位后按int64算术右移，完成符号扩展
+                pad = np.uint64(64 - codec.bit_length)
+                value = (raw << pad).view(np.int64) >> np.int64(pad)
+            elif codec.bit_length == 64:
+                value = raw
+            else:
+                value = raw.astype(np.int64)
+            values[name] = value
+        return values
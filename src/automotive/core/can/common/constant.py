@@ -24,3 +24,17 @@ dlc = {
     48: 14,
     64: 15
 }
+
+# DLC对应的数据长度
+dlc_length = {value: key for key, value in dlc.items()}
+
+# 标准帧ID的最大值
+MAX_STANDARD_ID = 0x7FF
+# 扩展帧ID的最大值
+MAX_EXTENDED_ID = 0x1FFFFFFF
+# 扩展帧的标志位，和SocketCAN的CAN_EFF_FLAG相同，放在ID的最高位
+EXTENDED_ID_FLAG = 0x80000000
+# CAN数据的最大长度
+MAX_CAN_DATA_LENGTH = 8
+# CAN FD数据的最大长度
+MAX_FD_DATA_LENGTH = 64
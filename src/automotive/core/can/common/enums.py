@@ -35,7 +35,7 @@ class CanBoxDeviceEnum(Enum):
     """
     CAN盒子的类型，目前支持
 
-    PEAKCAN、USBCAN、CANALYST
+    PEAKCAN、USBCAN、CANALYST、TSMASTER、ZLGUSBCAN、VIRTUAL
     """
     # PCAN
     PEAKCAN = "PEAKCAN", False
@@ -47,6 +47,8 @@ class CanBoxDeviceEnum(Enum):
     TSMASTER = "TSMASTER", True
     # 周立功
     ZLGUSBCAN = "ZLGUSBCAN", True
+    # 虚拟设备，不需要硬件，不参与自动查找
+    VIRTUAL = "VIRTUAL", True
 
     # 爱泰 CAN FD
     # ITEK = "ITEK"
@@ -76,9 +78,12 @@ class TraceTypeEnum(Enum):
         SPY3_ASC: SPY3录制的CAN log(ASC类型)
 
         CANOE_ASC: CANoe录制的CAN log(ASC类型)
+
+        BINARY: CANService录制的二进制CAN log
     """
     PCAN = "pcan_reader", "PCanReader"
     USB_CAN = "usb_can_reader", "UsbCanReader"
     SPY3_CSV = "vspy_csv_reader", "VspyCsvReader"
     SPY3_ASC = "vspy_ase_reader", "VspyAseReader"
     CANOE_ASC = "canoe_asc_reader", "CanoeAscReader"
+    BINARY = "binary_reader", "BinaryReader"
@@ -6,17 +6,24 @@
 # @Author:      lizhe
 # @Created:     2021/11/18 - 22:07
 # --------------------------------------------------------
-import copy
-import time
 from abc import ABCMeta, abstractmethod
 from concurrent.futures import ThreadPoolExecutor, ALL_COMPLETED, wait
-from typing import Tuple, Sequence, List
-from time import sleep
+from typing import Tuple, Sequence, List, Optional, Dict, Callable
+from time import sleep, perf_counter
+from threading import Event
 
 from automotive.common.constant import check_connect, can_tips
-from automotive.logger.logger import logger
-from .constant import dlc
+from automotive.logger.logger import logger, lazy_logger, log_level, hex_list
+from .constant import dlc, dlc_length
 from .enums import BaudRateEnum
+from .isotp import IsoTpTransport, LatencyStatistics
+from .monitor import CycleMonitor, CycleStatistics
+from .recorder import CanRecorder
+from .receive_filter import ReceiveFilter, FilterStatistics
+from .subscription import Subscription, SubscriptionDispatcher, WaitResult
+from .stack import FrameStack
+from .scheduler import TransmitScheduler, JitterStatistics
+from .typehints import Number
 from ..message import Message
 
 
@@ -73,19 +80,67 @@ class BaseCanDevice(metaclass=ABCMeta):
         """
         pass
 
+    def transmit_many(self, messages: Sequence[Message]):
+        """
+        一次发送多帧CAN消息，默认逐帧调用transmit，支持批量发送的设备需要重写该方法
+
+        某一帧发送失败不影响其他帧的发送，全部发送完成后统一抛出异常
+
+        :param messages: CAN消息列表
+        """
+        failed = []
+        for message in messages:
+            try:
+                self.transmit(message)
+            except RuntimeError as e:
+                logger.trace(f"transmit {hex(message.msg_id)} failed, error is {e}")
+                failed.append(hex(message.msg_id))
+        if failed:
+            raise RuntimeError(f"transmit {failed} failed")
+
     @abstractmethod
     def receive(self) -> Tuple:
         """
-        接收CAN消息
+        接收CAN消息，接收缓冲区为空的时候通过返回值表示(如数量为0)，不抛出异常
         :return: message CAN消息
         """
         pass
 
+    def wait_for_receive(self, timeout: float) -> Optional[bool]:
+        """
+        阻塞等待接收缓冲区中有数据，设备支持接收事件或者阻塞读取的时候重写该方法
+
+        :param timeout: 超时时间，单位秒
+
+        :return: 有数据返回True，超时返回False，设备不支持等待返回None(接收线程退避轮询)
+        """
+        return None
+
+    def set_receive_event(self, event: Optional[Event]) -> bool:
+        """
+        设置接收事件，有数据放入接收缓冲区的时候set该事件，多通道会话通过一个事件等待所有的通道，设备支持的时候重写该方法
+
+        :param event: 接收事件，为None的时候取消
+
+        :return: 设备支持返回True
+        """
+        return False
+
+    def set_receive_filter(self, ranges: Sequence[Tuple[int, int, bool]]) -> bool:
+        """
+        设置硬件验收滤波，设备支持的时候重写该方法，设置的滤波可以比ranges宽，软件滤波会再过滤一次
+
+        :param ranges: [(起始ID, 结束ID, 是否扩展帧), ...]，为空的时候取消滤波，接收所有的帧
+
+        :return: 设置了硬件滤波返回True，设备不支持返回False
+        """
+        return False
+
 
 class BaseCanBus(metaclass=ABCMeta):
     def __init__(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                  channel_index: int = 1, can_fd: bool = False, max_workers: int = 300, need_receive: bool = True,
-                 is_uds_can_fd: bool = False):
+                 is_uds_can_fd: bool = False, use_scheduler: bool = False):
         # UDS是否使用CANFD模式
         self._is_uds_can_fd = is_uds_can_fd
         # 表示间隔时间10ms
@@ -115,7 +170,7 @@ class BaseCanBus(metaclass=ABCMeta):
         # 保存发送的事件信号的字典，用于发送
         self._event_send_messages = dict()
         # 用于存放接收到的数据
-        self._stack = []
+        self._stack = FrameStack(self._max_message_size, 64 if can_fd else 8)
         # 周期性信号
         self._cycle = "Cycle"
         # 事件性信号
@@ -149,6 +204,25 @@ class BaseCanBus(metaclass=ABCMeta):
         self._response_id = None
         # 诊断的功能请求ID
         self._function_id = None
+        # ISO-TP的收发，key是响应ID，接收线程收到的帧直接交给对应的transport
+        self._transports = dict()  # type: Dict[int, IsoTpTransport]
+        # 单线程发送调度器，不使用的时候每个周期信号一个线程
+        self._scheduler = TransmitScheduler(self.__transmit_batch) if use_scheduler else None
+        # 日志录制器，录制的时候记录所有收发的帧
+        self._recorder = None  # type: Optional[CanRecorder]
+        # 接收订阅的分发
+        self._dispatcher = SubscriptionDispatcher()
+        # 接收周期监控
+        self._monitor = CycleMonitor()
+        # 接收线程阻塞等待的超时时间，也是关闭的时候接收线程退出的最长时间，单位秒
+        self._receive_wait_time = 0.05
+        # 设备不支持阻塞等待的时候，轮询的最小和最大间隔，单位秒
+        self._min_poll_interval = 0.0005
+        self._max_poll_interval = 0.005
+        # 是否在多通道会话中，会话中的通道共用线程池、发送调度线程和接收线程
+        self._in_session = False
+        # 接收滤波，各个总线的_read在构造Message之前检查
+        self._receive_filter = None  # type: Optional[ReceiveFilter]
 
     @property
     def random_thread(self) -> List:
@@ -158,20 +232,103 @@ class BaseCanBus(metaclass=ABCMeta):
     def can_device(self) -> BaseCanDevice:
         return self._can
 
+    @property
+    def channel_index(self) -> int:
+        return self._channel_index
+
     @property
     def thread_pool(self) -> ThreadPoolExecutor:
         return self._thread_pool
 
+    @property
+    def monitor(self) -> CycleMonitor:
+        return self._monitor
+
     def _append(self, message: Message):
-        if len(self._stack) == self._max_message_size:
-            self._stack.pop(0)
         self._stack.append(message)
+        self._monitor.update(message)
+        if self._recorder:
+            self._recorder.record(message)
+        transport = self._transports.get(message.msg_id)
+        if transport:
+            transport.feed(message)
+        if self._dispatcher.active:
+            self._dispatcher.dispatch(message)
+
+    def _join_session(self, thread_pool: ThreadPoolExecutor, scheduler: Optional[TransmitScheduler]):
+        """
+        加入多通道会话，必须在open_can之前调用
+
+        :param thread_pool: 会话共用的线程池
+
+        :param scheduler: 会话共用的发送调度器，为None的时候每个周期信号一个线程
+        """
+        self._in_session = True
+        # 会话的接收线程调用_read，不再启动自己的接收线程
+        self._need_start_receive = False
+        self._thread_pool = thread_pool
+        self._scheduler = scheduler.add_channel(self._channel_index, self.__transmit_batch) if scheduler else None
+
+    @abstractmethod
+    def _read(self) -> int:
+        """
+        读取设备接收缓冲区中所有的帧并处理，每个总线需要实现
+
+        :return: 本次处理的帧数，缓冲区为空的时候返回0
+        """
+        pass
+
+    def _handle_receive(self, message: Message):
+        """
+        接收线程中处理收到的一帧
+        """
+        self._receive_messages[message.msg_id] = message
+        self._append(message)
+        # UDS的时候自动发多帧的流控帧信号
+        self._handle_continue_frame(message)
+
+    def _receive_loop(self):
+        """
+        CAN接收帧函数，在接收线程中执行
+
+        每次唤醒都把设备缓冲区中的帧全部读完，缓冲区为空的时候阻塞等待设备的接收事件，
+
+        设备不支持等待的时候从_min_poll_interval开始逐渐加倍休眠时间，最长_max_poll_interval，收到数据以后恢复
+        """
+        interval = self._min_poll_interval
+        while self._can.is_open and self._need_receive:
+            try:
+                count = self._read()
+            except RuntimeError as e:
+                logger.trace(e)
+                count = 0
+            if count > 0:
+                interval = self._min_poll_interval
+                continue
+            try:
+                received = self._can.wait_for_receive(self._receive_wait_time)
+            except RuntimeError as e:
+                logger.trace(e)
+                received = None
+            if received is None:
+                sleep(interval)
+                interval = min(interval * 2, self._max_poll_interval)
+            else:
+                interval = self._min_poll_interval
+
+    @staticmethod
+    def _get_dlc_length(dlc_code: int) -> int:
+        """
+        DLC转换成数据长度
 
-    def _get_dlc_length(self, dlc_length: int) -> int:
-        for key, value in self._dlc.items():
-            if dlc_length == value:
-                return key
-        raise RuntimeError(f"dlc {dlc} not support, only support {self._dlc.keys()}")
+        :param dlc_code: DLC，0~15
+
+        :return: 数据长度
+        """
+        try:
+            return dlc_length[dlc_code]
+        except KeyError:
+            raise RuntimeError(f"dlc {dlc_code} not support, only support {list(dlc_length.keys())}")
 
     def _handle_continue_frame(self, message: Message):
         """
@@ -180,11 +337,12 @@ class BaseCanBus(metaclass=ABCMeta):
         :return:
         """
 
-        # 当设置了才能返回
-        if self._response_id:
+        # 当设置了才能返回，由ISO-TP处理的响应ID会自己回复流控帧
+        if self._response_id and message.msg_id not in self._transports:
             # 这里只处理诊断数据，即7xx的信号
             if message.msg_id >> 8 == 7:
-                logger.trace(f"msg_id is {message.msg_id}")
+                if log_level.trace:
+                    logger.trace(f"msg_id is {message.msg_id}")
                 first_data = message.data[0]
                 if first_data == 0x10:
                     # 收到7xx的信号，且第一帧是10，表示是连续帧的首帧，需要回一个流控帧
@@ -194,7 +352,8 @@ class BaseCanBus(metaclass=ABCMeta):
                     msg.data = [0x30, 0x0, self._interval_time]
                     while len(msg.data) != size:
                         msg.data.append(0x0)
-                    logger.debug(f"it will send msg {msg.msg_id} and data = {[hex(x) for x in msg.data]}")
+                    lazy_logger.debug("it will send msg {} and data = {}", lambda: msg.msg_id,
+                                      lambda: hex_list(msg.data))
                     self.transmit_one(msg)
 
     def _open_can(self):
@@ -213,6 +372,30 @@ class BaseCanBus(metaclass=ABCMeta):
         self.random_flag = True
         # 打开设备，并初始化设备
         self._can.open_device(baud_rate=self._baud_rate, data_rate=self._data_rate, channel=self._channel_index)
+        # 重新开始监控接收周期
+        self._monitor.reset()
+        # 打开之前设置的接收滤波
+        self.__apply_receive_filter()
+        # 开启发送调度线程
+        if self._scheduler:
+            self._scheduler.start()
+
+    def __transmit_batch(self, messages: Sequence[Message]):
+        """
+        发送调度器中同一批到期的消息
+
+        :param messages: 消息列表
+        """
+        if not self._can.is_open or not self._need_transmit:
+            return
+        if log_level.debug:
+            logger.debug(f"send msg {[hex(x.msg_id) for x in messages]}")
+        try:
+            self._can.transmit_many(messages)
+            if self._recorder:
+                self._recorder.record_many(messages, True)
+        except RuntimeError as e:
+            logger.trace(f"some issue found, error is {e}")
 
     def __transmit(self, can: BaseCanDevice, message: Message, cycle_time: float):
         """
@@ -225,9 +408,12 @@ class BaseCanBus(metaclass=ABCMeta):
         logger.trace(f"cycle_time = {cycle_time}")
         msg_id = message.msg_id
         while can.is_open and not message.stop_flag and self._need_transmit:
-            logger.debug(f"send msg {hex(msg_id)} and cycle time is {message.cycle_time}")
+            if log_level.debug:
+                logger.debug(f"send msg {hex(msg_id)} and cycle time is {message.cycle_time}")
             try:
                 can.transmit(message)
+                if self._recorder:
+                    self._recorder.record(message, True)
             except RuntimeError as e:
                 logger.trace(f"some issue found, error is {e}")
             # 循环发送的等待周期
@@ -255,10 +441,13 @@ class BaseCanBus(metaclass=ABCMeta):
             cycle_time = message.cycle_time / 1000.0
             message.stop_flag = False
             # 周期性发送
-            logger.debug(f"****** Transmit [Cycle] {hex_msg_id} : {list(map(lambda x: hex(x), data))}"
+            logger.debug(f"****** Transmit [Cycle] {hex_msg_id} : {hex_list(data)}"
                          f"Circle time is {message.cycle_time}ms ******")
-            task = self._thread_pool.submit(self.__transmit, can, message, cycle_time)
-            self._transmit_thread.append(task)
+            if self._scheduler:
+                self._scheduler.add_cycle(message)
+            else:
+                task = self._thread_pool.submit(self.__transmit, can, message, cycle_time)
+                self._transmit_thread.append(task)
         else:
             # 周期事件信号，当周期信号发送的时候，只在变化data的时候会进行快速发送消息
             if message.msg_send_type == self._cycle_event:
@@ -282,8 +471,11 @@ class BaseCanBus(metaclass=ABCMeta):
                 self._event_send_messages[msg_id]) > 0:
             message = self._event_send_messages[msg_id].pop(0)
             can.transmit(message)
-            logger.debug(f"****** Transmit [Event] {msg_id} : {list(map(lambda x: hex(x), message.data))}"
-                         f"Event Cycle time [{message.cycle_time_fast}]")
+            if self._recorder:
+                self._recorder.record(message, True)
+            if log_level.debug:
+                logger.debug(f"****** Transmit [Event] {msg_id} : {hex_list(message.data)}"
+                             f"Event Cycle time [{message.cycle_time_fast}]")
             sleep(cycle_time)
 
     def __event(self, can: BaseCanDevice, message: Message):
@@ -296,6 +488,9 @@ class BaseCanBus(metaclass=ABCMeta):
         cycle_time = message.cycle_time_fast / 1000.0
         # 事件信号
         event_times = message.cycle_time_fast_times if message.cycle_time_fast_times > 0 else 1
+        if self._scheduler:
+            self._scheduler.add_event(message, event_times)
+            return
         # 构建消息列表
         messages = []
         for i in range(event_times):
@@ -311,235 +506,6 @@ class BaseCanBus(metaclass=ABCMeta):
             if self._event_thread[msg_id].done():
                 self._event_thread[msg_id] = self._thread_pool.submit(self.__event_transmit, can, msg_id, cycle_time)
 
-    def __get_response_frame(self, delay_78: int = 5):
-        """
-        接收返回帧
-        params delay_78: 遇到7F 78时，需要等待的时长。按照ISO 14229-2标准，等待5000ms
-        :return:
-        """
-        result = []
-        receive_flag = True
-        start_time = time.time()
-        logger.trace(f"timeout is {self._mutil_frame_time_out}")
-        real_timeout = self._mutil_frame_time_out
-        total_count = 1
-        while receive_flag:
-            logger.trace(f"第{total_count}次")
-            total_count += 1
-            delay_flag = False
-            stack = self.get_stack()
-            receive_messages = list(filter(lambda x: x.msg_id == self._response_id, stack))
-            message_size = len(receive_messages)
-            logger.trace(f"message size is {message_size}")
-            if message_size > 0:
-                message = receive_messages[0]
-                data = message.data
-                show_data = [hex(x) for x in data]
-                logger.trace(f"data is {show_data}")
-                if data[0] == 0x10:
-                    logger.trace(f"continue frame")
-                    length = data[1]
-                    logger.trace(f"length is {length}")
-                    # 获取连续帧还需要发多少帧
-                    frame_count = self.__get_frame_length(length)
-                    logger.trace(f"frame_count is {frame_count}")
-                    if real_timeout == self._mutil_frame_time_out:
-                        # 根据每帧之间的间隔时间计算出来需要多少, 单位是秒  10是buffer时间
-                        timeout = ((frame_count + 10) * self._interval_time * 1.2) / 1000
-                        real_timeout = timeout
-                        logger.debug(f"change timeout to {real_timeout}s")
-                    # 判断是否收集完成所有帧数据
-                    if self.__is_message_receive_finished(length, message_size):
-                        for index, message in enumerate(receive_messages):
-                            if index == 0:
-                                msg_data = message.data[2:]
-                            else:
-                                msg_data = message.data[1:]
-                            show_result = [hex(x) for x in result]
-                            logger.debug(f"result = {show_result}")
-                            result += msg_data
-                        result = result[: length]
-                        receive_flag = False
-                else:
-                    logger.debug(f"one frame")
-                    # 拿到一次receive，清一次栈（单帧处理方法）
-                    self.clear_stack_data()
-                    logger.trace(f"receive_messages: {list(map(lambda x: x.data, receive_messages))}")
-                    for message in receive_messages:
-                        msg_data = message.data
-                        logger.debug(f"msg_data is {msg_data}")
-                        result += msg_data
-                        if msg_data[0] >> 4 == 3:
-                            # 处理流控帧等待时间 30开头的报文，第二个字节是允许接收最大帧数，第三个字节是每帧间隔时间（ms）
-                            delay_time = ((msg_data[2] & 0xf) * msg_data[1] / 1000)
-                            # 据观察每一帧会比规定时间多1-2ms左右
-                            sleep(delay_time + ((msg_data[2] & 0xf) * 2) / 1000)
-                            logger.trace(f"遇到流控帧 需要等待{delay_time + ((msg_data[2] & 0xf) * 2) / 1000}ms")
-                            delay_flag = True
-                            break
-
-                        if msg_data[1] == 0x7f and msg_data[3] == 0x78:
-                            # 负响应超时处理
-                            logger.trace(f"遇到78, 等待 {delay_78}s")
-                            sleep(delay_78)
-                            delay_flag = True
-                            break
-
-                        logger.debug(f"result = {result}")
-
-            logger.trace(f"是否收到78： {delay_flag}")
-            if not delay_flag:
-                current_time = time.time()
-                pass_time = current_time - start_time
-                logger.trace(f"pass_time is {pass_time}")
-                if pass_time > real_timeout:
-                    logger.debug(f"timeout exit , the pass time is {pass_time}")
-                    receive_flag = False
-        return result
-
-    def __get_frame_length(self, length: int) -> int:
-        """
-        根据第一帧检查需要收的帧数
-        :param length: 数据的长度
-        :return:
-        """
-        message_length = 64 if self._is_uds_can_fd else 8
-        # 先把第一帧数据去掉
-        length = length - (message_length - 2)
-        size = length // (message_length - 1)
-        left = length % (message_length - 1)
-        logger.trace(f"length = {length}")
-        logger.trace(f"size = {size}")
-        logger.trace(f"left = {left}")
-        if left == 0:
-            size = size
-        else:
-            size = size + 1
-        logger.trace(f"size is {size}")
-        return size
-
-    def __is_message_receive_finished(self, length: int, message_size: int) -> bool:
-        """
-        根据第一帧检查是否已经接收完成
-        :param length: 数据的长度
-        :param message_size:  目前收到的帧数
-        :return:
-        """
-        size = self.__get_frame_length(length) + 1
-        logger.trace(f"size is {size} and message_size is {message_size}")
-        return size == message_size
-
-    def __send_multi_frame(self, send_messages: List[Message]):
-        """
-        发多帧
-        :param send_messages:
-        :return:
-        """
-        if len(send_messages) > 4095:
-            raise RuntimeError("报文字节长度超出最大范围4095")
-
-        # 清空接收数据，并发送发送第一帧，等待流控帧
-        self.clear_stack_data()
-        messages = copy.deepcopy(send_messages)
-        messages_length = len(messages)
-        logger.debug(f"messages size is {messages_length}")
-        message = messages.pop(0)
-        logger.debug(f"first frame message is {message}")
-        if messages_length == 1:
-            self.transmit_one(message)
-        else:
-            self.transmit_one(message)
-            send_time = -1
-            wait_flag = True
-            start_time = time.time()
-            while wait_flag:
-                stack = self.get_stack()
-                receive_messages = list(filter(lambda x: x.msg_id == self._response_id, stack))
-                if len(receive_messages) > 0:
-                    for message in receive_messages:
-                        # 14.054030 CANFD   1 Rx 70E  1  0  8 8 30 08 05 00 00 00 00 00    0  0   1000 0 0 0 0 0
-                        data = message.data
-                        if data[0] == 0x30:
-                            send_time = data[2]
-                            # 收到了流控帧，就需要处理,否则解析出来的数据可能有问题
-                            self.clear_stack_data()
-                            wait_flag = False
-                current_time = time.time()
-                pass_time = current_time - start_time
-                if pass_time > self._flow_control_time_out:
-                    wait_flag = False
-            logger.debug(f"send_time is {send_time}")
-            # 没有收到流控帧
-            if send_time != -1:
-                interval_time = send_time / 1000
-                for message in messages:
-                    data = [hex(x) for x in message.data]
-                    logger.debug(f"send message [{hex(message.msg_id)}] and data is [{data}]")
-                    self.transmit_one(message)
-                    sleep(interval_time)
-            else:
-                raise RuntimeError("can not receive flow control frame, not send message")
-
-    def __get_message_data(self, message_data: List[int]) -> List[Message]:
-        """
-        根据数据长度组包，方便后期发送
-        :param message_data: 数据列表
-        :return: 二维数组，数组中的每一个值表示一个message中的data
-        """
-        messages = []
-        message_datus = []
-        message = copy.deepcopy(message_data)
-        length = len(message)
-        size = 64 if self._is_uds_can_fd else 8
-        if length < size:
-            msg_data = copy.deepcopy(message)
-            msg_data.insert(0, length)
-            while len(msg_data) != size:
-                msg_data.append(0x0)
-            msg = Message()
-            msg.msg_id = self._request_id
-            msg.data = msg_data
-            messages.append(msg)
-        else:
-            # 这一步处理当数据超过3位的时候
-            length_value = hex(length)[2:]
-            if len(length_value) > 3:
-                value = f"1{length_value}"
-                first_frame = list(int(value, 16).to_bytes(64, "big"))
-            else:
-                first_frame = [0x10, length]
-            while len(first_frame) != size:
-                data = message.pop(0)
-                logger.trace(f"data = {data}")
-                first_frame.append(data)
-            message_datus.append(first_frame)
-            continue_frame = [0x21]
-            # CAN FD的方式组包
-            while len(message) != 0:
-                data = message.pop(0)
-                logger.trace(f"data = {data}")
-                if len(continue_frame) != size:
-                    continue_frame.append(data)
-                else:
-                    # 列表复用，所以需要深拷贝
-                    message_datus.append(copy.deepcopy(continue_frame))
-                    frame = continue_frame[0] + 1
-                    continue_frame.clear()
-                    continue_frame.append(frame)
-                    continue_frame.append(data)
-            # 追加尾部数据
-            if len(continue_frame) != 0:
-                while len(continue_frame) != size:
-                    continue_frame.append(0xAA)
-                message_datus.append(copy.deepcopy(continue_frame))
-            for msg in message_datus:
-                message = Message()
-                message.msg_id = self._request_id
-                message.data = msg
-                messages.append(message)
-        logger.debug(f"message is [{messages}]")
-        return messages
-
     @abstractmethod
     def open_can(self):
         """
@@ -552,6 +518,9 @@ class BaseCanBus(metaclass=ABCMeta):
             关闭USB CAN设备。
         """
         self._need_transmit = False
+        if self._scheduler:
+            logger.trace("stop transmit scheduler")
+            self._scheduler.stop()
         logger.trace("wait _transmit_thread close")
         wait(self._transmit_thread, return_when=ALL_COMPLETED)
         self._need_receive = False
@@ -563,12 +532,14 @@ class BaseCanBus(metaclass=ABCMeta):
         # 开启随机信号的标识符
         self.random_flag = False
         wait(self._random_thread, return_when=ALL_COMPLETED)
-        if self._thread_pool:
-            logger.info("shutdown thread pool")
-            self._thread_pool.shutdown()
         logger.trace("_send_messages clear")
         self._send_messages.clear()
-        self._thread_pool = None
+        # 多通道会话中的线程池是共用的，由会话关闭
+        if self._thread_pool and not self._in_session:
+            logger.info("shutdown thread pool")
+            self._thread_pool.shutdown()
+            self._thread_pool = None
+        self.stop_record()
         logger.trace("close_device")
         logger.trace(f"The thread pool id is {id(self._thread_pool)}")
         self._can.close_device()
@@ -603,6 +574,19 @@ class BaseCanBus(metaclass=ABCMeta):
         :param message: message对象
         """
         self._can.transmit(message)
+        if self._recorder:
+            self._recorder.record(message, True)
+
+    @check_connect("_can", can_tips, is_bus=True)
+    def transmit_many(self, messages: Sequence[Message]):
+        """
+        一次发送多帧CAN消息
+
+        :param messages: message对象列表
+        """
+        self._can.transmit_many(messages)
+        if self._recorder:
+            self._recorder.record_many(messages, True)
 
     @check_connect("_can", can_tips, is_bus=True)
     def stop_transmit(self, message_id: int):
@@ -675,8 +659,23 @@ class BaseCanBus(metaclass=ABCMeta):
     def get_stack(self) -> Sequence[Message]:
         """
         获取CAN的stack
+
+        :return: 栈的只读视图，只包含调用时已经收到的消息
+        """
+        return self._stack.view()
+
+    @check_connect("_can", can_tips, is_bus=True)
+    def get_stack_by_id(self, msg_id: int, since: Optional[Number] = None) -> List[Message]:
         """
-        return self._stack
+        获取栈中某个msg id的消息
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :return: 按照接收顺序排列的消息
+        """
+        return self._stack.get_messages(msg_id, since)
 
     @check_connect("_can", can_tips, is_bus=True)
     def clear_stack_data(self):
@@ -685,6 +684,232 @@ class BaseCanBus(metaclass=ABCMeta):
         """
         self._stack.clear()
 
+    def subscribe(self, msg_id: Optional[int] = None, callback: Optional[Callable[[Message], None]] = None,
+                  mask: Optional[int] = None, predicate: Optional[Callable[[Message], bool]] = None,
+                  queue_size: int = 1000, edge: bool = False) -> Subscription:
+        """
+        订阅接收到的帧，回调函数在接收线程中执行，不传回调函数的时候通过返回的Subscription.get等待
+
+        :param msg_id: 订阅的msg id，为None的时候订阅所有的帧
+
+        :param callback: 回调函数，参数是收到的Message
+
+        :param mask: ID掩码，(收到的ID & mask) == (msg_id & mask)的时候匹配，默认需要ID相同
+
+        :param predicate: 帧的条件，返回True的时候才通知
+
+        :param queue_size: 队列的最大长度，满了以后丢弃最早的帧
+
+        :param edge: 为True的时候只在predicate从False变成True的时候通知一次
+
+        :return: Subscription，调用cancel取消订阅
+        """
+        subscription = Subscription(msg_id, mask, predicate, callback, queue_size, edge)
+        return self._dispatcher.subscribe(subscription)
+
+    def unsubscribe(self, subscription: Optional[Subscription] = None):
+        """
+        取消订阅
+
+        :param subscription: 订阅，为None的时候取消所有订阅
+        """
+        if subscription is None:
+            self._dispatcher.clear()
+        else:
+            self._dispatcher.unsubscribe(subscription)
+
+    def wait_for_message(self, msg_id: Optional[int] = None, timeout: float = 5, mask: Optional[int] = None,
+                         predicate: Optional[Callable[[Message], bool]] = None) -> WaitResult:
+        """
+        等待调用之后收到的第一帧满足条件的消息，收到以后立即返回
+
+        :param msg_id: msg id，为None的时候等待任意一帧
+
+        :param timeout: 超时时间，单位秒
+
+        :param mask: ID掩码，参考subscribe
+
+        :param predicate: 帧的条件
+
+        :return: WaitResult(是否收到, 收到的帧, 从调用到收到的时间)
+        """
+        event = Event()
+        received = []
+
+        def on_message(message: Message):
+            if not received:
+                received.append((perf_counter(), message))
+                event.set()
+
+        start_time = perf_counter()
+        subscription = self.subscribe(msg_id, on_message, mask, predicate)
+        try:
+            event.wait(timeout)
+        finally:
+            subscription.cancel()
+        if received:
+            receive_time, message = received[0]
+            return WaitResult(True, message, receive_time - start_time)
+        return WaitResult(False, None, perf_counter() - start_time)
+
+    def wait_for_silence(self, msg_id: Optional[int] = None, duration: float = 1, timeout: float = 10,
+                         mask: Optional[int] = None) -> WaitResult:
+        """
+        等待某个msg id(为None的时候是整个总线)连续duration秒没有收到消息
+
+        :param msg_id: msg id，为None的时候是任意帧
+
+        :param duration: 需要持续静默的时间，单位秒
+
+        :param timeout: 超时时间，单位秒，不能小于duration
+
+        :param mask: ID掩码，参考subscribe
+
+        :return: WaitResult(是否静默, 最后收到的帧, 从调用到开始静默的时间)
+        """
+        if timeout < duration:
+            raise ValueError(f"timeout[{timeout}] must >= duration[{duration}]")
+        start_time = perf_counter()
+        # 最后一帧的时间和消息
+        last = [start_time, None]
+
+        def on_message(message: Message):
+            last[0] = perf_counter()
+            last[1] = message
+
+        subscription = self.subscribe(msg_id, on_message, mask)
+        try:
+            while True:
+                last_time, message = last
+                now = perf_counter()
+                if now - last_time >= duration:
+                    return WaitResult(True, message, last_time - start_time)
+                if now - start_time >= timeout:
+                    return WaitResult(False, message, now - start_time)
+                # 收到新的帧以后静默的时间会推后，醒来以后重新计算
+                sleep(min(last_time + duration, start_time + timeout) - now)
+        finally:
+            subscription.cancel()
+
+    def start_record(self, file: str, flush_interval: float = 0.1, append: bool = False) -> CanRecorder:
+        """
+        开始把收发的帧录制到二进制日志文件中，录制的文件可以通过CanLog读取，也可以直接用于回放和信号分析
+
+        :param file: 日志文件
+
+        :param flush_interval: 批量写入文件的间隔，单位秒
+
+        :param append: 文件已经存在的时候是否追加，默认覆盖
+
+        :return: 录制器
+        """
+        self.stop_record()
+        recorder = CanRecorder(file, flush_interval, append)
+        recorder.start()
+        self._recorder = recorder
+        return recorder
+
+    def stop_record(self) -> Optional[str]:
+        """
+        停止录制
+
+        :return: 日志文件，没有录制的时候返回None
+        """
+        recorder = self._recorder
+        if recorder is None:
+            return None
+        self._recorder = None
+        recorder.stop()
+        return recorder.file
+
+    def get_jitter_statistics(self, msg_id: Optional[int] = None) -> Dict[int, JitterStatistics]:
+        """
+        获取周期信号的抖动统计(仅use_scheduler为True时可用)
+
+        :param msg_id: msg id，默认获取所有
+
+        :return: 其中key是msg id，value是实际发送间隔和周期之间的误差统计，单位毫秒
+        """
+        if self._scheduler is None:
+            raise RuntimeError("jitter statistics only support when use_scheduler is True")
+        return self._scheduler.get_jitter(msg_id)
+
+    def set_cycle_times(self, cycle_times: Dict[int, int]):
+        """
+        设置接收周期监控使用的周期
+
+        :param cycle_times: 其中key是msg id，value是周期，单位毫秒
+        """
+        self._monitor.set_cycle_times(cycle_times)
+
+    def get_cycle_statistics(self, msg_id: Optional[int] = None) -> Dict[int, CycleStatistics]:
+        """
+        获取接收周期统计的快照，接收线程中增量计算，不需要遍历栈
+
+        :param msg_id: msg id，默认获取所有收到过的
+
+        :return: 其中key是msg id，value是CycleStatistics，周期相关的单位是毫秒
+        """
+        return self._monitor.get_statistics(msg_id)
+
+    def __apply_receive_filter(self):
+        """
+        设备已经打开的时候设置硬件滤波，设置失败的时候只使用软件滤波
+        """
+        receive_filter = self._receive_filter
+        if receive_filter is None or not self._can.is_open:
+            return
+        try:
+            receive_filter.hardware = self._can.set_receive_filter(receive_filter.get_ranges())
+        except RuntimeError as e:
+            logger.error(f"set hardware receive filter failed, only use software filter, error is {e}")
+            receive_filter.hardware = False
+
+    def set_receive_filter(self, ids: Optional[Sequence[int]] = None,
+                           ranges: Optional[Sequence[Tuple[int, int]]] = None,
+                           masks: Optional[Sequence[Tuple[int, int]]] = None) -> ReceiveFilter:
+        """
+        设置接收滤波，只接收满足任意一个条件的帧，被过滤的帧不会构造Message，也不会进入栈、周期监控、订阅和诊断的处理
+
+        设备支持的时候同时设置硬件验收滤波(PCAN、周立功)，否则只在接收线程中通过ID位图过滤，
+
+        使用诊断的时候需要包含诊断的响应ID
+
+        :param ids: 接收的ID
+
+        :param ranges: 接收的ID范围，(起始ID, 结束ID)，包含两端
+
+        :param masks: (code, mask)，(ID & mask) == (code & mask)的时候接收
+
+        :return: ReceiveFilter
+        """
+        receive_filter = ReceiveFilter(ids, ranges, masks)
+        self._receive_filter = receive_filter
+        self.__apply_receive_filter()
+        logger.debug(f"set receive filter, hardware filter is {receive_filter.hardware}")
+        return receive_filter
+
+    def clear_receive_filter(self):
+        """
+        取消接收滤波，接收所有的帧
+        """
+        receive_filter = self._receive_filter
+        self._receive_filter = None
+        if receive_filter and receive_filter.hardware and self._can.is_open:
+            try:
+                self._can.set_receive_filter([])
+            except RuntimeError as e:
+                logger.error(f"clear hardware receive filter failed, error is {e}")
+
+    def get_receive_filter_statistics(self) -> Optional[FilterStatistics]:
+        """
+        获取接收滤波的统计
+
+        :return: FilterStatistics(接收的帧数, 过滤掉的帧数, 是否设置了硬件滤波)，没有设置滤波的时候返回None
+        """
+        receive_filter = self._receive_filter
+        return receive_filter.get_statistics() if receive_filter else None
+
     def init_uds(self, request_id: int, response_id: int, function_id: int):
         """
         初始化USD（仅同星可用)
@@ -695,23 +920,62 @@ class BaseCanBus(metaclass=ABCMeta):
         self._request_id = request_id
         self._response_id = response_id
         self._function_id = function_id
+        self.get_transport(request_id, response_id)
+
+    def get_transport(self, request_id: int, response_id: int, **kwargs) -> IsoTpTransport:
+        """
+        获取一对诊断ID上的ISO-TP收发，同一个响应ID只会有一个transport
+
+        :param request_id: 请求ID
+
+        :param response_id: 响应ID
+
+        :param kwargs: IsoTpTransport的其他参数，默认使用当前CAN总线的设置
+
+        :return: IsoTpTransport
+        """
+        transport = self._transports.get(response_id)
+        if transport is None or transport.request_id != request_id or kwargs:
+            params = {"can_fd": self._is_uds_can_fd, "st_min": self._interval_time,
+                      "p2": self._mutil_frame_time_out, "flow_control_time_out": self._flow_control_time_out}
+            params.update(kwargs)
+            transport = IsoTpTransport(self.transmit_one, self.transmit_many, request_id, response_id, **params)
+            self._transports[response_id] = transport
+        return transport
+
+    def remove_transport(self, response_id: int):
+        """
+        移除响应ID上的ISO-TP收发
+
+        :param response_id: 响应ID
+        """
+        self._transports.pop(response_id, None)
 
     def send_and_receive_uds_message(self, message: List[int]) -> List[int]:
         """
         发送UDS诊断消息, 两种情况，没有init的UDS的时候，返回空列表，还有就是本身不返回
-        :param message:
-        :return:
+
+        只需要响应数据的时候使用get_transport获取的IsoTpTransport
+        :param message: 请求数据
+        :return: 单帧响应返回收到的整帧数据(包含PCI和填充字节)，多帧响应返回不包含PCI的数据
         """
         if self._request_id and self._response_id and self._function_id:
             receive_message = []
-            message_data = self.__get_message_data(message)
-            logger.debug(f"message_data length is {len(message_data)}")
             try:
-                self.__send_multi_frame(message_data)
-                logger.debug(f"now get response data")
-                receive_message = self.__get_response_frame()
+                transport = self.get_transport(self._request_id, self._response_id)
+                receive_message = transport.request(message, single_frame=True)
             except RuntimeError as e:
                 logger.error(e)
             return receive_message
         else:
             raise RuntimeError("please use function init_uds to init uds")
+
+    def get_uds_latency_statistics(self) -> LatencyStatistics:
+        """
+        获取send_and_receive_uds_message的往返时间统计
+
+        :return: LatencyStatistics，单位毫秒
+        """
+        if not self._response_id or self._response_id not in self._transports:
+            raise RuntimeError("please use function init_uds to init uds")
+        return self._transports[self._response_id].get_latency_statistics()
@@ -0,0 +1,440 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        isotp.py
+# @Author:      lizhe
+# @Created:     2023/4/2 - 10:25
+# --------------------------------------------------------
+import asyncio
+from collections import deque, namedtuple
+from threading import Condition, Lock
+from time import perf_counter, sleep
+from typing import Callable, Sequence, List, Optional, Generator, Tuple, Deque
+
+import numpy as np
+
+from automotive.logger.logger import logger
+from ..message import Message
+
+"""
+ISO 15765-2(ISO-TP)传输层
+
+每个IsoTpTransport对应一对(request_id, response_id)，接收线程收到response_id的帧以后通过feed放到transport自己的队列中，
+
+收发过程不再读取和清空CAN总线的栈，支持:
+
+1、单帧、首帧、连续帧、流控帧，以及CANFD的长单帧和超过4095字节的首帧(escape sequence)
+
+2、发送时遵守对端流控帧的BS(block size)和STmin，支持WAIT状态，收到OVFLW时报错
+
+3、接收时检查连续帧的SN(sequence number)，按照自己的BS回复流控帧
+
+4、收到7F xx 78(response pending)的时候继续等待，超时时间从P2变为P2*，不属于本次请求的服务的响应直接丢弃
+
+协议的处理写成生成器，由同步的request和asyncio的request_async分别驱动，两者的行为完全一致。
+"""
+
+# 等待一帧数据，值为超时时间(秒)
+_WAIT = 0
+# 等待一段时间，值为时间(秒)
+_SLEEP = 1
+# 流控帧的状态
+_CONTINUE_TO_SEND = 0
+_WAIT_FLOW_CONTROL = 1
+_OVERFLOW = 2
+# 首帧中12位长度能表示的最大值
+_max_first_frame_length = 0xFFF
+
+# 往返时间的统计结果，单位毫秒
+LatencyStatistics = namedtuple("LatencyStatistics", ["count", "mean", "min", "max", "p50", "p90", "p99"])
+
+# 协议处理的生成器，yield (_WAIT/_SLEEP, 秒)，_WAIT的时候send回收到的数据(超时为None)
+Steps = Generator[Tuple[int, float], Optional[List[int]], Optional[List[int]]]
+
+
+def _set_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class IsoTpTransport(object):
+    """
+    一对诊断ID上的ISO-TP收发
+    """
+
+    def __init__(self, transmit_one: Callable[[Message], None], transmit_many: Callable[[Sequence[Message]], None],
+                 request_id: int, response_id: int, can_fd: bool = False, padding: int = 0x00, block_size: int = 0,
+                 st_min: int = 0, p2: float = 0.1, p2_star: float = 5, flow_control_time_out: float = 1,
+                 continue_frame_time_out: float = 1, max_wait_frame: int = 10, latency_size: int = 1000):
+        """
+        :param transmit_one: 发送单帧的函数
+
+        :param transmit_many: 一次发送多帧的函数
+
+        :param request_id: 请求ID
+
+        :param response_id: 响应ID
+
+        :param can_fd: 是否CANFD，决定每帧的长度
+
+        :param padding: 填充字节
+
+        :param block_size: 接收多帧时回复的流控帧中的BS，0表示不限制
+
+        :param st_min: 接收多帧时回复的流控帧中的STmin，单位毫秒
+
+        :param p2: 等待响应的超时时间，单位秒
+
+        :param p2_star: 收到78以后等待响应的超时时间，单位秒
+
+        :param flow_control_time_out: 发送首帧后等待流控帧的超时时间(N_Bs)，单位秒
+
+        :param continue_frame_time_out: 等待连续帧的超时时间(N_Cr)，单位秒
+
+        :param max_wait_frame: 最多允许收到多少个WAIT状态的流控帧
+
+        :param latency_size: 保存最近多少次往返时间
+        """
+        self.__transmit_one = transmit_one
+        self.__transmit_many = transmit_many
+        self.__request_id = request_id
+        self.__response_id = response_id
+        self.__size = 64 if can_fd else 8
+        self.__padding = padding
+        self.__block_size = block_size
+        self.__st_min = st_min
+        self.__p2 = p2
+        self.__p2_star = p2_star
+        self.__flow_control_time_out = flow_control_time_out
+        self.__continue_frame_time_out = continue_frame_time_out
+        self.__max_wait_frame = max_wait_frame
+        # 收到的数据
+        self.__frames = deque()  # type: Deque[List[int]]
+        self.__condition = Condition()
+        # asyncio中等待数据的(loop, future)
+        self.__waiter = None
+        # 同步请求的锁，同一时间只能有一个请求
+        self.__lock = Lock()
+        # 最近的往返时间，单位毫秒
+        self.__latencies = deque(maxlen=latency_size)  # type: Deque[float]
+        # 最近一次接收的响应是单帧的时候，收到的整帧数据(包含PCI和填充字节)，多帧的时候为None
+        self.__single_frame = None  # type: Optional[List[int]]
+
+    @property
+    def request_id(self) -> int:
+        return self.__request_id
+
+    @property
+    def response_id(self) -> int:
+        return self.__response_id
+
+    @property
+    def latencies(self) -> List[float]:
+        """
+        最近的往返时间，单位毫秒
+        """
+        return list(self.__latencies)
+
+    def feed(self, message: Message):
+        """
+        放入收到的一帧数据，由接收线程调用
+
+        :param message: 收到的消息
+        """
+        if message.msg_id != self.__response_id or len(message.data) == 0:
+            return
+        with self.__condition:
+            self.__frames.append(list(message.data))
+            self.__condition.notify()
+            waiter, self.__waiter = self.__waiter, None
+        if waiter:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_set_future, future)
+
+    def clear(self):
+        """
+        清空还没有处理的数据
+        """
+        with self.__condition:
+            self.__frames.clear()
+
+    def get_latency_statistics(self) -> LatencyStatistics:
+        """
+        统计最近的往返时间
+
+        :return: LatencyStatistics，单位毫秒
+        """
+        if len(self.__latencies) == 0:
+            return LatencyStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        values = np.asarray(self.__latencies, dtype=np.float64)
+        p50, p90, p99 = np.percentile(values, (50, 90, 99))
+        return LatencyStatistics(len(values), float(values.mean()), float(values.min()), float(values.max()),
+                                 float(p50), float(p90), float(p99))
+
+    def __get(self, timeout: float) -> Optional[List[int]]:
+        with self.__condition:
+            if not self.__frames:
+                self.__condition.wait_for(lambda: len(self.__frames) > 0, timeout)
+            return self.__frames.popleft() if self.__frames else None
+
+    async def __get_async(self, timeout: float) -> Optional[List[int]]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.__condition:
+                if self.__frames:
+                    return self.__frames.popleft()
+                future = loop.create_future()
+                self.__waiter = loop, future
+            remain = deadline - loop.time()
+            if remain <= 0:
+                return None
+            try:
+                await asyncio.wait_for(future, remain)
+            except asyncio.TimeoutError:
+                with self.__condition:
+                    self.__waiter = None
+                    return self.__frames.popleft() if self.__frames else None
+
+    def __run(self, steps: Steps) -> Optional[List[int]]:
+        """
+        同步驱动协议处理
+        """
+        try:
+            step, value = next(steps)
+            while True:
+                if step == _WAIT:
+                    step, value = steps.send(self.__get(value))
+                else:
+                    sleep(value)
+                    step, value = steps.send(None)
+        except StopIteration as e:
+            return e.value
+
+    async def __run_async(self, steps: Steps) -> Optional[List[int]]:
+        """
+        asyncio驱动协议处理
+        """
+        try:
+            step, value = next(steps)
+            while True:
+                if step == _WAIT:
+                    step, value = steps.send(await self.__get_async(value))
+                else:
+                    await asyncio.sleep(value)
+                    step, value = steps.send(None)
+        except StopIteration as e:
+            return e.value
+
+    def __get_message(self, data: List[int]) -> Message:
+        message = Message()
+        message.msg_id = self.__request_id
+        message.data = data + [self.__padding] * (self.__size - len(data))
+        message.data_length = self.__size
+        return message
+
+    def __segment(self, payload: Sequence[int]) -> List[Message]:
+        """
+        把数据拆分成单帧或者首帧加连续帧
+        """
+        payload = list(payload)
+        length = len(payload)
+        if length <= 7:
+            return [self.__get_message([length] + payload)]
+        if self.__size > 8 and length <= self.__size - 2:
+            # CANFD的长单帧
+            return [self.__get_message([0x00, length] + payload)]
+        if length > 0xFFFFFFFF:
+            raise RuntimeError(f"payload length {length} is too long")
+        if length > _max_first_frame_length:
+            first_frame = [0x10, 0x00] + list(length.to_bytes(4, "big"))
+        else:
+            first_frame = [0x10 | (length >> 8), length & 0xFF]
+        index = self.__size - len(first_frame)
+        messages = [self.__get_message(first_frame + payload[:index])]
+        sequence = 1
+        while index < length:
+            messages.append(self.__get_message([0x20 | (sequence & 0x0F)] + payload[index:index + self.__size - 1]))
+            index += self.__size - 1
+            sequence += 1
+        return messages
+
+    @staticmethod
+    def __get_st_min(value: int) -> float:
+        """
+        把流控帧中的STmin转换成秒，0xF1-0xF9表示100-900微秒，保留值按照127毫秒处理
+        """
+        if value <= 0x7F:
+            return value / 1000
+        if 0xF1 <= value <= 0xF9:
+            return (value - 0xF0) / 10000
+        return 0.127
+
+    def __wait_flow_control(self) -> Steps:
+        wait_count = 0
+        while True:
+            data = yield _WAIT, self.__flow_control_time_out
+            if data is None:
+                raise RuntimeError(f"can not receive flow control frame from {hex(self.__response_id)}")
+            if data[0] >> 4 != 3:
+                logger.debug(f"ignore frame {[hex(x) for x in data]} when wait flow control frame")
+                continue
+            status = data[0] & 0x0F
+            if status == _CONTINUE_TO_SEND:
+                return data[1], self.__get_st_min(data[2])
+            elif status == _WAIT_FLOW_CONTROL:
+                wait_count += 1
+                if wait_count > self.__max_wait_frame:
+                    raise RuntimeError(f"receive more than {self.__max_wait_frame} wait flow control frames")
+            elif status == _OVERFLOW:
+                raise RuntimeError(f"{hex(self.__response_id)} overflow, payload is too long")
+            else:
+                raise RuntimeError(f"unknown flow control status {status}")
+
+    def __send_steps(self, payload: Sequence[int]) -> Steps:
+        messages = self.__segment(payload)
+        self.__transmit_one(messages[0])
+        index = 1
+        while index < len(messages):
+            block_size, st_min = yield from self.__wait_flow_control()
+            end = len(messages) if block_size == 0 else min(index + block_size, len(messages))
+            logger.debug(f"send continue frames [{index}, {end}), block size is {block_size}, st_min is {st_min}s")
+            if st_min == 0:
+                self.__transmit_many(messages[index:end])
+            else:
+                for position in range(index, end):
+                    self.__transmit_one(messages[position])
+                    if position != end - 1:
+                        yield _SLEEP, st_min
+            index = end
+
+    def __transmit_flow_control(self):
+        self.__transmit_one(self.__get_message([0x30 | _CONTINUE_TO_SEND, self.__block_size, self.__st_min]))
+
+    def __receive_steps(self, timeout: float) -> Steps:
+        while True:
+            data = yield _WAIT, timeout
+            if data is None:
+                raise RuntimeError(f"receive response from {hex(self.__response_id)} timeout")
+            frame_type = data[0] >> 4
+            if frame_type == 0:
+                length, start = data[0] & 0x0F, 1
+                if length == 0 and len(data) > 8:
+                    # CANFD的长单帧
+                    length, start = data[1], 2
+                if length == 0 or start + length > len(data):
+                    logger.debug(f"ignore invalid single frame {[hex(x) for x in data]}")
+                    continue
+                self.__single_frame = data
+                return data[start:start + length]
+            elif frame_type == 1:
+                length, start = ((data[0] & 0x0F) << 8) | data[1], 2
+                if length == 0:
+                    length, start = int.from_bytes(bytes(data[2:6]), "big"), 6
+                payload = data[start:]
+                self.__single_frame = None
+                self.__transmit_flow_control()
+                sequence = 1
+                block_count = 0
+                while len(payload) < length:
+                    data = yield _WAIT, self.__continue_frame_time_out
+                    if data is None:
+                        raise RuntimeError(f"receive continue frame from {hex(self.__response_id)} timeout")
+                    if data[0] >> 4 != 2:
+                        logger.debug(f"ignore frame {[hex(x) for x in data]} when wait continue frame")
+                        continue
+                    if data[0] & 0x0F != sequence & 0x0F:
+                        raise RuntimeError(f"sequence number should be {sequence & 0x0F}, but now is {data[0] & 0x0F}")
+                    sequence += 1
+                    payload += data[1:]
+                    block_count += 1
+                    if self.__block_size and block_count == self.__block_size and len(payload) < length:
+                        block_count = 0
+                        self.__transmit_flow_control()
+                return payload[:length]
+            else:
+                logger.debug(f"ignore frame {[hex(x) for x in data]} when wait response")
+
+    def __request_steps(self, payload: Sequence[int]) -> Steps:
+        start_time = perf_counter()
+        # 之前残留的数据不属于本次请求
+        self.clear()
+        yield from self.__send_steps(payload)
+        timeout = self.__p2
+        while True:
+            response = yield from self.__receive_steps(timeout)
+            if response[0] == 0x7F:
+                if len(response) < 3 or response[1] != payload[0]:
+                    logger.debug(f"ignore negative response {[hex(x) for x in response]} of other service")
+                    continue
+                if response[2] == 0x78:
+                    logger.debug(f"receive response pending, wait {self.__p2_star}s")
+                    timeout = self.__p2_star
+                    continue
+            elif response[0] != (payload[0] + 0x40) & 0xFF:
+                # 比如之前3E 80的响应，不属于本次请求
+                logger.debug(f"ignore response {[hex(x) for x in response]} of other service")
+                continue
+            latency = (perf_counter() - start_time) * 1000
+            self.__latencies.append(latency)
+            logger.debug(f"{hex(self.__request_id)} round trip time is {latency:.3f}ms")
+            return response
+
+    def send(self, payload: Sequence[int]):
+        """
+        发送数据，多帧的时候会等待对端的流控帧
+
+        :param payload: 数据
+        """
+        with self.__lock:
+            self.__run(self.__send_steps(payload))
+
+    def receive(self, timeout: Optional[float] = None) -> List[int]:
+        """
+        接收一次完整的数据，首帧会自动回复流控帧
+
+        :param timeout: 等待单帧或首帧的超时时间，默认为P2
+
+        :return: 数据
+        """
+        with self.__lock:
+            return self.__run(self.__receive_steps(self.__p2 if timeout is None else timeout))
+
+    def request(self, payload: Sequence[int], single_frame: bool = False) -> List[int]:
+        """
+        发送请求并等待响应，收到78的时候继续等待
+
+        :param payload: 请求数据
+
+        :param single_frame: 为True的时候，单帧的响应返回收到的整帧数据(包含PCI和填充字节)
+
+        :return: 响应数据(不包含PCI和填充字节)
+        """
+        if len(payload) == 0:
+            raise ValueError("payload is empty")
+        with self.__lock:
+            response = self.__run(self.__request_steps(payload))
+            if single_frame and self.__single_frame is not None:
+                return self.__single_frame
+            return response
+
+    async def send_async(self, payload: Sequence[int]):
+        """
+        send的asyncio版本，同一个transport同一时间只能有一个请求
+        """
+        await self.__run_async(self.__send_steps(payload))
+
+    async def receive_async(self, timeout: Optional[float] = None) -> List[int]:
+        """
+        receive的asyncio版本，同一个transport同一时间只能有一个请求
+        """
+        return await self.__run_async(self.__receive_steps(self.__p2 if timeout is None else timeout))
+
+    async def request_async(self, payload: Sequence[int]) -> List[int]:
+        """
+        request的asyncio版本，同一个transport同一时间只能有一个请求
+        """
+        if len(payload) == 0:
+            raise ValueError("payload is empty")
+        return await self.__run_async(self.__request_steps(payload))
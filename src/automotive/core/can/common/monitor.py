@@ -0,0 +1,199 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        monitor.py
+# @Author:      lizhe
+# @Created:     2023/4/12 - 21:16
+# --------------------------------------------------------
+from collections import deque, namedtuple
+from time import time, perf_counter
+from typing import Dict, Optional, List, Deque
+
+import numpy as np
+
+from ..message import Message
+
+"""
+接收周期监控
+
+CycleMonitor在接收线程中随每一帧增量更新每个msg id的接收间隔统计，不需要遍历栈，
+
+最小值、最大值、平均值和丢失的周期数是累计的，p99只根据最近window个间隔在获取统计的时候计算。
+
+设置了周期(DBC中的GenMsgCycleTime)的msg id，间隔超过周期的tolerance倍时，按照间隔计算丢失的周期数。
+
+时间统一使用perf_counter，不受系统时间调整的影响，也不依赖各个CAN盒上报的时间戳格式。
+"""
+
+# 接收周期统计，周期相关的单位是毫秒，last_seen是最后收到的系统时间(秒)，silent_time是距离最后一次收到的时间(毫秒)
+CycleStatistics = namedtuple("CycleStatistics", ["count", "cycle_time", "mean", "min", "max", "p99", "missed",
+                                                 "last_seen", "silent_time"])
+
+
+class _Cycle(object):
+    """
+    一个msg id的接收间隔统计
+    """
+
+    __slots__ = ("cycle_time", "last", "count", "total", "min", "max", "missed", "periods")
+
+    def __init__(self, cycle_time: int, window: int):
+        # 周期，单位毫秒，0表示不知道周期
+        self.cycle_time = cycle_time
+        self.last = None
+        self.count = 0
+        self.total = 0.0
+        self.min = 0.0
+        self.max = 0.0
+        self.missed = 0
+        self.periods = deque(maxlen=window)  # type: Deque[float]
+
+    def update(self, now: float, tolerance: float):
+        last = self.last
+        self.last = now
+        self.count += 1
+        if last is None:
+            return
+        period = (now - last) * 1000
+        if self.count == 2:
+            self.min = self.max = period
+        elif period < self.min:
+            self.min = period
+        elif period > self.max:
+            self.max = period
+        self.total += period
+        self.periods.append(period)
+        cycle_time = self.cycle_time
+        if cycle_time and period > cycle_time * tolerance:
+            self.missed += int(period / cycle_time + 0.5) - 1
+
+
+class CycleMonitor(object):
+    """
+    接收周期监控
+    """
+
+    def __init__(self, window: int = 1000, tolerance: float = 1.5):
+        """
+        :param window: 计算p99的时候使用的最近的间隔数量
+
+        :param tolerance: 间隔超过周期的多少倍认为丢失了周期
+        """
+        self.__window = window
+        self.__tolerance = tolerance
+        # msg id对应的周期，单位毫秒
+        self.__cycle_times = dict()  # type: Dict[int, int]
+        self.__cycles = dict()  # type: Dict[int, _Cycle]
+        self.__start_time = time()
+        self.__start_counter = perf_counter()
+        self.__last = None  # type: Optional[float]
+
+    @property
+    def observed_time(self) -> float:
+        """
+        开始监控到现在的时间，单位秒
+        """
+        return perf_counter() - self.__start_counter
+
+    def reset(self):
+        """
+        清空统计，重新开始监控，周期的设置保留
+        """
+        self.__cycles = dict()
+        self.__last = None
+        self.__start_time = time()
+        self.__start_counter = perf_counter()
+
+    def set_cycle_times(self, cycle_times: Dict[int, int]):
+        """
+        设置msg id的周期，用于计算丢失的周期数
+
+        :param cycle_times: 其中key是msg id，value是周期，单位毫秒
+        """
+        self.__cycle_times.update(cycle_times)
+        for msg_id, cycle in self.__cycles.items():
+            cycle.cycle_time = self.__cycle_times.get(msg_id, 0)
+
+    def get_cycle_time(self, msg_id: int) -> int:
+        """
+        获取设置的周期，没有设置的时候返回0
+        """
+        return self.__cycle_times.get(msg_id, 0)
+
+    def update(self, message: Message):
+        """
+        收到一帧的时候在接收线程中调用
+
+        :param message: 收到的帧
+        """
+        now = perf_counter()
+        cycle = self.__cycles.get(message.msg_id)
+        if cycle is None:
+            cycle = _Cycle(self.__cycle_times.get(message.msg_id, 0), self.__window)
+            self.__cycles[message.msg_id] = cycle
+        cycle.update(now, self.__tolerance)
+        self.__last = now
+
+    def is_received(self, msg_id: Optional[int] = None) -> bool:
+        """
+        开始监控以后是否收到过
+
+        :param msg_id: msg id，为None的时候是任意帧
+        """
+        if msg_id is None:
+            return self.__last is not None
+        return msg_id in self.__cycles
+
+    def get_silent_time(self, msg_id: Optional[int] = None) -> float:
+        """
+        距离最后一次收到的时间，没有收到过的时候是开始监控到现在的时间
+
+        :param msg_id: msg id，为None的时候是整个总线
+
+        :return: 单位秒
+        """
+        if msg_id is None:
+            last = self.__last
+        else:
+            cycle = self.__cycles.get(msg_id)
+            last = cycle.last if cycle else None
+        return perf_counter() - (self.__start_counter if last is None else last)
+
+    def get_statistics(self, msg_id: Optional[int] = None) -> Dict[int, CycleStatistics]:
+        """
+        获取接收周期统计的快照
+
+        :param msg_id: msg id，默认获取所有收到过的
+
+        :return: 其中key是msg id，value是CycleStatistics
+        """
+        now = perf_counter()
+        cycles = self.__cycles
+        msg_ids = list(cycles) if msg_id is None else [msg_id] if msg_id in cycles else []
+        result = dict()
+        for key in msg_ids:
+            cycle = cycles[key]
+            last = cycle.last
+            periods = list(cycle.periods)
+            size = cycle.count - 1
+            mean = cycle.total / size if size > 0 else 0.0
+            p99 = float(np.percentile(periods, 99)) if periods else 0.0
+            last_seen = self.__start_time + (last - self.__start_counter)
+            result[key] = CycleStatistics(cycle.count, cycle.cycle_time, mean, cycle.min, cycle.max, p99,
+                                          cycle.missed, last_seen, (now - last) * 1000)
+        return result
+
+    def get_lost_messages(self, lost_period: int = 10) -> List[int]:
+        """
+        获取设置了周期，但是超过lost_period个周期没有收到的msg id
+
+        :param lost_period: 丢失的周期数
+
+        :return: msg id列表
+        """
+        lost = []
+        for msg_id, cycle_time in self.__cycle_times.items():
+            if cycle_time > 0 and self.get_silent_time(msg_id) * 1000 > cycle_time * lost_period:
+                lost.append(msg_id)
+        return lost
@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        receive_filter.py
+# @Author:      lizhe
+# @Created:     2023/4/16 - 15:22
+# --------------------------------------------------------
+from collections import namedtuple
+from typing import Iterable, Tuple, Optional, List, Dict
+
+from .constant import MAX_STANDARD_ID, MAX_EXTENDED_ID
+
+"""
+接收滤波
+
+ReceiveFilter由ID、ID范围和(code, mask)组成，满足任意一个条件的帧才会被接收：
+
+    标准帧(ID不超过0x7FF)在创建的时候计算成2048字节的位图，接收的时候只需要一次索引
+
+    扩展帧第一次收到的时候计算，并缓存结果
+
+各个总线的_read在构造Message之前用原始的ID调用accept，被过滤的帧不会进入栈、周期监控、订阅和诊断的处理。
+
+设备支持硬件验收滤波的时候，会把条件合并成ID范围(get_ranges)设置到设备中，硬件滤波可能比软件的条件宽(如mask转换成范围)，
+
+所以软件滤波始终生效，dropped只统计软件过滤掉的帧，被硬件过滤的帧不会到达上位机，无法统计。
+"""
+
+# 滤波统计，accepted和dropped是软件滤波接收和丢弃的帧数，hardware是否设置了硬件滤波
+FilterStatistics = namedtuple("FilterStatistics", ["accepted", "dropped", "hardware"])
+
+# 扩展帧结果缓存的最大数量，超过以后清空重新计算
+_max_cache_size = 65536
+
+
+class ReceiveFilter(object):
+    """
+    接收滤波
+    """
+
+    def __init__(self, ids: Optional[Iterable[int]] = None, ranges: Optional[Iterable[Tuple[int, int]]] = None,
+                 masks: Optional[Iterable[Tuple[int, int]]] = None):
+        """
+        :param ids: 接收的ID
+
+        :param ranges: 接收的ID范围，(起始ID, 结束ID)，包含两端
+
+        :param masks: (code, mask)，(ID & mask) == (code & mask)的时候接收
+
+        ID不超过0x7FF的认为是标准帧，超过的认为是扩展帧
+        """
+        self.__ids = frozenset(ids) if ids else frozenset()
+        self.__ranges = [(min(x), max(x)) for x in ranges] if ranges else []
+        self.__masks = [(code & mask, mask) for code, mask in masks] if masks else []
+        if not (self.__ids or self.__ranges or self.__masks):
+            raise ValueError("at least one of ids, ranges and masks is needed")
+        for msg_id in list(self.__ids) + [x for item in self.__ranges for x in item]:
+            if not 0 <= msg_id <= MAX_EXTENDED_ID:
+                raise ValueError(f"msg id [{msg_id}] is incorrect, only support [0 - {hex(MAX_EXTENDED_ID)}]")
+        # 标准帧的位图
+        self.__standard = bytearray(self.__match(x) for x in range(MAX_STANDARD_ID + 1))
+        # 扩展帧的结果缓存
+        self.__extended = dict()  # type: Dict[int, bool]
+        self.__accepted = 0
+        self.__dropped = 0
+        self.__hardware = False
+
+    @property
+    def accepted(self) -> int:
+        return self.__accepted
+
+    @property
+    def dropped(self) -> int:
+        return self.__dropped
+
+    @property
+    def hardware(self) -> bool:
+        """
+        是否设置了硬件滤波
+        """
+        return self.__hardware
+
+    @hardware.setter
+    def hardware(self, hardware: bool):
+        self.__hardware = hardware
+
+    def __match(self, msg_id: int) -> bool:
+        if msg_id in self.__ids:
+            return True
+        for start, end in self.__ranges:
+            if start <= msg_id <= end:
+                return True
+        for code, mask in self.__masks:
+            if msg_id & mask == code:
+                return True
+        return False
+
+    def accept(self, msg_id: int) -> bool:
+        """
+        在接收线程中调用，判断是否接收并计数
+
+        :param msg_id: 帧的原始ID，不能带有扩展帧的标志位
+
+        :return: 接收返回True
+        """
+        if msg_id <= MAX_STANDARD_ID:
+            result = self.__standard[msg_id] == 1
+        else:
+            result = self.__extended.get(msg_id)
+            if result is None:
+                if len(self.__extended) >= _max_cache_size:
+                    self.__extended.clear()
+                result = self.__extended[msg_id] = self.__match(msg_id)
+        if result:
+            self.__accepted += 1
+        else:
+            self.__dropped += 1
+        return result
+
+    def get_ranges(self) -> List[Tuple[int, int, bool]]:
+        """
+        把所有的条件合并成ID范围，用于设置硬件滤波，mask转换成包含所有匹配ID的范围
+
+        :return: [(起始ID, 结束ID, 是否扩展帧), ...]，按照ID排列，标准帧和扩展帧分开
+        """
+        items = [(x, x) for x in self.__ids] + self.__ranges
+        for code, mask in self.__masks:
+            items.append((code, code | (~mask & MAX_EXTENDED_ID)))
+        merged = []
+        for start, end in sorted(items):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        ranges = []
+        for start, end in merged:
+            if start <= MAX_STANDARD_ID:
+                ranges.append((start, min(end, MAX_STANDARD_ID), False))
+            if end > MAX_STANDARD_ID:
+                ranges.append((max(start, MAX_STANDARD_ID + 1), end, True))
+        return ranges
+
+    def get_statistics(self) -> FilterStatistics:
+        return FilterStatistics(self.__accepted, self.__dropped, self.__hardware)
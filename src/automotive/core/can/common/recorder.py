@@ -0,0 +1,324 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        recorder.py
+# @Author:      lizhe
+# @Created:     2023/4/6 - 20:35
+# --------------------------------------------------------
+import os
+import struct
+from collections import deque
+from threading import Thread, Event
+from time import time, perf_counter
+from typing import Optional, List, Deque, Tuple
+
+import numpy as np
+
+from automotive.logger.logger import logger
+from .typehints import Number
+from ..message import Message
+
+"""
+CAN日志的录制和读取
+
+CanRecorder把总线上收发的帧追加到二进制文件中，接收线程和发送线程只把帧放入队列，由后台的写入线程定时批量写入，
+
+文件由16字节的文件头和定长的记录组成：
+
+    文件头: 8字节的magic、4字节的版本号、4字节的记录长度(均为小端)
+
+    记录: 参考record_dtype，时间(秒，float64)、帧ID(uint32)、标志位(uint8)、数据长度(uint8)、64字节数据
+
+CanLog通过numpy.memmap映射文件，不需要把整个文件读入内存，正在录制的文件也可以打开(只包含打开时已经写入的记录)
+"""
+
+# 文件头
+LOG_MAGIC = b"AUTOCAN\x00"
+LOG_VERSION = 1
+_header_format = "<8sII"
+HEADER_SIZE = struct.calcsize(_header_format)
+# 数据的最大长度
+MAX_DATA_LENGTH = 64
+# 标志位: 发送的帧
+FLAG_TRANSMIT = 0x01
+# 标志位: 扩展帧
+FLAG_EXTENDED = 0x02
+# 标志位: CANFD帧
+FLAG_FD = 0x04
+
+# 一条记录的结构，最后2个字节保留，使记录长度为8的倍数
+record_dtype = np.dtype([("time_stamp", "<f8"), ("msg_id", "<u4"), ("flags", "u1"), ("dlc", "u1"),
+                         ("reserved", "u1", (2,)), ("data", "u1", (MAX_DATA_LENGTH,))])
+
+
+def is_can_log(file: str) -> bool:
+    """
+    判断文件是否是CanRecorder录制的日志
+
+    :param file: 文件
+
+    :return: 文件头正确返回True
+    """
+    with open(file, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    return len(header) == HEADER_SIZE and header[:len(LOG_MAGIC)] == LOG_MAGIC
+
+
+def get_flags(message: Message, is_transmit: bool = False) -> int:
+    """
+    计算帧的标志位
+
+    :param message: 帧
+
+    :param is_transmit: 是否是发送的帧
+
+    :return: 标志位
+    """
+    flags = FLAG_TRANSMIT if is_transmit else 0
+    if message.is_extended:
+        flags |= FLAG_EXTENDED
+    if message.is_fd_frame:
+        flags |= FLAG_FD
+    return flags
+
+
+class CanRecorder(object):
+    """
+    CAN日志录制器
+    """
+
+    def __init__(self, file: str, flush_interval: float = 0.1, append: bool = False):
+        """
+        :param file: 日志文件
+
+        :param flush_interval: 写入线程批量写入的间隔，单位秒
+
+        :param append: 文件已经存在的时候是否追加，默认覆盖
+        """
+        self.__file = file
+        self.__flush_interval = flush_interval
+        self.__append = append
+        # 接收线程和发送线程放入，写入线程取出，deque的append和popleft是线程安全的
+        self.__queue = deque()  # type: Deque[Tuple[float, int, int, bytes]]
+        self.__stop_event = Event()
+        self.__thread = None  # type: Optional[Thread]
+        self.__handle = None
+        # 用perf_counter计算时间，避免系统时间调整导致时间倒退
+        self.__start_time = 0.0
+        self.__start_counter = 0.0
+        self.__count = 0
+
+    @property
+    def file(self) -> str:
+        return self.__file
+
+    @property
+    def is_recording(self) -> bool:
+        return self.__thread is not None
+
+    @property
+    def count(self) -> int:
+        """
+        已经写入文件的帧数
+        """
+        return self.__count
+
+    def start(self):
+        """
+        打开文件并启动写入线程
+        """
+        if self.__thread:
+            return
+        if self.__append and os.path.exists(self.__file) and os.path.getsize(self.__file) > 0:
+            if not is_can_log(self.__file):
+                raise RuntimeError(f"{self.__file} is not a can log file")
+            self.__handle = open(self.__file, "ab")
+        else:
+            self.__handle = open(self.__file, "wb")
+            self.__handle.write(struct.pack(_header_format, LOG_MAGIC, LOG_VERSION, record_dtype.itemsize))
+        self.__start_time = time()
+        self.__start_counter = perf_counter()
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__write, name="can_recorder", daemon=True)
+        self.__thread.start()
+        logger.debug(f"start record can log to {self.__file}")
+
+    def stop(self):
+        """
+        写入队列中剩余的帧，然后关闭文件
+        """
+        if self.__thread is None:
+            return
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+        self.__handle.close()
+        self.__handle = None
+        logger.debug(f"stop record can log, {self.__count} frames in {self.__file}")
+
+    def record(self, message: Message, is_transmit: bool = False):
+        """
+        记录一帧，只放入队列，不做任何IO操作
+
+        :param message: 帧
+
+        :param is_transmit: 是否是发送的帧
+        """
+        if self.__thread is None:
+            return
+        time_stamp = self.__start_time + (perf_counter() - self.__start_counter)
+        # 发送的message对象会被复用，所以需要复制数据
+        self.__queue.append((time_stamp, message.msg_id, get_flags(message, is_transmit),
+                             bytes(message.data[:MAX_DATA_LENGTH])))
+
+    def record_many(self, messages: List[Message], is_transmit: bool = False):
+        """
+        记录多帧
+
+        :param messages: 帧列表
+
+        :param is_transmit: 是否是发送的帧
+        """
+        for message in messages:
+            self.record(message, is_transmit)
+
+    def __write(self):
+        while not self.__stop_event.wait(self.__flush_interval):
+            self.__flush()
+        self.__flush()
+
+    def __flush(self):
+        size = len(self.__queue)
+        if size == 0:
+            return
+        queue = self.__queue
+        frames = [queue.popleft() for _ in range(size)]
+        time_stamps, msg_ids, flags, datas = zip(*frames)
+        records = np.zeros(size, dtype=record_dtype)
+        records["time_stamp"] = time_stamps
+        records["msg_id"] = msg_ids
+        records["flags"] = flags
+        records["dlc"] = [len(x) for x in datas]
+        buffer = b"".join(x.ljust(MAX_DATA_LENGTH, b"\x00") for x in datas)
+        records["data"] = np.frombuffer(buffer, dtype=np.uint8).reshape(size, MAX_DATA_LENGTH)
+        try:
+            self.__handle.write(records.tobytes())
+            self.__handle.flush()
+            self.__count += size
+        except OSError as e:
+            logger.error(f"write {size} frames to {self.__file} failed, error is {e}")
+
+
+class CanLog(object):
+    """
+    通过numpy.memmap读取CanRecorder录制的日志
+    """
+
+    def __init__(self, file: str):
+        """
+        :param file: 日志文件
+        """
+        with open(file, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE:
+            raise RuntimeError(f"{file} is not a can log file")
+        magic, version, record_size = struct.unpack(_header_format, header)
+        if magic != LOG_MAGIC:
+            raise RuntimeError(f"{file} is not a can log file")
+        if version != LOG_VERSION or record_size != record_dtype.itemsize:
+            raise RuntimeError(f"{file} version {version} and record size {record_size} is not support")
+        self.__file = file
+        # 只映射完整的记录，正在录制的文件最后一条记录可能没有写完
+        count = (os.path.getsize(file) - HEADER_SIZE) // record_size
+        if count > 0:
+            self.__records = np.memmap(file, dtype=record_dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+        else:
+            # 没有记录的时候memmap会抛出异常
+            self.__records = np.zeros(0, dtype=record_dtype)
+
+    @property
+    def file(self) -> str:
+        return self.__file
+
+    @property
+    def records(self) -> np.ndarray:
+        """
+        所有的记录，字段参考record_dtype
+        """
+        return self.__records
+
+    def __len__(self) -> int:
+        return len(self.__records)
+
+    def __get_mask(self, msg_id: Optional[int], since: Optional[Number], include_transmit: bool) -> np.ndarray:
+        records = self.__records
+        mask = np.ones(len(records), dtype=bool)
+        if msg_id is not None:
+            mask &= records["msg_id"] == msg_id
+        if since is not None:
+            mask &= records["time_stamp"] >= since
+        if not include_transmit:
+            mask &= (records["flags"] & FLAG_TRANSMIT) == 0
+        return mask
+
+    def get_records(self, msg_id: Optional[int] = None, since: Optional[Number] = None,
+                    include_transmit: bool = True) -> np.ndarray:
+        """
+        过滤记录
+
+        :param msg_id: msg id，默认全部
+
+        :param since: 只获取时间大于等于since的记录，默认全部
+
+        :param include_transmit: 是否包含发送的帧
+
+        :return: 记录的数组
+        """
+        return self.__records[self.__get_mask(msg_id, since, include_transmit)]
+
+    def get_frames(self, msg_id: int, since: Optional[Number] = None, include_transmit: bool = False) -> np.ndarray:
+        """
+        获取某个msg id所有帧的数据，可以直接用于Message.decode_frames，和接收栈一样默认只包含接收的帧
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的帧，默认全部
+
+        :param include_transmit: 是否包含发送的帧
+
+        :return: (N, 64)的uint8数组
+        """
+        return self.get_records(msg_id, since, include_transmit)["data"]
+
+    def get_messages(self, msg_id: Optional[int] = None, since: Optional[Number] = None,
+                     include_transmit: bool = False) -> List[Message]:
+        """
+        获取帧并转换成Message对象
+
+        :param msg_id: msg id，默认全部
+
+        :param since: 只获取时间大于等于since的帧，默认全部
+
+        :param include_transmit: 是否包含发送的帧
+
+        :return: 消息列表
+        """
+        records = self.get_records(msg_id, since, include_transmit)
+        # 一次性转换成bytes，每一帧的数据只需要切片
+        width = records["data"].shape[1]
+        buffer = records["data"].tobytes()
+        messages = []
+        for index, (time_stamp, record_id, flags, dlc) in enumerate(zip(records["time_stamp"].tolist(),
+                                                                        records["msg_id"].tolist(),
+                                                                        records["flags"].tolist(),
+                                                                        records["dlc"].tolist())):
+            message = Message()
+            message.msg_id = record_id
+            message.time_stamp = time_stamp
+            message.data = buffer[index * width:index * width + dlc]
+            message.data_length = dlc
+            message.external_flag = 1 if flags & FLAG_EXTENDED else 0
+            message.is_fd = bool(flags & FLAG_FD)
+            messages.append(message)
+        return messages
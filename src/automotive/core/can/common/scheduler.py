@@ -0,0 +1,385 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        scheduler.py
+# @Author:      lizhe
+# @Created:     2023/3/24 - 21:08
+# --------------------------------------------------------
+import heapq
+import math
+from collections import namedtuple
+from threading import Thread, Condition
+from time import perf_counter_ns
+from typing import Callable, Sequence, Dict, Optional, List, Tuple
+
+from automotive.logger.logger import logger
+from ..message import Message
+
+"""
+发送调度器
+
+原来的周期信号每个msg id都在线程池中开一个线程，通过sleep(cycle_time)来控制周期，发送本身的耗时会累加到周期中，
+
+而且几百个线程之间争抢GIL，周期的抖动很大。
+
+TransmitScheduler只用一个线程，通过最小堆按照绝对时间(perf_counter_ns)排列所有周期和事件信号的下一次发送时间，
+
+下一次的发送时间是上一次的计划时间加上周期，所以发送的耗时不会累加。计划时间相差在batch_window之内的帧会合并成一批发送。
+
+多通道会话中多个CAN通道共用一个调度线程，任务按照(通道, msg id)区分，同一批到期的帧按照通道分组，交给各个通道的发送函数，
+
+每个通道通过add_channel得到的ChannelScheduler使用，接口和TransmitScheduler相同。
+"""
+
+# 抖动统计，单位都是毫秒
+JitterStatistics = namedtuple("JitterStatistics", ["count", "mean", "std", "min", "max"])
+
+# 纳秒和毫秒的转换
+_ns_per_ms = 1000000
+
+
+class _Task(object):
+    """
+    调度任务
+    """
+
+    __slots__ = ("channel", "msg_id", "message", "period", "deadline", "times", "is_cycle", "cancelled")
+
+    def __init__(self, message: Message, period: int, deadline: int, times: Optional[int], is_cycle: bool,
+                 channel: int = 0):
+        # 通道，单通道使用的时候为0
+        self.channel = channel
+        self.msg_id = message.msg_id
+        self.message = message
+        # 周期，单位纳秒
+        self.period = period
+        # 下一次发送的时间
+        self.deadline = deadline
+        # 剩余发送次数，None表示一直发送
+        self.times = times
+        self.is_cycle = is_cycle
+        self.cancelled = False
+
+
+class _Jitter(object):
+    """
+    周期误差的统计(Welford算法)
+    """
+
+    __slots__ = ("last", "count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.last = None
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, send_time: int, period: int):
+        if self.last is not None:
+            error = (send_time - self.last - period) / _ns_per_ms
+            self.count += 1
+            delta = error - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (error - self.mean)
+            self.min = min(self.min, error)
+            self.max = max(self.max, error)
+        self.last = send_time
+
+    def get_statistics(self) -> JitterStatistics:
+        if self.count == 0:
+            return JitterStatistics(0, 0.0, 0.0, 0.0, 0.0)
+        std = math.sqrt(self.m2 / self.count)
+        return JitterStatistics(self.count, self.mean, std, self.min, self.max)
+
+
+class TransmitScheduler(object):
+    """
+    单线程的发送调度器
+    """
+
+    def __init__(self, transmit: Optional[Callable[[Sequence[Message]], None]] = None, batch_window: float = 0.5,
+                 spin_time: float = 0):
+        """
+        :param transmit: 发送函数，参数是同一批需要发送的消息，多通道共用的时候为None，通过add_channel设置每个通道的发送函数
+
+        :param batch_window: 合并发送的时间窗口，单位毫秒
+
+        :param spin_time: 发送前忙等的时间，单位毫秒，默认为0，完全依赖系统定时器
+
+            大于0的时候可以减小抖动，但是每个发送时间之前都会忙等，周期信号较多并且发送时间错开的时候，调度线程几乎占满一个CPU核
+        """
+        # 通道对应的发送函数
+        self.__transmits = {0: transmit} if transmit else dict()  # type: Dict[int, Callable[[Sequence[Message]], None]]
+        self.__batch_window = int(batch_window * _ns_per_ms)
+        self.__spin_time = int(spin_time * _ns_per_ms)
+        self.__condition = Condition()
+        # 最小堆，每一项是(deadline, 序号, task)
+        self.__heap = []
+        self.__counter = 0
+        # (通道, msg id)对应的周期任务和事件任务
+        self.__cycle_tasks = dict()  # type: Dict[Tuple[int, int], _Task]
+        self.__event_tasks = dict()  # type: Dict[Tuple[int, int], _Task]
+        self.__jitters = dict()  # type: Dict[Tuple[int, int], _Jitter]
+        self.__running = False
+        self.__thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.__running
+
+    def start(self):
+        """
+        启动调度线程
+        """
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = Thread(target=self.__run, name="can_transmit_scheduler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        停止调度线程，并清除所有的任务
+        """
+        with self.__condition:
+            self.__running = False
+            self.__heap.clear()
+            self.__cycle_tasks.clear()
+            self.__event_tasks.clear()
+            self.__condition.notify_all()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def add_channel(self, channel: int, transmit: Callable[[Sequence[Message]], None]) -> "ChannelScheduler":
+        """
+        增加一个共用调度线程的通道
+
+        :param channel: 通道
+
+        :param transmit: 该通道的发送函数，参数是同一批需要发送的消息
+
+        :return: 该通道使用的调度器
+        """
+        with self.__condition:
+            self.__transmits[channel] = transmit
+        return ChannelScheduler(self, channel)
+
+    def clear(self, channel: int):
+        """
+        移除某个通道所有的任务，调度线程继续运行
+
+        :param channel: 通道
+        """
+        with self.__condition:
+            for tasks in self.__cycle_tasks, self.__event_tasks:
+                for key in [x for x in tasks if x[0] == channel]:
+                    tasks.pop(key).cancelled = True
+
+    def __push(self, task: _Task):
+        self.__counter += 1
+        heapq.heappush(self.__heap, (task.deadline, self.__counter, task))
+        self.__condition.notify_all()
+
+    def add_cycle(self, message: Message, channel: int = 0):
+        """
+        添加周期发送的消息，如果该msg id已经在发送则替换掉原来的任务
+
+        :param message: 消息，周期是message.cycle_time
+
+        :param channel: 通道
+        """
+        period = int(message.cycle_time * _ns_per_ms)
+        if period <= 0:
+            raise ValueError(f"cycle time of {hex(message.msg_id)} must > 0, but now is {message.cycle_time}")
+        key = channel, message.msg_id
+        with self.__condition:
+            task = self.__cycle_tasks.get(key)
+            if task:
+                task.cancelled = True
+            task = _Task(message, period, perf_counter_ns(), None, True, channel)
+            self.__cycle_tasks[key] = task
+            self.__jitters[key] = _Jitter()
+            self.__push(task)
+
+    def add_event(self, message: Message, times: int, channel: int = 0):
+        """
+        添加事件发送的消息，如果该msg id的事件还没有发送完成，则在原来的次数上追加
+
+        :param message: 消息，间隔是message.cycle_time_fast
+
+        :param times: 发送次数
+
+        :param channel: 通道
+        """
+        key = channel, message.msg_id
+        with self.__condition:
+            task = self.__event_tasks.get(key)
+            if task and not task.cancelled:
+                task.message = message
+                task.times += times
+            else:
+                period = max(int(message.cycle_time_fast * _ns_per_ms), 1)
+                task = _Task(message, period, perf_counter_ns(), times, False, channel)
+                self.__event_tasks[key] = task
+                self.__push(task)
+
+    def remove(self, msg_id: int, channel: int = 0):
+        """
+        移除某个msg id的周期和事件任务
+
+        :param msg_id: msg id
+
+        :param channel: 通道
+        """
+        with self.__condition:
+            for tasks in self.__cycle_tasks, self.__event_tasks:
+                task = tasks.pop((channel, msg_id), None)
+                if task:
+                    task.cancelled = True
+
+    def get_jitter(self, msg_id: Optional[int] = None, channel: int = 0) -> Dict[int, JitterStatistics]:
+        """
+        获取周期信号实际发送间隔和周期之间误差的统计
+
+        :param msg_id: msg id，默认获取所有
+
+        :param channel: 通道
+
+        :return: 其中key是msg id，value是JitterStatistics(次数, 平均值, 标准差, 最小值, 最大值)，单位毫秒
+        """
+        with self.__condition:
+            if msg_id is not None:
+                if (channel, msg_id) not in self.__jitters:
+                    raise RuntimeError(f"message {hex(msg_id)} is not transmit by scheduler")
+                return {msg_id: self.__jitters[(channel, msg_id)].get_statistics()}
+            return dict((key[1], value.get_statistics()) for key, value in self.__jitters.items()
+                        if key[0] == channel)
+
+    def __get_due_tasks(self) -> List[_Task]:
+        """
+        等待到最近的发送时间，并取出时间窗口内所有到期的任务
+        """
+        with self.__condition:
+            while self.__running:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                deadline, _, task = self.__heap[0]
+                if task.cancelled:
+                    heapq.heappop(self.__heap)
+                    continue
+                wait_time = deadline - perf_counter_ns()
+                if wait_time > self.__spin_time:
+                    # 提前醒来，剩下的时间忙等，避免系统定时器的误差
+                    self.__condition.wait((wait_time - self.__spin_time) / 1e9)
+                    continue
+                if wait_time > 0:
+                    self.__condition.wait(0)
+                    continue
+                limit = perf_counter_ns() + self.__batch_window
+                tasks = []
+                while self.__heap and self.__heap[0][0] <= limit:
+                    _, _, task = heapq.heappop(self.__heap)
+                    if not task.cancelled:
+                        tasks.append(task)
+                return tasks
+            return []
+
+    def __reschedule(self, tasks: Sequence[_Task], send_time: int):
+        """
+        计算下一次发送时间，周期超时的时候跳过已经错过的周期
+        """
+        with self.__condition:
+            for task in tasks:
+                if task.cancelled:
+                    continue
+                if task.is_cycle:
+                    self.__jitters[(task.channel, task.msg_id)].update(send_time, task.period)
+                else:
+                    task.times -= 1
+                    if task.times <= 0:
+                        task.cancelled = True
+                        self.__event_tasks.pop((task.channel, task.msg_id), None)
+                        continue
+                task.deadline += task.period
+                if task.deadline <= send_time:
+                    task.deadline += ((send_time - task.deadline) // task.period + 1) * task.period
+                self.__push(task)
+
+    def __run(self):
+        logger.debug("transmit scheduler start")
+        while self.__running:
+            tasks = self.__get_due_tasks()
+            if not tasks:
+                continue
+            # 按照通道分组，单通道的时候只有一组
+            batches = dict()  # type: Dict[int, List[Message]]
+            for task in tasks:
+                # 周期信号被停止了
+                if task.is_cycle and task.message.stop_flag:
+                    task.cancelled = True
+                    continue
+                batches.setdefault(task.channel, []).append(task.message)
+            send_time = perf_counter_ns()
+            for channel, messages in batches.items():
+                transmit = self.__transmits.get(channel)
+                if transmit is None:
+                    continue
+                try:
+                    transmit(messages)
+                except RuntimeError as e:
+                    logger.trace(f"some issue found, error is {e}")
+            self.__reschedule(tasks, send_time)
+        logger.debug("transmit scheduler stop")
+
+
+class ChannelScheduler(object):
+    """
+    共用调度线程的一个通道，接口和TransmitScheduler相同
+    """
+
+    def __init__(self, scheduler: TransmitScheduler, channel: int):
+        """
+        :param scheduler: 共用的调度器
+
+        :param channel: 通道
+        """
+        self.__scheduler = scheduler
+        self.__channel = channel
+
+    @property
+    def channel(self) -> int:
+        return self.__channel
+
+    @property
+    def is_running(self) -> bool:
+        return self.__scheduler.is_running
+
+    def start(self):
+        """
+        启动共用的调度线程，已经启动的时候不做任何操作
+        """
+        self.__scheduler.start()
+
+    def stop(self):
+        """
+        移除该通道所有的任务，共用的调度线程由创建者停止
+        """
+        self.__scheduler.clear(self.__channel)
+
+    def add_cycle(self, message: Message):
+        self.__scheduler.add_cycle(message, self.__channel)
+
+    def add_event(self, message: Message, times: int):
+        self.__scheduler.add_event(message, times, self.__channel)
+
+    def remove(self, msg_id: int):
+        self.__scheduler.remove(msg_id, self.__channel)
+
+    def get_jitter(self, msg_id: Optional[int] = None) -> Dict[int, JitterStatistics]:
+        return self.__scheduler.get_jitter(msg_id, self.__channel)
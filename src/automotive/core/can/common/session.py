@@ -0,0 +1,341 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        session.py
+# @Author:      lizhe
+# @Created:     2023/4/15 - 19:48
+# --------------------------------------------------------
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+from time import perf_counter, sleep
+from typing import Dict, Optional, List, Iterable, Callable, Deque
+
+import numpy as np
+
+from automotive.logger.logger import logger
+from .interfaces import BaseCanBus
+from .isotp import LatencyStatistics
+from .scheduler import TransmitScheduler
+from ..message import Message
+
+"""
+多通道会话
+
+同一个CAN盒的多个通道在一个会话中打开，每个通道是一个BaseCanBus，设备句柄由同一个CAN盒的各个通道共用，
+
+所有通道共用一个线程池、一个发送调度线程和一个接收线程：
+
+    接收线程依次读取每个通道的接收缓存，收到的帧按照通道分别放入该通道的栈、周期监控和订阅中，
+
+    所有通道的设备都支持接收事件(set_receive_event)的时候等待事件，只有一个通道的时候使用设备的wait_for_receive，否则退避轮询
+
+GatewayRoute在接收线程中把源通道收到的帧直接发送到目标通道，并统计从接收线程拿到帧到发送完成增加的时间
+"""
+
+
+class GatewayRoute(object):
+    """
+    两个通道之间的网关转发
+    """
+
+    def __init__(self, source: BaseCanBus, target: BaseCanBus, msg_ids: Optional[Iterable[int]] = None,
+                 transform: Optional[Callable[[Message], Optional[Message]]] = None, window: int = 10000):
+        """
+        :param source: 源通道
+
+        :param target: 目标通道
+
+        :param msg_ids: 需要转发的msg id，默认转发所有的帧
+
+        :param transform: 转换函数，参数是收到的帧，返回需要发送的新的Message，返回None的时候不转发，不能修改收到的帧
+
+        :param window: 统计转发时间的时候使用的最近的次数
+        """
+        self.__source = source
+        self.__target = target
+        self.__transform = transform
+        self.__latencies = deque(maxlen=window)  # type: Deque[float]
+        self.__count = 0
+        self.__failed = 0
+        if msg_ids is None:
+            self.__subscriptions = [source.subscribe(None, self.__forward)]
+        else:
+            self.__subscriptions = [source.subscribe(msg_id, self.__forward) for msg_id in msg_ids]
+
+    @property
+    def source_channel(self) -> int:
+        return self.__source.channel_index
+
+    @property
+    def target_channel(self) -> int:
+        return self.__target.channel_index
+
+    @property
+    def count(self) -> int:
+        """
+        转发成功的帧数
+        """
+        return self.__count
+
+    @property
+    def failed(self) -> int:
+        """
+        发送失败的帧数
+        """
+        return self.__failed
+
+    @property
+    def is_active(self) -> bool:
+        return len(self.__subscriptions) > 0
+
+    @staticmethod
+    def __copy(message: Message) -> Message:
+        msg = Message()
+        msg.msg_id = message.msg_id
+        msg.external_flag = message.external_flag
+        msg.is_fd = message.is_fd
+        msg.data = bytes(message.data)
+        msg.data_length = len(msg.data)
+        return msg
+
+    def __forward(self, message: Message):
+        """
+        在接收线程中执行，收到的帧在源通道的栈中，所以发送的是复制的帧
+        """
+        start_time = perf_counter()
+        frame = self.__transform(message) if self.__transform else self.__copy(message)
+        if frame is None:
+            return
+        try:
+            self.__target.transmit_one(frame)
+        except RuntimeError as e:
+            self.__failed += 1
+            logger.trace(f"forward {hex(message.msg_id)} to channel {self.target_channel} failed, error is {e}")
+            return
+        self.__latencies.append((perf_counter() - start_time) * 1000)
+        self.__count += 1
+
+    def get_latency_statistics(self) -> LatencyStatistics:
+        """
+        统计最近转发增加的时间
+
+        :return: LatencyStatistics，单位毫秒
+        """
+        latencies = list(self.__latencies)
+        if len(latencies) == 0:
+            return LatencyStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        values = np.asarray(latencies, dtype=np.float64)
+        p50, p90, p99 = np.percentile(values, (50, 90, 99))
+        return LatencyStatistics(len(values), float(values.mean()), float(values.min()), float(values.max()),
+                                 float(p50), float(p90), float(p99))
+
+    def cancel(self):
+        """
+        停止转发
+        """
+        for subscription in self.__subscriptions:
+            subscription.cancel()
+        self.__subscriptions = []
+
+
+class CanSession(object):
+    """
+    共用设备句柄的多通道会话
+    """
+
+    def __init__(self, buses: Dict[int, BaseCanBus], use_scheduler: bool = True, max_workers: int = 300):
+        """
+        :param buses: 其中key是通道，value是该通道的总线，总线需要是同一种CAN盒，并且还没有打开
+
+        :param use_scheduler: 是否使用共用的发送调度线程，为False的时候每个周期信号一个线程
+
+        :param max_workers: 共用的线程池的最大线程数
+        """
+        if not buses:
+            raise ValueError("at least one channel is needed")
+        self.__buses = dict(buses)
+        self.__max_workers = max_workers
+        self.__scheduler = TransmitScheduler() if use_scheduler else None
+        self.__thread_pool = None  # type: Optional[ThreadPoolExecutor]
+        self.__routes = []  # type: List[GatewayRoute]
+        self.__routes_lock = Lock()
+        # 所有通道共用的接收事件
+        self.__receive_event = Event()
+        self.__use_event = False
+        self.__running = False
+        self.__thread = None  # type: Optional[Thread]
+        # 接收线程等待的超时时间，也是关闭的时候接收线程退出的最长时间，单位秒
+        self.__receive_wait_time = 0.05
+        # 退避轮询的最小和最大间隔，单位秒
+        self.__min_poll_interval = 0.0005
+        self.__max_poll_interval = 0.005
+
+    def __enter__(self):
+        self.open_can()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_can()
+
+    def __getitem__(self, channel: int) -> BaseCanBus:
+        return self.get_bus(channel)
+
+    @property
+    def channels(self) -> List[int]:
+        return list(self.__buses)
+
+    @property
+    def is_open(self) -> bool:
+        return self.__running
+
+    @property
+    def routes(self) -> List[GatewayRoute]:
+        return list(self.__routes)
+
+    def get_bus(self, channel: int) -> BaseCanBus:
+        """
+        获取通道的总线
+
+        :param channel: 通道
+
+        :return: 该通道的总线，可以和单通道一样发送、接收、订阅和获取栈
+        """
+        if channel not in self.__buses:
+            raise RuntimeError(f"channel {channel} not in session, only support {self.channels}")
+        return self.__buses[channel]
+
+    def open_can(self):
+        """
+        打开所有的通道，并启动共用的接收线程
+        """
+        if self.__running:
+            return
+        if self.__thread_pool is None:
+            self.__thread_pool = ThreadPoolExecutor(max_workers=self.__max_workers)
+        opened = []
+        try:
+            for bus in self.__buses.values():
+                bus._join_session(self.__thread_pool, self.__scheduler)
+                bus.open_can()
+                opened.append(bus)
+        except RuntimeError:
+            for bus in opened:
+                bus.close_can()
+            raise
+        # 所有的设备都支持接收事件的时候才使用事件等待
+        self.__receive_event.clear()
+        self.__use_event = all([bus.can_device.set_receive_event(self.__receive_event) for bus in opened])
+        if not self.__use_event:
+            for bus in opened:
+                bus.can_device.set_receive_event(None)
+        self.__running = True
+        self.__thread = Thread(target=self.__receive_loop, name="can_session_receive", daemon=True)
+        self.__thread.start()
+        logger.debug(f"session open with channels {self.channels}, use receive event is {self.__use_event}")
+
+    def close_can(self):
+        """
+        停止接收线程，关闭所有的通道，网关转发在重新打开之后继续有效
+        """
+        if not self.__running:
+            return
+        self.__running = False
+        self.__receive_event.set()
+        self.__thread.join()
+        self.__thread = None
+        for bus in self.__buses.values():
+            bus.can_device.set_receive_event(None)
+            try:
+                bus.close_can()
+            except RuntimeError as e:
+                logger.error(f"close channel {bus.channel_index} failed, error is {e}")
+        if self.__scheduler:
+            self.__scheduler.stop()
+        logger.info("shutdown thread pool")
+        self.__thread_pool.shutdown()
+        self.__thread_pool = None
+
+    def __read(self, buses: List[BaseCanBus]) -> int:
+        """
+        依次读取每个通道的接收缓存
+
+        :return: 所有通道本次处理的帧数
+        """
+        count = 0
+        for bus in buses:
+            if not bus.can_device.is_open:
+                continue
+            try:
+                count += bus._read()
+            except RuntimeError as e:
+                logger.trace(e)
+        return count
+
+    def __receive_loop(self):
+        """
+        所有通道共用的接收线程
+
+        使用事件等待的时候，事件set以后没有读到帧，说明是还没有到达的帧(如虚拟设备的延时)，退避轮询直到读到帧为止
+        """
+        buses = list(self.__buses.values())
+        event = self.__receive_event if self.__use_event else None
+        interval = self.__min_poll_interval
+        pending = False
+        while self.__running:
+            if self.__read(buses) > 0:
+                interval = self.__min_poll_interval
+                pending = False
+                continue
+            if event is not None and not pending:
+                pending = event.wait(self.__receive_wait_time)
+                event.clear()
+                continue
+            if event is None and len(buses) == 1:
+                try:
+                    received = buses[0].can_device.wait_for_receive(self.__receive_wait_time)
+                except RuntimeError as e:
+                    logger.trace(e)
+                    received = None
+                if received is not None:
+                    interval = self.__min_poll_interval
+                    continue
+            sleep(interval)
+            interval = min(interval * 2, self.__max_poll_interval)
+
+    def add_route(self, source: int, target: int, msg_ids: Optional[Iterable[int]] = None,
+                  transform: Optional[Callable[[Message], Optional[Message]]] = None) -> GatewayRoute:
+        """
+        增加网关转发，源通道收到的帧在接收线程中直接发送到目标通道
+
+        注意双向转发同一个msg id的时候，设备不能把自己发送的帧回环接收(如虚拟设备的loopback)，否则会一直转发
+
+        :param source: 源通道
+
+        :param target: 目标通道
+
+        :param msg_ids: 需要转发的msg id，默认转发所有的帧
+
+        :param transform: 转换函数，参数是收到的帧，返回需要发送的新的Message，返回None的时候不转发
+
+        :return: GatewayRoute，可以获取转发增加的时间的统计
+        """
+        if source == target:
+            raise ValueError(f"source and target channel can not be same, but both are {source}")
+        route = GatewayRoute(self.get_bus(source), self.get_bus(target), msg_ids, transform)
+        with self.__routes_lock:
+            self.__routes.append(route)
+        return route
+
+    def remove_route(self, route: Optional[GatewayRoute] = None):
+        """
+        停止网关转发
+
+        :param route: 网关转发，为None的时候停止所有的转发
+        """
+        with self.__routes_lock:
+            routes = self.__routes if route is None else [route]
+            self.__routes = [x for x in self.__routes if x not in routes]
+        for item in routes:
+            item.cancel()
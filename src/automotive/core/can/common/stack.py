@@ -0,0 +1,282 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        stack.py
+# @Author:      lizhe
+# @Created:     2023/3/22 - 20:41
+# --------------------------------------------------------
+from collections import deque
+from threading import Lock
+from typing import Sequence, List, Optional, Iterator, Dict, Deque, Union
+
+import numpy as np
+
+from .typehints import Number
+from ..message import Message
+
+"""
+接收栈
+
+原来的栈是python的list，满了以后每收到一帧都需要pop(0)，是O(n)的操作，而且查找某个msg id的消息需要遍历整个栈。
+
+FrameStack预先分配好固定大小的空间，按照环形缓冲区的方式保存数据，除了Message对象之外，还按列保存了时间、ID、DLC以及数据，
+
+同时为每个msg id维护了一个按接收顺序排列的序号索引，可以在O(k)的时间内取出某个msg id的所有消息。
+
+序号(sequence)是从0开始一直递增的接收编号，对应的槽位是sequence % capacity
+"""
+
+
+class FrameStack(object):
+    """
+    环形缓冲区实现的接收栈
+    """
+
+    def __init__(self, capacity: int = 500000, width: int = 8):
+        """
+        :param capacity: 最大允许保存的消息数量
+
+        :param width: 每帧数据保存的最大字节数，CAN为8， CANFD为64
+        """
+        if capacity <= 0:
+            raise ValueError(f"capacity must > 0, but now is {capacity}")
+        self.__capacity = capacity
+        self.__width = width
+        self.__lock = Lock()
+        self.__messages = [None] * capacity
+        self.__time_stamps = np.zeros(capacity, dtype=np.float64)
+        self.__msg_ids = np.zeros(capacity, dtype=np.uint32)
+        self.__dlc = np.zeros(capacity, dtype=np.uint8)
+        self.__data = np.zeros((capacity, width), dtype=np.uint8)
+        # 每个msg id对应的sequence
+        self.__index = dict()  # type: Dict[int, Deque[int]]
+        # 栈中第一帧的sequence
+        self.__head = 0
+        # 下一帧的sequence
+        self.__tail = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    @property
+    def head(self) -> int:
+        return self.__head
+
+    @property
+    def tail(self) -> int:
+        return self.__tail
+
+    def __len__(self) -> int:
+        return self.__tail - self.__head
+
+    def append(self, message: Message):
+        """
+        追加一帧消息，栈满的时候覆盖最早的一帧
+
+        :param message: 收到的消息
+        """
+        with self.__lock:
+            if self.__tail - self.__head == self.__capacity:
+                self.__evict()
+            sequence = self.__tail
+            slot = sequence % self.__capacity
+            msg_id = message.msg_id
+            data = message.data[:self.__width]
+            if isinstance(data, (bytes, bytearray)):
+                # NumPy不能直接把bytes赋值给uint8数组
+                data = memoryview(data)
+            length = len(data)
+            self.__messages[slot] = message
+            self.__time_stamps[slot] = message.time_stamp if message.time_stamp is not None else np.nan
+            self.__msg_ids[slot] = msg_id
+            self.__dlc[slot] = length
+            self.__data[slot, :length] = data
+            self.__data[slot, length:] = 0
+            if msg_id not in self.__index:
+                self.__index[msg_id] = deque()
+            self.__index[msg_id].append(sequence)
+            self.__tail = sequence + 1
+
+    def __evict(self):
+        """
+        移除最早的一帧，最早的一帧一定是该msg id索引中的第一个
+        """
+        slot = self.__head % self.__capacity
+        msg_id = int(self.__msg_ids[slot])
+        sequences = self.__index[msg_id]
+        sequences.popleft()
+        if len(sequences) == 0:
+            del self.__index[msg_id]
+        self.__messages[slot] = None
+        self.__head += 1
+
+    def clear(self):
+        """
+        清空栈
+        """
+        with self.__lock:
+            for sequence in range(self.__head, self.__tail):
+                self.__messages[sequence % self.__capacity] = None
+            self.__index.clear()
+            self.__head = self.__tail
+
+    def get(self, sequence: int) -> Message:
+        """
+        根据sequence获取消息
+
+        :param sequence: 接收编号
+
+        :return: 消息
+        """
+        if not self.__head <= sequence < self.__tail:
+            raise IndexError(f"sequence {sequence} is not in [{self.__head}, {self.__tail})")
+        return self.__messages[sequence % self.__capacity]
+
+    def get_sequences(self, msg_id: int, since: Optional[Number] = None, start: Optional[int] = None,
+                      end: Optional[int] = None) -> List[int]:
+        """
+        获取某个msg id的所有sequence，按照接收顺序排列
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :param start: sequence的起始值(包含)
+
+        :param end: sequence的结束值(不包含)
+
+        :return: sequence列表
+        """
+        with self.__lock:
+            return self.__get_sequences(msg_id, since, start, end)
+
+    def __get_sequences(self, msg_id: int, since: Optional[Number], start: Optional[int],
+                        end: Optional[int]) -> List[int]:
+        """
+        get_sequences的实现，调用者需要持有锁
+        """
+        start = self.__head if start is None else max(start, self.__head)
+        end = self.__tail if end is None else min(end, self.__tail)
+        if msg_id not in self.__index:
+            return []
+        result = []
+        # 从最新的往前找，找到范围外的就退出，复杂度只和结果的数量有关
+        for sequence in reversed(self.__index[msg_id]):
+            if sequence >= end:
+                continue
+            if sequence < start:
+                break
+            if since is not None and self.__time_stamps[sequence % self.__capacity] < since:
+                break
+            result.append(sequence)
+        result.reverse()
+        return result
+
+    def get_messages(self, msg_id: int, since: Optional[Number] = None, start: Optional[int] = None,
+                     end: Optional[int] = None) -> List[Message]:
+        """
+        获取某个msg id的所有消息，按照接收顺序排列
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :param start: sequence的起始值(包含)
+
+        :param end: sequence的结束值(不包含)
+
+        :return: 消息列表
+        """
+        with self.__lock:
+            sequences = self.__get_sequences(msg_id, since, start, end)
+            return [self.__messages[sequence % self.__capacity] for sequence in sequences]
+
+    def get_frames(self, msg_id: int, since: Optional[Number] = None, start: Optional[int] = None,
+                   end: Optional[int] = None) -> np.ndarray:
+        """
+        获取某个msg id所有消息的数据，可以直接用于Message.decode_frames
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :param start: sequence的起始值(包含)
+
+        :param end: sequence的结束值(不包含)
+
+        :return: (N, width)的uint8数组，长度不足的帧在尾部补0
+        """
+        # 查找和复制需要在同一个锁内，否则环形缓冲区覆盖以后会复制到新的帧
+        with self.__lock:
+            sequences = self.__get_sequences(msg_id, since, start, end)
+            slots = np.asarray(sequences, dtype=np.int64) % self.__capacity
+            return self.__data[slots]
+
+    def view(self) -> "StackView":
+        """
+        获取当前栈的只读视图
+        """
+        with self.__lock:
+            return StackView(self, self.__head, self.__tail)
+
+
+class StackView(Sequence[Message]):
+    """
+    接收栈的只读视图，和原来get_stack返回的list一样，可以遍历、索引以及切片
+
+    视图创建的时候固定了sequence的范围，之后收到的消息不会出现在视图中，已经被覆盖或者清除的消息会被跳过
+    """
+
+    def __init__(self, stack: FrameStack, start: int, end: int):
+        self.__stack = stack
+        self.__start = start
+        self.__end = end
+
+    def __range(self) -> range:
+        return range(max(self.__start, self.__stack.head), min(self.__end, self.__stack.tail))
+
+    def __len__(self) -> int:
+        return len(self.__range())
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, List[Message]]:
+        sequences = self.__range()[index]
+        if isinstance(index, slice):
+            return [self.__stack.get(sequence) for sequence in sequences]
+        return self.__stack.get(sequences)
+
+    def __iter__(self) -> Iterator[Message]:
+        for sequence in self.__range():
+            try:
+                yield self.__stack.get(sequence)
+            except IndexError:
+                # 遍历的过程中被覆盖或者清除了
+                continue
+
+    def __repr__(self) -> str:
+        return f"StackView({list(self)})"
+
+    def get_messages(self, msg_id: int, since: Optional[Number] = None) -> List[Message]:
+        """
+        获取视图中某个msg id的所有消息
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :return: 消息列表
+        """
+        return self.__stack.get_messages(msg_id, since, self.__start, self.__end)
+
+    def get_frames(self, msg_id: int, since: Optional[Number] = None) -> np.ndarray:
+        """
+        获取视图中某个msg id所有消息的数据
+
+        :param msg_id: msg id
+
+        :param since: 只获取时间大于等于since的消息，默认全部
+
+        :return: (N, width)的uint8数组
+        """
+        return self.__stack.get_frames(msg_id, since, self.__start, self.__end)
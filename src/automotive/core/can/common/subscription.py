@@ -0,0 +1,271 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        subscription.py
+# @Author:      lizhe
+# @Created:     2023/4/10 - 20:52
+# --------------------------------------------------------
+import operator
+import re
+from collections import deque, namedtuple
+from threading import Lock, Condition
+from time import monotonic
+from typing import Callable, Optional, Dict, Tuple, List, Deque
+
+from automotive.logger.logger import logger
+from ..message import Message
+
+"""
+接收订阅
+
+订阅者可以按照msg id、ID掩码或者条件(predicate)订阅接收到的帧，满足条件的帧交给回调函数处理，或者放入订阅者自己的有界队列中，
+
+上层通过Subscription.get等待，不需要轮询receive或者遍历栈。
+
+SubscriptionDispatcher在接收线程中分发，每个msg id对应的订阅者列表在第一次收到该msg id的时候计算并缓存(分发表)，
+
+订阅和取消订阅的时候清空分发表，所以接收线程中每一帧只需要一次字典查找，没有订阅者的时候直接返回。
+
+回调函数在接收线程中执行，应该尽快返回，耗时的处理请使用队列。
+"""
+
+
+class WaitResult(namedtuple("WaitResult", ["success", "message", "latency"])):
+    """
+    wait_for_*的结果，success为条件是否满足，message为满足条件的帧(超时的时候为None或者最后一帧)，latency单位秒
+
+    可以直接用于if判断，和success相同
+    """
+    __slots__ = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.success)
+
+
+# 信号条件表达式，如VehicleSpeed > 50
+_condition_pattern = re.compile(r"^\s*([\w.]+)\s*(==|!=|>=|<=|>|<)\s*(-?\d+(?:\.\d+)?)\s*$")
+_operators = {"==": operator.eq, "!=": operator.ne, ">=": operator.ge, "<=": operator.le, ">": operator.gt,
+              "<": operator.lt}
+
+
+def parse_condition(condition: str) -> Tuple[str, Optional[Callable[[float], bool]]]:
+    """
+    解析信号条件表达式
+
+    :param condition: 条件表达式，如"VehicleSpeed > 50"，支持==、!=、>=、<=、>、<，只有信号名字的时候没有条件
+
+    :return: (信号名字, 物理值的判断函数)
+    """
+    condition = condition.strip()
+    if re.fullmatch(r"[\w.]+", condition):
+        return condition, None
+    match = _condition_pattern.match(condition)
+    if match is None:
+        raise ValueError(f"condition {condition} is not support, it should like VehicleSpeed > 50")
+    name, symbol, value = match.groups()
+    compare = _operators[symbol]
+    threshold = float(value)
+    return name, lambda x: compare(x, threshold)
+
+
+class Subscription(object):
+    """
+    一个订阅
+    """
+
+    def __init__(self, msg_id: Optional[int] = None, mask: Optional[int] = None,
+                 predicate: Optional[Callable[[Message], bool]] = None,
+                 callback: Optional[Callable[[Message], None]] = None, queue_size: int = 1000, edge: bool = False):
+        """
+        :param msg_id: 订阅的msg id，为None的时候订阅所有的帧
+
+        :param mask: ID掩码，(收到的ID & mask) == (msg_id & mask)的时候匹配，为None的时候需要ID相同
+
+        :param predicate: 帧的条件，返回True的时候才通知订阅者
+
+        :param callback: 回调函数，为None的时候放入队列，通过get获取
+
+        :param queue_size: 队列的最大长度，满了以后丢弃最早的帧
+
+        :param edge: 为True的时候只在predicate从False变成True的时候通知一次
+        """
+        if queue_size <= 0:
+            raise ValueError(f"queue_size must > 0, but now is {queue_size}")
+        self.__msg_id = msg_id
+        self.__mask = mask
+        self.__predicate = predicate
+        self.__callback = callback
+        self.__edge = edge
+        self.__last_state = False
+        self.__queue = deque(maxlen=queue_size)  # type: Deque[Message]
+        self.__condition = Condition()
+        self.__dropped = 0
+        self.__dispatcher = None  # type: Optional[SubscriptionDispatcher]
+
+    @property
+    def msg_id(self) -> Optional[int]:
+        return self.__msg_id
+
+    @property
+    def dropped(self) -> int:
+        """
+        队列满了丢弃的帧数
+        """
+        return self.__dropped
+
+    @property
+    def is_active(self) -> bool:
+        return self.__dispatcher is not None
+
+    def _bind(self, dispatcher: Optional["SubscriptionDispatcher"]):
+        self.__dispatcher = dispatcher
+
+    def match(self, msg_id: int) -> bool:
+        """
+        ID是否匹配，只在编译分发表的时候调用
+
+        :param msg_id: 收到的msg id
+        """
+        if self.__msg_id is None:
+            return True
+        if self.__mask is None:
+            return msg_id == self.__msg_id
+        return (msg_id & self.__mask) == (self.__msg_id & self.__mask)
+
+    def notify(self, message: Message):
+        """
+        在接收线程中调用，判断条件并通知订阅者
+
+        :param message: 收到的帧
+        """
+        if self.__predicate is not None:
+            state = self.__predicate(message)
+            if self.__edge:
+                rising = state and not self.__last_state
+                self.__last_state = state
+                state = rising
+            if not state:
+                return
+        if self.__callback is not None:
+            self.__callback(message)
+            return
+        with self.__condition:
+            if len(self.__queue) == self.__queue.maxlen:
+                self.__dropped += 1
+            self.__queue.append(message)
+            self.__condition.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """
+        从队列中取出最早的一帧，没有的时候等待
+
+        :param timeout: 超时时间，单位秒，为None的时候一直等待
+
+        :return: 收到的帧，超时返回None
+        """
+        end_time = None if timeout is None else monotonic() + timeout
+        with self.__condition:
+            while not self.__queue:
+                remaining = None if end_time is None else end_time - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.__condition.wait(remaining)
+            return self.__queue.popleft()
+
+    def get_all(self) -> List[Message]:
+        """
+        取出队列中所有的帧，不等待
+        """
+        with self.__condition:
+            messages = list(self.__queue)
+            self.__queue.clear()
+            return messages
+
+    def clear(self):
+        """
+        清空队列，edge为True的时候同时复位条件的状态
+        """
+        with self.__condition:
+            self.__queue.clear()
+            self.__last_state = False
+
+    def cancel(self):
+        """
+        取消订阅
+        """
+        if self.__dispatcher:
+            self.__dispatcher.unsubscribe(self)
+
+
+class SubscriptionDispatcher(object):
+    """
+    接收线程中的订阅分发
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__subscriptions = []  # type: List[Subscription]
+        # msg id对应的订阅者，接收线程只读，订阅变化的时候整体替换
+        self.__table = dict()  # type: Dict[int, Tuple[Subscription, ...]]
+
+    @property
+    def active(self) -> bool:
+        return len(self.__subscriptions) > 0
+
+    def subscribe(self, subscription: Subscription) -> Subscription:
+        """
+        增加订阅
+
+        :param subscription: 订阅
+
+        :return: 传入的订阅
+        """
+        with self.__lock:
+            self.__subscriptions = self.__subscriptions + [subscription]
+            self.__table = dict()
+        subscription._bind(self)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        取消订阅
+
+        :param subscription: 订阅
+        """
+        with self.__lock:
+            self.__subscriptions = [x for x in self.__subscriptions if x is not subscription]
+            self.__table = dict()
+        subscription._bind(None)
+
+    def clear(self):
+        """
+        取消所有订阅
+        """
+        with self.__lock:
+            subscriptions = self.__subscriptions
+            self.__subscriptions = []
+            self.__table = dict()
+        for subscription in subscriptions:
+            subscription._bind(None)
+
+    def __compile(self, table: Dict[int, Tuple[Subscription, ...]], msg_id: int) -> Tuple[Subscription, ...]:
+        subscriptions = tuple(x for x in self.__subscriptions if x.match(msg_id))
+        table[msg_id] = subscriptions
+        return subscriptions
+
+    def dispatch(self, message: Message):
+        """
+        分发收到的帧，在接收线程中调用
+
+        :param message: 收到的帧
+        """
+        table = self.__table
+        subscriptions = table.get(message.msg_id)
+        if subscriptions is None:
+            subscriptions = self.__compile(table, message.msg_id)
+        for subscription in subscriptions:
+            try:
+                subscription.notify(message)
+            except Exception as e:
+                logger.error(f"subscription of {hex(message.msg_id)} handle failed, error is {e}")
@@ -7,12 +7,15 @@
 # @Created:     2021/5/1 - 23:39
 # --------------------------------------------------------
 # 导入所需模块
+import ctypes
+import platform
+import select
 from inspect import stack
 from ctypes import memmove, c_uint
-from typing import Sequence, Tuple
+from typing import Tuple, Optional, Sequence
 
 from . import pcanbasic
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
 from automotive.core.can.common.interfaces import BaseCanDevice
 from automotive.core.can.common.enums import BaudRateEnum
 from automotive.common.constant import check_connect, can_tips
@@ -64,13 +67,18 @@ class PCanDevice(BaseCanDevice):
         self.__channel = pcanbasic.PCAN_USBBUS1
         #  是否CANFD，如果是CANFD则调用canfd接口
         self.__is_fd = is_fd
+        # 接收事件，Windows下是事件句柄，Linux下是文件描述符，不支持的时候为None
+        self.__receive_event = None
+        self.__is_windows = platform.system() == "Windows"
 
-    def __init_device(self, baud_rate: int, channel: int):
+    def __init_device(self, baud_rate: int, data_rate: int, channel: int):
         """
         Initializes a PEAK CAN Channel
 
         :param baud_rate: 波特率
 
+        :param data_rate: CAN FD的数据段速率
+
         :param channel: A TPCANHandle representing a PEAK CAN Channel
         """
         # 由于目前peak can只支持单通道，所以无论设置还是不设置该值都是PCAN_USBBUS1
@@ -79,105 +87,115 @@ class PCanDevice(BaseCanDevice):
         else:
             raise RuntimeError("peak can only support 1 channel")
         btr0btr1 = baud_rate_list[baud_rate]
-        # TIPS: 目前只支持IPEH-002021 这个型号，该型号不支持CAN FD
+        # TIPS: 非即插即用的型号(如IPEH-002021)才需要hw_type、io_port和interrupt，CAN FD需要支持FD的型号
         hw_type = hw_types['ISA-82C200']
         io_port = io_ports['0100']
         interrupt = interrupts['11']
 
         if not self._is_open:
             if self.__is_fd:
-                ret = self.__can_basic.initialize_fd(channel, btr0btr1)
+                ret = self.__can_basic.initialize_fd(channel, self.__get_bit_rate_fd(baud_rate, data_rate))
             else:
                 ret = self.__can_basic.initialize(channel, btr0btr1, hw_type, io_port, interrupt)
             if ret == 0:
                 self._is_open = True
                 logger.debug(f"pcan is open success")
+                self.__receive_event = self.__create_receive_event(channel)
             else:
                 self._is_open = False
                 raise RuntimeError(f"Method <{stack()[0][3]}> Init PEAK CAN channel_{hex(channel.value)} Failed.")
 
     @staticmethod
-    def __data_package_fd(frame_length: int, message_id: int, send_type: int, data_length: int, data: Sequence):
+    def __get_message_type(message: Message) -> int:
         """
-        组包CAN FD发送数据，供VCI_Transmit函数使用。
-
-        :param frame_length: 帧长度
+        计算帧类型，在send_type的基础上增加扩展帧以及CAN FD的标志
 
-        :param message_id:  11/29-bit message identifier
+        :param message: 发送的帧
 
-        :param send_type: Type of the message
+        :return: TPCANMessageType的值
+        """
+        msg_type = message.send_type
+        if message.is_extended:
+            msg_type |= pcanbasic.PCAN_MESSAGE_EXTENDED.value
+        if message.is_fd_frame:
+            msg_type |= pcanbasic.PCAN_MESSAGE_FD.value | pcanbasic.PCAN_MESSAGE_BRS.value
+        return msg_type
+
+    def __data_package_fd(self, frame_length: int, message: Message):
+        """
+        组包CAN FD发送数据，供CAN_WriteFD函数使用。
 
-        :param data_length: Data Length Code of the message (0..8)
+        :param frame_length: 帧长度
 
-        :param data: Data of the message (DATA[0]..DATA[7])
+        :param message: 发送的帧，支持11/29-bit的ID以及最长64字节的数据
 
         :return: 返回组包的帧数据。
         """
         send_data = (pcanbasic.TPCANMsgFD * frame_length)()
-
+        data = bytes(message.data)
+        msg_type = self.__get_message_type(message)
         for i in range(frame_length):
             # 帧ID。32位变量，数据格式为靠右对齐
-            send_data[i].ID = c_uint(message_id)
-
-            # 发送帧类型。=0时为正常发送（发送失败会自动重发，重发最长时间为1.5-3秒）；
-            # =1时为单次发送（只发送一次，不自动重发）；
-            # 其它值无效。（二次开发，建议SendType=1，提高发送的响应速度）
-            send_data[i].MSGTYPE = pcanbasic.TPCANMessageType(send_type)
-
-            # 数据长度 DLC (<=8)，即CAN帧Data有几个字节。约束了后面Data[8]中的有效字节
-            send_data[i].DLC = data_length
-
+            send_data[i].ID = c_uint(message.msg_id)
+            # 帧类型，包含扩展帧、CAN FD、BRS等标志
+            send_data[i].MSGTYPE = pcanbasic.TPCANMessageType(msg_type)
+            # CAN FD的DLC不是数据长度，需要转换(0..15)
+            send_data[i].DLC = self._dlc[len(data)]
             # CAN帧的数据
-            a_data = (pcanbasic.TPCANMessageType * 8)()
-            for j, value in enumerate(data):
-                a_data[j] = pcanbasic.TPCANMessageType(value)
-            memmove(send_data[i].DATA, a_data, 8)
+            memmove(send_data[i].DATA, data, len(data))
         return send_data
 
-    @staticmethod
-    def __data_package(frame_length: int, message_id: int, send_type: int, data_length: int, data: Sequence):
+    def __data_package(self, frame_length: int, message: Message):
         """
-        组包CAN发送数据，供VCI_Transmit函数使用。
+        组包CAN发送数据，供CAN_Write函数使用。
 
         :param frame_length: 帧长度
 
-        :param message_id:  11/29-bit message identifier
-
-        :param send_type: Type of the message
-
-        :param data_length: Data Length Code of the message (0..8)
-
-        :param data: Data of the message (DATA[0]..DATA[7])
+        :param message: 发送的帧，支持11/29-bit的ID
 
         :return: 返回组包的帧数据。
         """
         send_data = (pcanbasic.TPCANMsg * frame_length)()
-
+        data = bytes(message.data)
+        if len(data) > 8:
+            raise RuntimeError(f"data length {len(data)} is larger than 8, please use can fd")
+        msg_type = self.__get_message_type(message)
         for i in range(frame_length):
             # 帧ID。32位变量，数据格式为靠右对齐
-            send_data[i].id = c_uint(message_id)
-
-            # 发送帧类型。=0时为正常发送（发送失败会自动重发，重发最长时间为1.5-3秒）；
-            # =1时为单次发送（只发送一次，不自动重发）；
-            # 其它值无效。（二次开发，建议SendType=1，提高发送的响应速度）
-            send_data[i].msg_type = pcanbasic.TPCANMessageType(send_type)
-
+            send_data[i].id = c_uint(message.msg_id)
+            # 帧类型。标准帧或者扩展帧
+            send_data[i].msg_type = pcanbasic.TPCANMessageType(msg_type)
             # 数据长度 DLC (<=8)，即CAN帧Data有几个字节。约束了后面Data[8]中的有效字节
-            send_data[i].len = data_length
-
+            send_data[i].len = len(data)
             # CAN帧的数据
-            a_data = (pcanbasic.TPCANMessageType * 8)()
-            for j, value in enumerate(data):
-                a_data[j] = pcanbasic.TPCANMessageType(value)
-            memmove(send_data[i].data, a_data, 8)
+            memmove(send_data[i].data, data, len(data))
         return send_data
 
+    @staticmethod
+    def __get_bit_rate_fd(baud_rate: int, data_rate: int) -> bytes:
+        """
+        生成CAN FD的波特率字符串，时钟为80MHz，仲裁段每位80个tq，数据段每位20个tq，采样点都是80%
+
+        :param baud_rate: 仲裁段速率，单位kbps
+
+        :param data_rate: 数据段速率，单位kbps
+
+        :return: FD bit rate string
+        """
+        clock = 80000
+        nom_brp, nom_rest = divmod(clock, baud_rate * 80)
+        data_brp, data_rest = divmod(clock, data_rate * 20)
+        if nom_rest or data_rest or nom_brp == 0 or data_brp == 0:
+            raise ValueError(f"baud rate {baud_rate}kbps and data rate {data_rate}kbps is not support")
+        return (f"f_clock_mhz=80, nom_brp={nom_brp}, nom_tseg1=63, nom_tseg2=16, nom_sjw=16, "
+                f"data_brp={data_brp}, data_tseg1=15, data_tseg2=4, data_sjw=4").encode("ascii")
+
     def open_device(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                     channel: int = 1):
         """
         打开Pcan设备
 
-        :param data_rate: DATA速率，对于目前的PCAN没有用
+        :param data_rate: DATA速率，仅CAN FD有用
         :param baud_rate: CAN速率，HIGH表示高速，LOW表示低速
 
         :param channel:
@@ -189,7 +207,41 @@ class PCanDevice(BaseCanDevice):
         logger.debug(f"baud_rate is {baud_rate}")
         if channel != 1:
             raise RuntimeError("pcan channel only support 1")
-        self.__init_device(baud_rate, channel)
+        self.__init_device(baud_rate, data_rate.value, channel)
+
+    def __create_receive_event(self, channel) -> Optional[int]:
+        """
+        设置PCAN_RECEIVE_EVENT，收到数据的时候驱动会触发该事件
+
+        Windows下需要创建事件并设置给驱动，Linux下从驱动获取可以select的文件描述符
+
+        :return: 事件句柄或者文件描述符，不支持的时候返回None
+        """
+        try:
+            if self.__is_windows:
+                kernel32 = ctypes.windll.kernel32
+                # 自动复位的事件
+                handle = kernel32.CreateEventW(None, 0, 0, None)
+                if not handle:
+                    return None
+                ret = self.__can_basic.set_value(channel, pcanbasic.PCAN_RECEIVE_EVENT, handle)
+                if ret != pcanbasic.PCAN_ERROR_OK:
+                    kernel32.CloseHandle(handle)
+                    return None
+                return handle
+            else:
+                ret, file_descriptor = self.__can_basic.get_value(channel, pcanbasic.PCAN_RECEIVE_EVENT)
+                return file_descriptor if ret == pcanbasic.PCAN_ERROR_OK else None
+        except Exception as e:
+            logger.debug(f"pcan receive event is not support, error is {e}")
+            return None
+
+    def __close_receive_event(self, channel):
+        event = self.__receive_event
+        self.__receive_event = None
+        if event is not None and self.__is_windows:
+            self.__can_basic.set_value(channel, pcanbasic.PCAN_RECEIVE_EVENT, 0)
+            ctypes.windll.kernel32.CloseHandle(event)
 
     def close_device(self):
         """
@@ -199,6 +251,7 @@ class PCanDevice(BaseCanDevice):
         """
         channel = self.__channel
         if self._is_open:
+            self.__close_receive_event(channel)
             ret = self.__can_basic.uninitialize(channel)
             if ret == pcanbasic.PCAN_ERROR_OK:
                 logger.debug(f"close pcan success")
@@ -278,6 +331,33 @@ class PCanDevice(BaseCanDevice):
         if ret != pcanbasic.PCAN_ERROR_OK:
             raise RuntimeError(f"Method <{stack()[0][3]}> Reset PEAK CAN Failed.")
 
+    @check_connect("_is_open", can_tips)
+    def set_receive_filter(self, ranges: Sequence[Tuple[int, int, bool]]) -> bool:
+        """
+        通过CAN_FilterMessages设置硬件滤波，每次调用都会扩大滤波的范围，所以先关闭滤波再依次设置每个范围
+
+        :param ranges: [(起始ID, 结束ID, 是否扩展帧), ...]，为空的时候打开滤波，接收所有的帧
+
+        :return: 设置了硬件滤波返回True
+        """
+        channel = self.__channel
+        if not ranges:
+            ret = self.__can_basic.set_value(channel, pcanbasic.PCAN_MESSAGE_FILTER, pcanbasic.PCAN_FILTER_OPEN)
+            if ret != pcanbasic.PCAN_ERROR_OK:
+                raise RuntimeError(f"open PEAK CAN filter failed, error code is {ret}")
+            return False
+        ret = self.__can_basic.set_value(channel, pcanbasic.PCAN_MESSAGE_FILTER, pcanbasic.PCAN_FILTER_CLOSE)
+        if ret != pcanbasic.PCAN_ERROR_OK:
+            raise RuntimeError(f"close PEAK CAN filter failed, error code is {ret}")
+        for start, end, is_extended in ranges:
+            mode = pcanbasic.PCAN_MODE_EXTENDED if is_extended else pcanbasic.PCAN_MODE_STANDARD
+            ret = self.__can_basic.filter_messages(channel, start, end, mode)
+            if ret != pcanbasic.PCAN_ERROR_OK:
+                # 设置失败的时候恢复接收所有的帧，由软件滤波过滤
+                self.__can_basic.set_value(channel, pcanbasic.PCAN_MESSAGE_FILTER, pcanbasic.PCAN_FILTER_OPEN)
+                raise RuntimeError(f"set PEAK CAN filter {hex(start)} - {hex(end)} failed, error code is {ret}")
+        return True
+
     @check_connect("_is_open", can_tips)
     def transmit(self, message: Message, channel: int = None):
         """
@@ -288,35 +368,27 @@ class PCanDevice(BaseCanDevice):
         :param channel:  A TPCANHandle representing a PEAK CAN Channel
         """
         channel = self.__channel if channel else pcanbasic.PCAN_USBBUS1
-        if self.__is_fd:
-            p_send = self.__data_package_fd(message.frame_length,
-                                            message.msg_id,
-                                            message.send_type,
-                                            message.data_length,
-                                            message.data)
-        else:
-            p_send = self.__data_package(message.frame_length,
-                                         message.msg_id,
-                                         message.send_type,
-                                         message.data_length,
-                                         message.data)
         try:
-            ret = self.__can_basic.write(channel, p_send)
+            if self.__is_fd:
+                ret = self.__can_basic.write_fd(channel, self.__data_package_fd(message.frame_length, message))
+            else:
+                ret = self.__can_basic.write(channel, self.__data_package(message.frame_length, message))
             if ret == pcanbasic.PCAN_ERROR_OK:
-                logger.trace(f"PEAK CAN channel_{hex(channel.value)} Transmit Success.")
+                if log_level.trace:
+                    logger.trace(f"PEAK CAN channel_{hex(channel.value)} Transmit Success.")
             else:
                 raise RuntimeError(f"PEAK CAN channel_{hex(channel.value)} Transmit Failed.")
         except Exception as e:
             raise RuntimeError(f'PEAK CAN transmit failed. error info is {e}')
 
     @check_connect("_is_open", can_tips)
-    def receive(self, channel: int = None) -> Tuple:
+    def receive(self, channel: int = None) -> Optional[Tuple]:
         """
         Reads a CAN message from the receive queue of a PEAK CAN Channel
 
         :param channel: A TPCANHandle representing a PEAK CAN Channel
 
-        :return: PeakCanMessage消息对象
+        :return: (PeakCanMessage消息对象, 时间)，接收队列为空的时候返回None
         """
         channel = self.__channel if channel else pcanbasic.PCAN_USBBUS1
         try:
@@ -324,10 +396,30 @@ class PCanDevice(BaseCanDevice):
                 ret, message, timestamp = self.__can_basic.read_fd(channel)
             else:
                 ret, message, timestamp = self.__can_basic.read(channel)
-            if ret == pcanbasic.PCAN_ERROR_OK:
-                logger.trace(f"PEAK CAN channel_{hex(channel.value)} Receive Success.")
-                return message, timestamp
-            else:
-                raise RuntimeError(f"Method <{stack()[0][3]}> PEAK CAN Receive Failed.")
         except Exception:
             raise RuntimeError('PEAK CAN receive failed.')
+        if ret == pcanbasic.PCAN_ERROR_OK:
+            if log_level.trace:
+                logger.trace(f"PEAK CAN channel_{hex(channel.value)} Receive Success.")
+            return message, timestamp
+        elif ret & pcanbasic.PCAN_ERROR_QRCVEMPTY:
+            return None
+        else:
+            raise RuntimeError(f"Method <{stack()[0][3]}> PEAK CAN Receive Failed, error code is {hex(ret)}.")
+
+    def wait_for_receive(self, timeout: float) -> Optional[bool]:
+        """
+        等待PCAN_RECEIVE_EVENT
+
+        :param timeout: 超时时间，单位秒
+
+        :return: 有数据返回True，超时返回False，不支持接收事件的时候返回None
+        """
+        event = self.__receive_event
+        if event is None:
+            return None
+        if self.__is_windows:
+            # WAIT_OBJECT_0
+            return ctypes.windll.kernel32.WaitForSingleObject(event, int(timeout * 1000)) == 0
+        readable, _, _ = select.select([event], [], [], timeout)
+        return len(readable) > 0
@@ -6,10 +6,8 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:39
 # --------------------------------------------------------
-from time import sleep
-from typing import Sequence
-
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
+from . import pcanbasic
 from .pcan import PCanDevice
 from automotive.core.can.common.interfaces import BaseCanBus
 from automotive.core.can.common.enums import BaudRateEnum
@@ -23,30 +21,13 @@ class PCanBus(BaseCanBus):
 
     def __init__(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                  channel_index: int = 1, can_fd: bool = False, max_workers: int = 300, need_receive: bool = True,
-                 is_uds_can_fd: bool = False):
-        if can_fd:
-            raise RuntimeError("pcan not support canfd")
+                 is_uds_can_fd: bool = False, use_scheduler: bool = False):
         super().__init__(baud_rate=baud_rate, data_rate=data_rate, channel_index=channel_index,
-                         can_fd=can_fd, max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd)
+                         can_fd=can_fd, max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd,
+                         use_scheduler=use_scheduler)
         # PCAN实例化
         self._can = PCanDevice(can_fd)
 
-    @staticmethod
-    def __get_data(data, length: int) -> Sequence:
-        """
-        转换pcan收的data为list
-
-        :param data: 收到的data数据
-
-        :param length:  长度
-
-        :return: 8byte的list对象
-        """
-        msg_data = []
-        for i in range(length):
-            msg_data.append(data[i])
-        return msg_data
-
     @staticmethod
     def __get_time_stamp(timestamp) -> int:
         """
@@ -63,37 +44,51 @@ class PCanBus(BaseCanBus):
         """
         获取message对象
 
-        :param message: message信息
+        :param message: message信息，CAN FD的时候是TPCANMsgFD
+
+        :param timestamp: 时间，CAN FD的时候是微秒数
 
         :return: PeakCanMessage对象
         """
         msg = Message()
-        msg.msg_id = message.id
-        msg.time_stamp = self.__get_time_stamp(timestamp)
-        msg.send_type = message.msg_type
-        msg.data_length = 8 if message.len > 8 else message.len
-        msg.data = self.__get_data(message.data, msg.data_length)
+        if self._can_fd:
+            msg.msg_id = message.ID
+            msg.time_stamp = timestamp.value // 1000
+            msg_type = message.MSGTYPE
+            msg.data_length = self._get_dlc_length(message.DLC)
+            # 直接从ctypes数组复制出bytes
+            msg.data = bytes(message.DATA)[:msg.data_length]
+        else:
+            msg.msg_id = message.id
+            msg.time_stamp = self.__get_time_stamp(timestamp)
+            msg_type = message.msg_type
+            msg.data_length = 8 if message.len > 8 else message.len
+            msg.data = bytes(message.data)[:msg.data_length]
+        msg.send_type = msg_type
+        msg.external_flag = 1 if msg_type & pcanbasic.PCAN_MESSAGE_EXTENDED.value else 0
+        msg.is_fd = bool(msg_type & pcanbasic.PCAN_MESSAGE_FD.value)
         return msg
 
-    def __receive(self):
+    def _read(self) -> int:
         """
-        CAN接收帧函数，在接收线程中执行
+        PCAN每次只能读取一帧，一直读取到接收队列为空
         """
-        while self._can.is_open and self._need_receive:
-            try:
-                receive_msg, timestamp = self._can.receive()
-                msg_id = receive_msg.id
-                logger.trace(f"msg id = {hex(msg_id)}")
-                receive_message = self.__get_message(receive_msg, timestamp)
-                self._receive_messages[msg_id] = receive_message
-                self._append(receive_message)
-                # UDS的时候自动发多帧的流控帧信号
-                self._handle_continue_frame(receive_message)
-            except RuntimeError as e:
-                logger.trace(e)
+        count = 0
+        receive_filter = self._receive_filter
+        while True:
+            result = self._can.receive()
+            if result is None:
+                return count
+            receive_msg, timestamp = result
+            count += 1
+            # CANFD的TPCANMsgFD只有ID
+            raw_id = receive_msg.ID if self._can_fd else receive_msg.id
+            # 被过滤的帧不构造Message，硬件滤波可能比软件滤波宽
+            if receive_filter and not receive_filter.accept(raw_id):
                 continue
-            finally:
-                sleep(0.001)
+            if log_level.trace:
+                logger.trace(f"msg id = {hex(raw_id)}")
+            self._handle_receive(self.__get_message(receive_msg, timestamp))
 
     def open_can(self):
         """
@@ -102,4 +97,4 @@ class PCanBus(BaseCanBus):
         super()._open_can()
         if self._need_start_receive:
             # 把接收函数submit到线程池中
-            self._receive_thread.append(self._thread_pool.submit(self.__receive))
+            self._receive_thread.append(self._thread_pool.submit(self._receive_loop))
@@ -9,15 +9,28 @@
 import ctypes
 import os
 import platform
-from ctypes import windll, byref, c_size_t, c_int32, c_ubyte, POINTER, cast, c_int, c_char_p, create_string_buffer
+from ctypes import windll, byref, c_size_t, c_int32, c_ubyte, c_int, c_char_p, create_string_buffer, memmove
+from threading import Lock
 from typing import Sequence, Tuple
 from .tsmasterbasic import TRUE, APP_CHANNEL, TLIBCANFDControllerMode, TLIBCANFDControllerType, TLibCAN, TLibCANFD, \
-    error_code
+    error_code, PROPERTY_TX, PROPERTY_EXTENDED, FD_PROPERTY_EDL, FD_PROPERTY_BRS
 from automotive.common.constant import tsmaster_control_decorator, check_connect, can_tips
 from automotive.core.can.common.interfaces import BaseCanDevice
 from automotive.core.can.common.enums import BaudRateEnum
 from automotive.core.can.message import Message
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
+
+"""
+同星CAN盒
+
+libTSCAN在一个进程中只能连接一次，多通道的时候每个通道一个TSMasterDevice，共用同一个连接(设备句柄)，
+
+第一个通道打开的时候连接，最后一个通道关闭的时候才释放libTSCAN，每个通道只配置和读写自己的通道
+"""
+
+# 进程中共用的连接，handler是设备句柄，count是打开的通道数量
+_connection = {"handler": None, "count": 0}
+_connection_lock = Lock()
 
 
 class TSMasterDevice(BaseCanDevice):
@@ -27,6 +40,11 @@ class TSMasterDevice(BaseCanDevice):
         self.__is_fd = is_fd
         self.__device_handler = c_size_t(0)
         self.__channel = None
+        # 接收缓存大小， 这个是IN OUT模式，即输入的2500不代表一定有这么多数据，这个只是一个最大值，在执行完成函数后在读取值能知道实际的数量
+        self.__buffer_size = 2500
+        # 预先分配好接收缓存，每次接收都复用，避免每1ms轮询一次就重新创建2500个结构体
+        self.__receive_buffer = ((TLibCANFD if is_fd else TLibCAN) * self.__buffer_size)()
+        self.__receive_size = c_int(self.__buffer_size)
         # 需要在硬件文档中查询获取
         self.__dll_path = self.__get_dll_path()
         logger.debug(f"use dll path is {self.__dll_path}")
@@ -115,55 +133,90 @@ class TSMasterDevice(BaseCanDevice):
     def __disconnect(self):
         return self.__lib_can.tsapp_disconnect()
 
-    def __data_package(self, data: Sequence, msg_id: int) -> TLibCAN:
+    def __connect(self) -> c_size_t:
+        """
+        连接CAN盒，已经有通道连接的时候直接使用原来的设备句柄
+
+        :return: 设备句柄
+        """
+        with _connection_lock:
+            if _connection["count"] == 0:
+                self.__open_device()
+                # 连接CAN盒
+                # //连接设备，ADeviceSerial !=NULL：连接指定的设备；ADeviceSerial == NULL：连接默认设备
+                # typedef uint32_t(__stdcall* tscan_connect_t)(const char* ADeviceSerial, size_t* AHandle);
+                # self.__lib_can.tscan_connect.argtypes = (CHAR_P, POINTER(U))
+                # self.__lib_can.tscan_connect.restype = c_uint
+                device_handler = c_size_t(0)
+                result = self.__lib_can.tscan_connect('', byref(device_handler))
+                if result != 0:
+                    raise RuntimeError(f"open tsmaster failed, result is {result}")
+                logger.info("ts master connect")
+                _connection["handler"] = device_handler
+            _connection["count"] += 1
+            return _connection["handler"]
+
+    def __release(self):
+        """
+        关闭一个通道，最后一个通道关闭的时候释放libTSCAN
+        """
+        with _connection_lock:
+            _connection["count"] -= 1
+            if _connection["count"] > 0:
+                logger.debug(f"{_connection['count']} channels still connected")
+                return
+            _connection["handler"] = None
+            logger.trace("tscan_disconnect_all_devices")
+            # //断开所有设备
+            # typedef c_uint(__stdcall* tscan_disconnect_all_devices_t)(void);
+            self.__lib_can.finalize_lib_tscan()
+
+    @staticmethod
+    def __get_properties(message: Message) -> int:
+        """
+        FProperties，bit0为发送方向，bit2为扩展帧
+        """
+        return PROPERTY_TX | PROPERTY_EXTENDED if message.is_extended else PROPERTY_TX
+
+    def __data_package(self, message: Message) -> TLibCAN:
+        data = bytes(message.data)
+        if len(data) > 8:
+            raise RuntimeError(f"data length {len(data)} is larger than 8, please use can fd")
         lib_can = TLibCAN()
         lib_can.FIdxChn = self.__channel - 1
-        lib_can.FIdentifier = msg_id
-        lib_can.FProperties = 1
+        lib_can.FIdentifier = message.msg_id
+        lib_can.FProperties = self.__get_properties(message)
         lib_can.FDLC = self._dlc[len(data)]
         # CAN帧的数据
-        for j, data in enumerate(data):
-            lib_can.FData[j] = data
+        memmove(lib_can.FData, data, len(data))
         return lib_can
 
-    def __data_package_fd(self, data: Sequence, msg_id: int) -> TLibCANFD:
+    def __data_package_fd(self, message: Message) -> TLibCANFD:
+        data = bytes(message.data)
         lib_can_fd = TLibCANFD()
         lib_can_fd.FIdxChn = self.__channel - 1
-        lib_can_fd.FIdentifier = msg_id
-        lib_can_fd.FProperties = 1
-        lib_can_fd.FFDProperties = 1
+        lib_can_fd.FIdentifier = message.msg_id
+        lib_can_fd.FProperties = self.__get_properties(message)
+        # CAN FD通道上都按照FD帧(EDL)发送，CAN FD的message使用BRS切换到数据段的速率
+        lib_can_fd.FFDProperties = FD_PROPERTY_EDL | FD_PROPERTY_BRS if message.is_fd_frame else FD_PROPERTY_EDL
         # DLC不是简单的长度，而需要对应关系
         lib_can_fd.FDLC = self._dlc[len(data)]
-        for j, data in enumerate(data):
-            lib_can_fd.FData[j] = data
-        logger.trace(f"dlc = {lib_can_fd.FDLC}")
+        memmove(lib_can_fd.FData, data, len(data))
+        if log_level.trace:
+            logger.trace(f"dlc = {lib_can_fd.FDLC}")
         return lib_can_fd
 
     def open_device(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                     channel: int = 1):
         self.__channel = channel
         if not self._is_open:
-            self.__open_device()
-            # 连接CAN盒
-            # //连接设备，ADeviceSerial !=NULL：连接指定的设备；ADeviceSerial == NULL：连接默认设备
-            # typedef uint32_t(__stdcall* tscan_connect_t)(const char* ADeviceSerial, size_t* AHandle);
-            # self.__lib_can.tscan_connect.argtypes = (CHAR_P, POINTER(U))
-            # self.__lib_can.tscan_connect.restype = c_uint
-            result = self.__lib_can.tscan_connect('', byref(self.__device_handler))
-            if result == 0:
-                logger.info("ts master connect")
-                self._is_open = True
-                self.__set_baud_rate(baud_rate.value, data_rate.value, channel)
-            else:
-                self._is_open = False
-                raise RuntimeError(f"open tsmaster failed, result is {result}")
+            self.__device_handler = self.__connect()
+            self._is_open = True
+            self.__set_baud_rate(baud_rate.value, data_rate.value, channel)
 
     def close_device(self):
         if self._is_open:
-            logger.trace("tscan_disconnect_all_devices")
-            # //断开所有设备
-            # typedef c_uint(__stdcall* tscan_disconnect_all_devices_t)(void);
-            self.__lib_can.finalize_lib_tscan()
+            self.__release()
             # 重置初始状态
             logger.trace("reset default variable value")
             self._is_open = False
@@ -190,8 +243,9 @@ class TSMasterDevice(BaseCanDevice):
     @check_connect("_is_open", can_tips)
     def transmit(self, message: Message):
         if self.__is_fd:
-            logger.trace("transmit by can fd")
-            etcan_fd = self.__data_package_fd(message.data, message.msg_id)
+            if log_level.trace:
+                logger.trace("transmit by can fd")
+            etcan_fd = self.__data_package_fd(message)
             # //异步发送CANFD报文
             # typedef c_uint(__stdcall* tscan_transmit_canfd_async_t)(const size_t ADeviceHandle,
             # const TLibCANFD* ACAN);
@@ -199,19 +253,40 @@ class TSMasterDevice(BaseCanDevice):
             if result != 0:
                 raise RuntimeError(f"transmit can fd failed. error code is {result}")
         else:
-            logger.trace("transmit by can")
-            etcan = self.__data_package(message.data, message.msg_id)
+            if log_level.trace:
+                logger.trace("transmit by can")
+            etcan = self.__data_package(message)
             # //异步发送CAN报文
             # typedef c_uint(__stdcall* tscan_transmit_can_async_t)(const size_t ADeviceHandle, const TLibCAN* ACAN);
             result = self.__lib_can.tscan_transmit_can_async(self.__device_handler, etcan)
             if result != 0:
                 raise RuntimeError(f"transmit failed. error code is {result}")
 
+    @check_connect("_is_open", can_tips)
+    def transmit_many(self, messages: Sequence[Message]):
+        # libTSCAN只有单帧的异步发送接口，这里先把所有帧组包到一个连续的数组中，再依次异步发送，减少每一帧的组包和查找函数的开销
+        if self.__is_fd:
+            frames = (TLibCANFD * len(messages))(*[self.__data_package_fd(x) for x in messages])
+            transmit_function = self.__lib_can.tscan_transmit_canfd_async
+        else:
+            frames = (TLibCAN * len(messages))(*[self.__data_package(x) for x in messages])
+            transmit_function = self.__lib_can.tscan_transmit_can_async
+        failed = []
+        for message, frame in zip(messages, frames):
+            result = transmit_function(self.__device_handler, byref(frame))
+            if result != 0:
+                failed.append(hex(message.msg_id))
+        if failed:
+            raise RuntimeError(f"transmit {failed} failed")
+
     @check_connect("_is_open", can_tips)
     def receive(self) -> Tuple:
-        # 设置缓存大小， 这个是IN OUT模式，即输入的2500不代表一定有这么多数据，这个只是一个最大值，在执行完成函数后在读取值能知道实际的数量
-        buffer_size = 2500
-        p_buffer_size = byref(c_int(buffer_size))
+        """
+        接收CAN消息
+
+        :return: (实际收到的数量, 接收缓存)，接收缓存每次都会复用，需要在下一次调用receive之前处理完成
+        """
+        self.__receive_size.value = self.__buffer_size
         if self.__is_fd:
             # //读取CANFD报文
             # //ADeviceHandle：设备句柄；ACANBuffers:存储接收报文的数组；ACANBufferSize：存储数组的长度
@@ -219,11 +294,9 @@ class TSMasterDevice(BaseCanDevice):
             # typedef c_uint(__stdcall* tsfifo_receive_canfd_msgs_t)(const size_t ADeviceHandle,
             # const TLibCANFD* ACANBuffers, c_uint ACANBufferSize, c_uint8 AChn, c_uint8 ARXTX);
             # 0-RX, 1-TX
-            p_receive = [TLibCANFD() for _ in range(buffer_size)]
-            data = POINTER(TLibCANFD * len(p_receive))((TLibCANFD * len(p_receive))(*p_receive))
             result = self.__lib_can.tsfifo_receive_canfd_msgs(self.__device_handler,
-                                                              data,
-                                                              p_buffer_size,
+                                                              byref(self.__receive_buffer),
+                                                              byref(self.__receive_size),
                                                               APP_CHANNEL[self.__channel],
                                                               c_ubyte(0))
         else:
@@ -233,20 +306,14 @@ class TSMasterDevice(BaseCanDevice):
             # typedef c_uint(__stdcall* tsfifo_receive_can_msgs_t)(const size_t ADeviceHandle,
             # const TLibCAN* ACANBuffers, c_uint ACANBufferSize, c_uint8 AChn, c_uint8 ARXTX);
             # 0-RX, 1-TX
-            # p_receive = (TLibCAN * buffer_size)()
-            # temp_size = copy.copy(p_buffer_size)
-            p_receive = [TLibCAN() for _ in range(buffer_size)]
-            data = POINTER(TLibCAN * len(p_receive))((TLibCAN * len(p_receive))(*p_receive))
             result = self.__lib_can.tsfifo_receive_can_msgs(self.__device_handler,
-                                                            data,
-                                                            p_buffer_size,
+                                                            byref(self.__receive_buffer),
+                                                            byref(self.__receive_size),
                                                             APP_CHANNEL[self.__channel],
                                                             c_ubyte(0))
         if result == 0:
             # 真实收到的数据长度
-            cast_value = cast(p_buffer_size, POINTER(c_int32)).contents.value
-            # print(cast_value)
-            return cast_value, data.contents
+            return min(self.__receive_size.value, self.__buffer_size), self.__receive_buffer
         else:
             raise RuntimeError(f"receive failed, frame receive count is {result}")
 
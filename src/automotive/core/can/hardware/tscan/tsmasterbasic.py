@@ -11,6 +11,13 @@ from ctypes import c_int, c_uint8, c_int32, c_uint64, Structure, c_ubyte, c_ulon
 TRUE = c_int(1)
 FALSE = c_int(0)
 
+# TCANProperty，bit0为发送方向(1为TX)，bit2为扩展帧
+PROPERTY_TX = 0x01
+PROPERTY_EXTENDED = 0x04
+# TCANFDProperty，bit0为EDL(CAN FD帧)，bit1为BRS
+FD_PROPERTY_EDL = 0x01
+FD_PROPERTY_BRS = 0x02
+
 APP_CHANNEL = {
     1: c_int(0),
     2: c_int(1),
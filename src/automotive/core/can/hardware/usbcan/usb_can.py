@@ -18,7 +18,7 @@ from typing import Tuple, Sequence, Optional
 
 from automotive.core.can.hardware.usbcan.usb_can_basic import band_rate_list, VciInitConfig, UCHAR, DWORD, UINT, BYTE, \
     VciCanObj, VciBoardInfo
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
 from automotive.core.can.common.interfaces import BaseCanDevice
 from automotive.core.can.common.enums import BaudRateEnum, CanBoxDeviceEnum
 from automotive.common.constant import control_decorator, check_connect, can_tips
@@ -54,6 +54,9 @@ class UsbCanDevice(BaseCanDevice):
             self.__lib_can = windll.LoadLibrary(self.__dll_path)
         else:
             raise RuntimeError("can not support linux")
+        self.__lib_can.VCI_Receive.restype = c_long
+        # 复用的接收缓存，避免每次接收都重新分配
+        self.__receive_buffer = (VciCanObj * 2500)()
         self.__start_time = 0
         self.__device_type = device_type
         self.__device_index = device_index
@@ -187,7 +190,7 @@ class UsbCanDevice(BaseCanDevice):
         return self.__lib_can.VCI_InitCAN(self.__device_type, self.__device_index, self.__can_index, byref(init_config))
 
     def __data_package(self, frame_length: int, message_id: int, time_flag: int, send_type: int, remote_flag: int,
-                       external_flag: int, data_length: int, data: list, reserve: Optional[Sequence]):
+                       external_flag: int, data_length: int, data: bytes, reserve: Optional[Sequence]):
         """
         组包CAN发送数据，供VCI_Transmit函数使用。
 
@@ -219,7 +222,7 @@ class UsbCanDevice(BaseCanDevice):
 
         :param data:  data
 
-            CAN帧的数据。由于CAN规定了最大是8个字节，所以这里预留了8个字节的空间
+            CAN帧的数据(bytes)。由于CAN规定了最大是8个字节，所以这里预留了8个字节的空间
 
             受data_length约束。如data_length定义为3，即Data[0]、 Data[1]、 Data[2]是有效的。
 
@@ -257,10 +260,7 @@ class UsbCanDevice(BaseCanDevice):
             send_data[i].data_len = data_length
 
             # CAN帧的数据
-            a_data = (BYTE * 8)()
-            for j, value in enumerate(data):
-                a_data[j] = BYTE(value)
-            memmove(send_data[i].data, a_data, 8)
+            memmove(send_data[i].data, data, len(data))
 
             # 系统保留
             r_data = (BYTE * 3)()
@@ -447,20 +447,24 @@ class UsbCanDevice(BaseCanDevice):
         time_flag = 1
         # USB CAN特有的属性
         remote_flag = 0
-        # USB CAN特有的属性
-        external_flag = 0
+        # 是否是扩展帧
+        external_flag = 1 if message.is_extended else 0
         # 信号保留字
         reserved = None
+        data = bytes(message.data)
+        if len(data) > 8:
+            raise RuntimeError(f"data length {len(data)} is larger than 8, usb can not support can fd")
         p_send = self.__data_package(message.frame_length, message.msg_id, time_flag, usb_can_send_type,
-                                     remote_flag, external_flag, message.data_length, message.data,
-                                     reserved)
+                                     remote_flag, external_flag, len(data), data, reserved)
         self.__lib_can.VCI_Transmit.restype = DWORD
         try:
             ret = self.__lib_can.VCI_Transmit(self.__device_type, self.__device_index, self.__can_index, byref(p_send),
                                               message.frame_length)
-            logger.trace(f"ret = {ret}")
+            if log_level.trace:
+                logger.trace(f"ret = {ret}")
             if ret > 0:
-                logger.trace(f"Usb CAN CAN{self.__can_index} Transmit Success.")
+                if log_level.trace:
+                    logger.trace(f"Usb CAN CAN{self.__can_index} Transmit Success.")
             elif ret == 0:
                 raise RuntimeError(f"Usb CAN CAN{self.__can_index} Transmit Failed.")
             elif ret == -1:
@@ -490,18 +494,18 @@ class UsbCanDevice(BaseCanDevice):
         :param wait_time: 保留参数。
 
 
-        :return: 返回实际读取的帧数
+        :return: (实际读取的帧数, 接收缓存)，没有数据的时候帧数为0，接收缓存每次都会复用
         """
-        p_receive = (VciCanObj * frame_length)()
-        self.__lib_can.VCI_Receive.restype = c_long
+        if len(self.__receive_buffer) != frame_length:
+            self.__receive_buffer = (VciCanObj * frame_length)()
+        p_receive = self.__receive_buffer
         try:
             ret = self.__lib_can.VCI_Receive(self.__device_type, self.__device_index, self.__can_index,
                                              byref(p_receive), frame_length, wait_time)
-            if ret > 0:
-                logger.trace(f"Usb CAN CAN{self.__can_index} Receive Success.")
+            if ret >= 0:
+                if log_level.trace:
+                    logger.trace(f"Usb CAN CAN{self.__can_index} Receive {ret} frames.")
                 return ret, p_receive
-            elif ret == 0:
-                raise RuntimeError(f"Usb CAN CAN{self.__can_index} Transmit Failed.")
             elif ret == -1:
                 reason = stack()[0][3]
                 raise RuntimeError(f"Method <{reason}> Usb CAN not exist.")
@@ -6,10 +6,7 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:44
 # --------------------------------------------------------
-from time import sleep
-from typing import Sequence
-
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
 from .usb_can import UsbCanDevice
 from automotive.core.can.common.interfaces import BaseCanBus
 from automotive.core.can.common.enums import CanBoxDeviceEnum, BaudRateEnum
@@ -23,9 +20,11 @@ class UsbCanBus(BaseCanBus):
 
     def __init__(self, can_box_device: CanBoxDeviceEnum, baud_rate: BaudRateEnum = BaudRateEnum.HIGH,
                  data_rate: BaudRateEnum = BaudRateEnum.DATA, channel_index: int = 1, can_fd: bool = False,
-                 max_workers: int = 300, need_receive: bool = True, is_uds_can_fd: bool = False):
+                 max_workers: int = 300, need_receive: bool = True, is_uds_can_fd: bool = False,
+                 use_scheduler: bool = False):
         super().__init__(baud_rate=baud_rate, data_rate=data_rate, channel_index=channel_index, can_fd=can_fd,
-                         max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd)
+                         max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd,
+                         use_scheduler=use_scheduler)
         if self._can_fd:
             raise RuntimeError("usb can not support can fd")
         # USB CAN BOX实例化
@@ -33,22 +32,6 @@ class UsbCanBus(BaseCanBus):
         # Default TimeStamp有效
         self.__time_flag = 1
 
-    @staticmethod
-    def __get_data(data, length: int) -> Sequence:
-        """
-        转换CAN BOX收的data为list
-
-        :param data: 收到的data数据
-
-        :param length:  长度
-
-        :return: 8byte的列表
-        """
-        msg_data = []
-        for i in range(length):
-            msg_data.append(data[i])
-        return msg_data
-
     @staticmethod
     def __get_reserved(reserved_value) -> list:
         """
@@ -82,35 +65,35 @@ class UsbCanBus(BaseCanBus):
         msg.external_flag = p_receive.extern_flag
         msg.reserved = self.__get_reserved(p_receive.reserved)
         msg.data_length = 8 if p_receive.data_len > 8 else p_receive.data_len
-        msg.data = self.__get_data(p_receive.data, msg.data_length)
+        # 直接从ctypes数组复制出bytes
+        msg.data = bytes(p_receive.data)[:msg.data_length]
         return msg
 
-    def __receive(self):
+    def _read(self) -> int:
         """
-        CAN接收帧函数，在接收线程中执行
+        读取接收缓存中所有的帧，一次读满接收缓存的时候继续读取
+
+        :return: 读取的帧数
         """
-        while self._can.is_open and self._need_receive:
-            try:
-                ret, p_receive = self._can.receive()
+        total = 0
+        receive_filter = self._receive_filter
+        while True:
+            ret, p_receive = self._can.receive()
+            if log_level.trace:
                 logger.trace(f"return size is {ret}")
-                for i in range(ret):
-                    receive_message = self.__get_message(p_receive[i])
+            for i in range(ret):
+                frame = p_receive[i]
+                # 被过滤的帧不构造Message
+                if receive_filter and not receive_filter.accept(frame.id):
+                    continue
+                receive_message = self.__get_message(frame)
+                if log_level.trace:
                     logger.trace(f"msg id = {hex(receive_message.msg_id)}")
-                    # 单帧数据
-                    if receive_message.external_flag == 0:
-                        # 获取数据并保存到self._receive_msg字典中
-                        self._receive_messages[receive_message.msg_id] = receive_message
-                        self._append(receive_message)
-                        # UDS的时候自动发多帧的流控帧信号
-                        self._handle_continue_frame(receive_message)
-                    # 扩展帧
-                    else:
-                        logger.debug("type is external frame, not implement")
-            except RuntimeError as e:
-                logger.trace(e)
-                continue
-            finally:
-                sleep(0.001)
+                # 标准帧和扩展帧(external_flag为1)都交给上层处理
+                self._handle_receive(receive_message)
+            total += ret
+            if ret < len(p_receive):
+                return total
 
     def open_can(self):
         """
@@ -119,4 +102,4 @@ class UsbCanBus(BaseCanBus):
         super()._open_can()
         if self._need_start_receive:
             # 把接收函数submit到线程池中
-            self._receive_thread.append(self._thread_pool.submit(self.__receive))
+            self._receive_thread.append(self._thread_pool.submit(self._receive_loop))
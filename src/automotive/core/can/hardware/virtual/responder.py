@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        responder.py
+# @Author:      lizhe
+# @Created:     2023/3/26 - 15:12
+# --------------------------------------------------------
+from abc import ABCMeta, abstractmethod
+from typing import List, Tuple, Sequence, Optional
+
+from automotive.logger.logger import logger
+
+"""
+虚拟CAN总线上模拟的ECU
+
+虚拟设备每发送一帧，都会交给挂在总线上的responder处理，responder返回的帧会广播到整个虚拟总线上
+"""
+
+# 返回的帧，(msg_id, data)
+Frame = Tuple[int, List[int]]
+
+
+class BaseResponder(metaclass=ABCMeta):
+    """
+    模拟ECU的基类
+    """
+
+    @abstractmethod
+    def handle(self, msg_id: int, data: Sequence[int]) -> List[Frame]:
+        """
+        处理总线上的一帧数据
+
+        :param msg_id: msg id
+
+        :param data: 数据
+
+        :return: 需要返回的帧，不需要返回的时候为空列表
+        """
+        pass
+
+
+class EchoResponder(BaseResponder):
+    """
+    收到request_id的帧以后，原样用response_id返回
+    """
+
+    def __init__(self, request_id: int, response_id: int):
+        self.__request_id = request_id
+        self.__response_id = response_id
+
+    def handle(self, msg_id: int, data: Sequence[int]) -> List[Frame]:
+        if msg_id == self.__request_id:
+            return [(self.__response_id, list(data))]
+        return []
+
+
+class IsoTpEchoResponder(BaseResponder):
+    """
+    按照ISO 15765-2收发多帧的UDS应答器
+
+    收到完整的请求后，把请求原样返回，第一个字节(SID)加0x40作为肯定响应
+
+    请求是多帧的时候会在收到首帧以后回复流控帧，响应是多帧的时候会等待测试端的流控帧再发送连续帧
+    """
+
+    def __init__(self, request_id: int, response_id: int, function_id: Optional[int] = None, can_fd: bool = False,
+                 padding: int = 0xAA):
+        """
+        :param request_id: 物理寻址的请求ID
+
+        :param response_id: 响应ID
+
+        :param function_id: 功能寻址的请求ID
+
+        :param can_fd: 是否是CANFD，决定每帧的长度
+
+        :param padding: 填充字节
+        """
+        self.__request_ids = {request_id} if function_id is None else {request_id, function_id}
+        self.__response_id = response_id
+        self.__size = 64 if can_fd else 8
+        self.__padding = padding
+        # 正在接收的多帧请求
+        self.__request = []
+        self.__request_length = 0
+        self.__sequence = 0
+        # 等待流控帧才能发送的连续帧
+        self.__pending = []
+
+    def __pad(self, data: List[int]) -> List[int]:
+        return data + [self.__padding] * (self.__size - len(data))
+
+    def __segment(self, payload: List[int]) -> List[List[int]]:
+        """
+        把响应拆分成单帧或者首帧加连续帧
+        """
+        length = len(payload)
+        if length < self.__size:
+            if length <= 7:
+                return [self.__pad([length] + payload)]
+            return [self.__pad([0x00, length] + payload)]
+        first_size = self.__size - 2
+        frames = [[0x10 | ((length >> 8) & 0x0F), length & 0xFF] + payload[:first_size]]
+        sequence = 1
+        for index in range(first_size, length, self.__size - 1):
+            frames.append(self.__pad([0x20 | (sequence & 0x0F)] + payload[index:index + self.__size - 1]))
+            sequence += 1
+        return frames
+
+    def __response(self, payload: List[int]) -> List[Frame]:
+        logger.debug(f"virtual ecu receive request {[hex(x) for x in payload]}")
+        if len(payload) == 0:
+            return []
+        if payload[0] == 0x3E and len(payload) > 1 and payload[1] & 0x80:
+            # 3E 80不需要响应
+            return []
+        response = [(payload[0] + 0x40) & 0xFF] + payload[1:]
+        frames = self.__segment(response)
+        self.__pending = frames[1:]
+        return [(self.__response_id, frames[0])]
+
+    def handle(self, msg_id: int, data: Sequence[int]) -> List[Frame]:
+        if msg_id not in self.__request_ids or len(data) == 0:
+            return []
+        data = list(data)
+        frame_type = data[0] >> 4
+        if frame_type == 0:
+            # 单帧，长度为0表示是CANFD的长单帧
+            length = data[0] if data[0] != 0 else data[1]
+            start = 1 if data[0] != 0 else 2
+            return self.__response(data[start:start + length])
+        elif frame_type == 1:
+            # 首帧，回复流控帧
+            self.__request_length = ((data[0] & 0x0F) << 8) | data[1]
+            self.__request = data[2:]
+            self.__sequence = 1
+            return [(self.__response_id, self.__pad([0x30, 0x00, 0x00]))]
+        elif frame_type == 2:
+            # 连续帧
+            if (data[0] & 0x0F) != (self.__sequence & 0x0F) or self.__request_length == 0:
+                logger.debug(f"unexpected continue frame {[hex(x) for x in data]}")
+                return []
+            self.__sequence += 1
+            self.__request += data[1:]
+            if len(self.__request) >= self.__request_length:
+                payload = self.__request[:self.__request_length]
+                self.__request = []
+                self.__request_length = 0
+                return self.__response(payload)
+            return []
+        elif frame_type == 3:
+            # 测试端的流控帧，发送剩下的连续帧
+            frames = [(self.__response_id, frame) for frame in self.__pending]
+            self.__pending = []
+            return frames
+        return []
@@ -0,0 +1,370 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        virtual.py
+# @Author:      lizhe
+# @Created:     2023/3/26 - 14:37
+# --------------------------------------------------------
+import heapq
+import os
+import random
+import socket
+import struct
+from threading import Lock, Thread, Condition, Event
+from time import perf_counter_ns, sleep
+from typing import Tuple, List, Dict, Set, Sequence, Optional
+
+from automotive.common.constant import check_connect, can_tips
+from automotive.core.can.common.interfaces import BaseCanDevice
+from automotive.core.can.common.constant import dlc, MAX_STANDARD_ID, EXTENDED_ID_FLAG
+from automotive.core.can.common.enums import BaudRateEnum
+from automotive.core.can.message import Message
+from automotive.logger.logger import logger
+from .responder import BaseResponder, Frame
+
+"""
+虚拟CAN设备
+
+不需要任何硬件和DLL，用于在没有CAN盒的机器上调试和压测CANService。
+
+1、发送的帧会回环给自己(loopback)，并广播给同一个虚拟网络上的其他设备，可以设置延时(latency)
+
+2、可以设置错误率(error_rate)，按概率让发送失败
+
+3、可以注入总线负载(bus_load)，按每秒帧数随机产生其他节点的报文
+
+4、可以挂载模拟的ECU(responder)，比如IsoTpEchoResponder可以响应UDS诊断
+
+5、同一个进程中的多个设备通过共享的字典组网，不同进程之间的设备通过本机的UDP组播组网(use_socket)
+
+网络按照network和通道区分，同一个network同一个通道的设备才能互相收到数据
+
+扩展帧在网络上传输的时候ID的最高位为1(EXTENDED_ID_FLAG)，数据使用bytes保存
+"""
+
+# 组播地址和端口
+_multicast_group = "239.255.67.78"
+_multicast_port = 47808
+# 组播报文格式: 发送者ID、网络名称长度、msg_id、数据长度，后面依次是网络名称和数据
+_packet_header = struct.Struct("<QBIB")
+
+# 进程内的虚拟网络
+_networks = dict()  # type: Dict[str, Set["VirtualCanDevice"]]
+_networks_lock = Lock()
+
+
+class VirtualCanDevice(BaseCanDevice):
+
+    def __init__(self, is_fd: bool = False, network: str = "virtual", latency: float = 0, error_rate: float = 0,
+                 bus_load: int = 0, loopback: bool = True, use_socket: bool = False):
+        """
+        :param is_fd: 是否CANFD
+
+        :param network: 虚拟网络的名称
+
+        :param latency: 收到数据的延时，单位毫秒
+
+        :param error_rate: 发送失败的概率，0~1
+
+        :param bus_load: 注入的总线负载，每秒帧数
+
+        :param loopback: 发送的帧是否回环给自己
+
+        :param use_socket: 是否通过UDP组播和其他进程中的虚拟设备组网
+        """
+        super().__init__()
+        self.__is_fd = is_fd
+        self.__network = network
+        self.__latency = latency
+        self.__error_rate = error_rate
+        self.__bus_load = bus_load
+        self.__loopback = loopback
+        self.__use_socket = use_socket
+        # 注入负载使用的msg id
+        self.load_ids = list(range(0x600, 0x680))
+        self.__responders = []  # type: List[BaseResponder]
+        # 按照到达时间排列的接收队列，每一项是(到达时间, 序号, msg_id, data)
+        self.__queue = []
+        self.__counter = 0
+        self.__lock = Lock()
+        # 有数据放入队列的时候唤醒wait_for_receive
+        self.__condition = Condition(self.__lock)
+        # 多通道会话的接收事件，有数据放入队列的时候set
+        self.__receive_event = None  # type: Optional[Event]
+        self.__channel_name = None
+        self.__start_time = 0
+        self.__socket = None
+        self.__threads = []
+        # 区分组播中自己发出的报文
+        self.__sender_id = (os.getpid() << 32) | (id(self) & 0xFFFFFFFF)
+
+    @property
+    def latency(self) -> float:
+        return self.__latency
+
+    @latency.setter
+    def latency(self, latency: float):
+        self.__latency = latency
+
+    @property
+    def error_rate(self) -> float:
+        return self.__error_rate
+
+    @error_rate.setter
+    def error_rate(self, error_rate: float):
+        if not 0 <= error_rate <= 1:
+            raise ValueError(f"error rate must in [0, 1], but now is {error_rate}")
+        self.__error_rate = error_rate
+
+    @property
+    def bus_load(self) -> int:
+        return self.__bus_load
+
+    @bus_load.setter
+    def bus_load(self, bus_load: int):
+        self.__bus_load = bus_load
+
+    @property
+    def network(self) -> str:
+        return self.__network
+
+    @network.setter
+    def network(self, network: str):
+        if self._is_open:
+            raise RuntimeError("network can only be changed before open device")
+        self.__network = network
+
+    @property
+    def use_socket(self) -> bool:
+        return self.__use_socket
+
+    @use_socket.setter
+    def use_socket(self, use_socket: bool):
+        if self._is_open:
+            raise RuntimeError("use_socket can only be changed before open device")
+        self.__use_socket = use_socket
+
+    def add_responder(self, responder: BaseResponder):
+        """
+        在虚拟总线上挂载一个模拟的ECU
+
+        :param responder: 模拟的ECU
+        """
+        self.__responders.append(responder)
+
+    def clear_responders(self):
+        """
+        移除所有模拟的ECU
+        """
+        self.__responders.clear()
+
+    def __get_time_stamp(self) -> int:
+        """
+        从打开设备开始计算的时间，单位微秒
+        """
+        return (perf_counter_ns() - self.__start_time) // 1000
+
+    def _put(self, msg_id: int, data: Sequence[int]):
+        """
+        把一帧数据放到接收队列中，延时latency毫秒以后才能收到
+
+        :param msg_id: msg id
+
+        :param data: 数据
+        """
+        arrive_time = perf_counter_ns() + int(self.__latency * 1000000)
+        with self.__condition:
+            self.__counter += 1
+            heapq.heappush(self.__queue, (arrive_time, self.__counter, msg_id, bytes(data)))
+            self.__condition.notify_all()
+        receive_event = self.__receive_event
+        if receive_event:
+            receive_event.set()
+
+    def __get_peers(self) -> List["VirtualCanDevice"]:
+        with _networks_lock:
+            return list(_networks.get(self.__channel_name, ()))
+
+    def __broadcast(self, msg_id: int, data: Sequence[int], include_self: bool):
+        """
+        把一帧数据广播到虚拟网络上
+        """
+        for device in self.__get_peers():
+            if device is not self or include_self:
+                device._put(msg_id, data)
+        if self.__socket:
+            name = self.__channel_name.encode("utf-8")
+            packet = _packet_header.pack(self.__sender_id, len(name), msg_id, len(data)) + name + bytes(data)
+            try:
+                self.__socket.sendto(packet, (_multicast_group, _multicast_port))
+            except OSError as e:
+                logger.debug(f"send virtual frame by socket failed, error is {e}")
+
+    def __respond(self, frames: List[Frame]):
+        for msg_id, data in frames:
+            if msg_id > MAX_STANDARD_ID:
+                msg_id |= EXTENDED_ID_FLAG
+            # 模拟的ECU是总线上的其他节点，所以自己也能收到
+            self.__broadcast(msg_id, data, True)
+
+    def __open_socket(self):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(("", _multicast_port))
+        local = socket.inet_aton("127.0.0.1")
+        membership = struct.pack("4s4s", socket.inet_aton(_multicast_group), local)
+        self.__socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.__socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, local)
+        self.__socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.__socket.settimeout(0.1)
+
+    def __socket_receive(self):
+        """
+        接收其他进程中虚拟设备发出的数据
+        """
+        while self._is_open:
+            try:
+                packet, _ = self.__socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sender_id, name_length, msg_id, length = _packet_header.unpack_from(packet)
+            if sender_id == self.__sender_id:
+                continue
+            offset = _packet_header.size
+            name = packet[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            if name != self.__channel_name:
+                continue
+            # 来自其他进程的设备，同进程的设备在__broadcast中已经直接放到队列中了
+            if sender_id >> 32 == os.getpid():
+                continue
+            self._put(msg_id, packet[offset:offset + length])
+
+    def __inject_load(self):
+        """
+        按照bus_load注入其他节点的报文
+        """
+        size = 64 if self.__is_fd else 8
+        last_time = perf_counter_ns()
+        remain = 0.0
+        while self._is_open:
+            sleep(0.001)
+            current_time = perf_counter_ns()
+            remain += self.__bus_load * (current_time - last_time) / 1e9
+            last_time = current_time
+            while remain >= 1:
+                remain -= 1
+                data = [random.randint(0, 0xFF) for _ in range(size)]
+                self.__broadcast(random.choice(self.load_ids), data, True)
+
+    def open_device(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
+                    channel: int = 1):
+        if self._is_open:
+            return
+        self.__channel_name = f"{self.__network}:{channel}"
+        self.__start_time = perf_counter_ns()
+        with _networks_lock:
+            _networks.setdefault(self.__channel_name, set()).add(self)
+        self._is_open = True
+        if self.__use_socket:
+            self.__open_socket()
+            self.__threads.append(Thread(target=self.__socket_receive, daemon=True))
+        self.__threads.append(Thread(target=self.__inject_load, daemon=True))
+        for thread in self.__threads:
+            thread.start()
+        logger.debug(f"virtual can device open on {self.__channel_name}")
+
+    def close_device(self):
+        if not self._is_open:
+            return
+        self._is_open = False
+        with _networks_lock:
+            devices = _networks.get(self.__channel_name, set())
+            devices.discard(self)
+            if len(devices) == 0:
+                _networks.pop(self.__channel_name, None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads.clear()
+        if self.__socket:
+            self.__socket.close()
+            self.__socket = None
+        with self.__condition:
+            self.__queue.clear()
+            self.__condition.notify_all()
+        logger.debug(f"virtual can device close")
+
+    @check_connect("_is_open", can_tips)
+    def read_board_info(self) -> str:
+        return f"virtual can device on {self.__channel_name}"
+
+    @check_connect("_is_open", can_tips)
+    def reset_device(self):
+        with self.__lock:
+            self.__queue.clear()
+
+    @check_connect("_is_open", can_tips)
+    def transmit(self, message: Message):
+        size = 64 if self.__is_fd else 8
+        data = bytes(message.data)
+        if len(data) > size or len(data) not in dlc:
+            raise RuntimeError(f"data length {len(data)} is not support, max length is {size}")
+        if self.__error_rate and random.random() < self.__error_rate:
+            raise RuntimeError(f"transmit {hex(message.msg_id)} failed, error is injected by virtual device")
+        frame_id = message.msg_id | EXTENDED_ID_FLAG if message.is_extended else message.msg_id
+        self.__broadcast(frame_id, data, self.__loopback)
+        for responder in self.__responders:
+            frames = responder.handle(message.msg_id, data)
+            if frames:
+                self.__respond(frames)
+
+    @check_connect("_is_open", can_tips)
+    def receive(self) -> Tuple[int, List[Tuple[int, int, bytes]]]:
+        """
+        接收已经到达的数据
+
+        :return: (数量, [(时间戳(微秒), msg_id, data), ...])，没有数据的时候数量为0，扩展帧的msg_id带有EXTENDED_ID_FLAG
+        """
+        current_time = perf_counter_ns()
+        frames = []
+        with self.__lock:
+            while self.__queue and self.__queue[0][0] <= current_time:
+                arrive_time, _, msg_id, data = heapq.heappop(self.__queue)
+                frames.append(((arrive_time - self.__start_time) // 1000, msg_id, data))
+        return len(frames), frames
+
+    def wait_for_receive(self, timeout: float) -> Optional[bool]:
+        """
+        等待有数据到达，有延时(latency)的数据等到到达时间才返回
+
+        :param timeout: 超时时间，单位秒
+
+        :return: 有数据返回True，超时返回False
+        """
+        end_time = perf_counter_ns() + int(timeout * 1e9)
+        with self.__condition:
+            while self._is_open:
+                current_time = perf_counter_ns()
+                if self.__queue and self.__queue[0][0] <= current_time:
+                    return True
+                if current_time >= end_time:
+                    return False
+                wait_time = end_time - current_time
+                if self.__queue:
+                    wait_time = min(wait_time, self.__queue[0][0] - current_time)
+                self.__condition.wait(wait_time / 1e9)
+        return False
+
+    def set_receive_event(self, event: Optional[Event]) -> bool:
+        """
+        设置接收事件，数据放入接收队列的时候set，有延时(latency)的数据在到达之前就会set
+
+        :param event: 接收事件，为None的时候取消
+
+        :return: True
+        """
+        self.__receive_event = event
+        return True
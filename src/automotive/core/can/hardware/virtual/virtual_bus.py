@@ -0,0 +1,66 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        virtual_bus.py
+# @Author:      lizhe
+# @Created:     2023/3/26 - 16:02
+# --------------------------------------------------------
+from automotive.logger.logger import logger, log_level
+from automotive.core.can.message import Message
+from automotive.core.can.common.interfaces import BaseCanBus
+from automotive.core.can.common.constant import EXTENDED_ID_FLAG, MAX_CAN_DATA_LENGTH
+from automotive.core.can.common.enums import BaudRateEnum
+from .virtual import VirtualCanDevice
+
+
+class VirtualCanBus(BaseCanBus):
+
+    def __init__(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
+                 channel_index: int = 1, can_fd: bool = False, max_workers: int = 300, need_receive: bool = True,
+                 is_uds_can_fd: bool = False, use_scheduler: bool = False):
+        super().__init__(baud_rate=baud_rate, data_rate=data_rate, channel_index=channel_index, can_fd=can_fd,
+                         max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd,
+                         use_scheduler=use_scheduler)
+        # 实例化虚拟设备
+        self._can = VirtualCanDevice(can_fd)
+
+    @staticmethod
+    def __get_message(time_stamp: int, msg_id: int, data: bytes) -> Message:
+        """
+        获取message对象
+
+        :return: Message对象
+        """
+        msg = Message()
+        msg.msg_id = msg_id & ~EXTENDED_ID_FLAG
+        msg.external_flag = 1 if msg_id & EXTENDED_ID_FLAG else 0
+        msg.time_stamp = time_stamp
+        msg.data = data
+        msg.data_length = len(data)
+        msg.is_fd = msg.data_length > MAX_CAN_DATA_LENGTH
+        return msg
+
+    def _read(self) -> int:
+        """
+        读取已经到达的所有帧
+        """
+        count, frames = self._can.receive()
+        if log_level.trace:
+            logger.trace(f"receive count is {count}")
+        receive_filter = self._receive_filter
+        for time_stamp, msg_id, data in frames:
+            # 被过滤的帧不构造Message
+            if receive_filter and not receive_filter.accept(msg_id & ~EXTENDED_ID_FLAG):
+                continue
+            self._handle_receive(self.__get_message(time_stamp, msg_id, data))
+        return count
+
+    def open_can(self):
+        """
+        对CAN设备进行打开、初始化等操作，并同时开启设备的帧接收线程。
+        """
+        super()._open_can()
+        if self._need_start_receive:
+            # 把接收函数submit到线程池中
+            self._receive_thread.append(self._thread_pool.submit(self._receive_loop))
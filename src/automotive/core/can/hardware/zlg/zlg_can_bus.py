@@ -6,11 +6,9 @@
 # @Author:      lizhe
 # @Created:     2022/1/28 - 12:31
 # --------------------------------------------------------
-from time import sleep
-from typing import Sequence
-
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
 from automotive.core.can.common.interfaces import BaseCanBus
+from automotive.core.can.common.constant import MAX_CAN_DATA_LENGTH
 from automotive.core.can.common.enums import BaudRateEnum
 from automotive.core.can.message import Message
 from .zlg_usb_can import ZlgUsbCanDevice
@@ -20,20 +18,14 @@ class ZlgCanBus(BaseCanBus):
 
     def __init__(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                  channel_index: int = 1, can_fd: bool = False, max_workers: int = 300, need_receive: bool = True,
-                 is_uds_can_fd: bool = False):
+                 is_uds_can_fd: bool = False, use_scheduler: bool = False):
         super().__init__(baud_rate=baud_rate, data_rate=data_rate, channel_index=channel_index, can_fd=can_fd,
-                         max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd)
+                         max_workers=max_workers, need_receive=need_receive, is_uds_can_fd=is_uds_can_fd,
+                         use_scheduler=use_scheduler)
         self.__can_fd = can_fd
         # 实例化周立功
         self._can = ZlgUsbCanDevice(can_fd)
 
-    @staticmethod
-    def __get_data(data, length: int) -> Sequence:
-        msg_data = []
-        for i in range(length):
-            msg_data.append(data[i])
-        return msg_data
-
     def __get_message(self, p_receive) -> Message:
         """
         获取message对象
@@ -42,38 +34,45 @@ class ZlgCanBus(BaseCanBus):
 
         :return: PeakCanMessage对象
         """
+        frame = p_receive.frame
         msg = Message()
-        msg.msg_id = p_receive.frame.can_id
+        msg.msg_id = frame.can_id
+        msg.external_flag = frame.eff
         msg.time_stamp = p_receive.timestamp
         if self.__can_fd:
-            dlc = p_receive.frame.len
+            dlc = frame.len
         else:
-            dlc = p_receive.frame.can_dlc
-        msg.data = self.__get_data(p_receive.frame.data, self._get_dlc_length(dlc))
-        msg.data_length = len(msg.data)
+            dlc = frame.can_dlc
+        msg.data_length = self._get_dlc_length(dlc)
+        # 直接从ctypes数组复制出bytes
+        msg.data = bytes(frame.data)[:msg.data_length]
+        msg.is_fd = msg.data_length > MAX_CAN_DATA_LENGTH
         return msg
 
-    def __receive(self):
+    def _read(self) -> int:
         """
-        CAN接收帧函数，在接收线程中执行
+        读取接收缓存中所有的帧，一次读满接收缓存的时候继续读取
+
+        :return: 读取的帧数
         """
-        logger.debug(f"start receive and tsmaster status {self._can.is_open} and need_receive {self._need_receive}")
-        while self._can.is_open and self._need_receive:
-            try:
-                count, p_receive = self._can.receive()
+        total = 0
+        receive_filter = self._receive_filter
+        while True:
+            count, p_receive = self._can.receive()
+            if log_level.trace:
                 logger.trace(f"receive count is {count}")
-                for i in range(count):
-                    receive_message = self.__get_message(p_receive)
+            for i in range(count):
+                frame = p_receive[i]
+                # 被过滤的帧不构造Message
+                if receive_filter and not receive_filter.accept(frame.frame.can_id):
+                    continue
+                receive_message = self.__get_message(frame)
+                if log_level.trace:
                     logger.trace(f"message_id = {hex(receive_message.msg_id)}")
-                    self._receive_messages[receive_message.msg_id] = receive_message
-                    self._append(receive_message)
-                    # UDS的时候自动发多帧的流控帧信号
-                    self._handle_continue_frame(receive_message)
-            except RuntimeError as e:
-                logger.trace(e)
-                continue
-            finally:
-                sleep(0.001)
+                self._handle_receive(receive_message)
+            total += count
+            if count < len(p_receive):
+                return total
 
     def open_can(self):
         """
@@ -82,4 +81,4 @@ class ZlgCanBus(BaseCanBus):
         super()._open_can()
         if self._need_start_receive:
             # 把接收函数submit到线程池中
-            self._receive_thread.append(self._thread_pool.submit(self.__receive))
+            self._receive_thread.append(self._thread_pool.submit(self._receive_loop))
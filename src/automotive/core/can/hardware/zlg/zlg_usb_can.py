@@ -8,18 +8,33 @@
 # --------------------------------------------------------
 import os
 import platform
-from ctypes import windll, POINTER, CFUNCTYPE, c_uint, c_char_p, byref, c_int
-from typing import Tuple
+from ctypes import windll, POINTER, CFUNCTYPE, c_uint, c_char_p, byref, c_int, memmove
+from threading import Lock
+from typing import Tuple, Sequence, Optional, Dict, List
 
 from automotive.common.constant import control_decorator, check_connect, can_tips
-from automotive.core.can.hardware.zlg.zlgbasic import ZCAN_USBCANFD_200U, ZCAN_TYPE_CANFD, ZCAN_TYPE_CAN, \
+from automotive.core.can.hardware.zlg.zlgbasic import ZCAN_USBCANFD_200U, ZCAN_TYPE_CANFD, \
     INVALID_DEVICE_HANDLE, IProperty, ZCAN_CHANNEL_INIT_CONFIG, ZCAN_STATUS_OK, ZCAN_DEVICE_INFO, ZCAN_Transmit_Data, \
     ZCAN_TransmitFD_Data, ZCAN_Receive_Data, ZCAN_ReceiveFD_Data, BAUD_RATE, DATA_RATE
 from automotive.core.can.message import Message
 from automotive.core.can.common.enums import BaudRateEnum
-from automotive.logger.logger import logger
+from automotive.logger.logger import logger, log_level
 from automotive.core.can.common.interfaces import BaseCanDevice
 
+"""
+周立功CAN盒
+
+多通道的时候每个通道一个ZlgUsbCanDevice，同一个设备索引的通道共用ZCAN_OpenDevice打开的设备句柄，
+
+第一个通道打开的时候打开设备，其他通道关闭的时候只复位自己的通道，最后一个通道关闭的时候才关闭设备
+"""
+
+# 每个通道最多的硬件滤波数量
+_max_filter_count = 64
+# 设备索引对应的[设备句柄, 打开的通道数量]
+_devices = dict()  # type: Dict[int, List]
+_devices_lock = Lock()
+
 
 class ZlgUsbCanDevice(BaseCanDevice):
 
@@ -39,6 +54,14 @@ class ZlgUsbCanDevice(BaseCanDevice):
         self.__dll_path = self.__get_dll_path()
         self.__device_handler = None
         self.__channel_handler = None
+        # 复用的接收缓存，每次最多读取的帧数
+        self.__buffer_size = 1000
+        if is_fd:
+            self.__receive_buffer = (ZCAN_ReceiveFD_Data * self.__buffer_size)()
+        else:
+            self.__receive_buffer = (ZCAN_Receive_Data * self.__buffer_size)()
+        # wait_for_receive中已经读取到接收缓存，但还没有被receive取走的帧数
+        self.__pending = 0
         logger.debug(f"use dll path is {self.__dll_path}")
         if platform.system() == "Windows":
             self.__lib_can = windll.LoadLibrary(self.__dll_path)
@@ -88,31 +111,79 @@ class ZlgUsbCanDevice(BaseCanDevice):
         if self.__channel_handler is None:
             raise RuntimeError("init can failed")
 
+    @staticmethod
+    def __merge_filter_ranges(ranges: Sequence[Tuple[int, int, bool]]) -> List[Tuple[int, int, bool]]:
+        """
+        范围超过硬件滤波数量的时候，标准帧和扩展帧各合并成一个范围
+        """
+        if len(ranges) <= _max_filter_count:
+            return list(ranges)
+        merged = []
+        for is_extended in False, True:
+            items = [x for x in ranges if x[2] == is_extended]
+            if items:
+                merged.append((min(x[0] for x in items), max(x[1] for x in items), is_extended))
+        return merged
+
+    @check_connect("_is_open", can_tips)
+    def set_receive_filter(self, ranges: Sequence[Tuple[int, int, bool]]) -> bool:
+        """
+        通过通道的filter属性设置硬件滤波，每个范围是一条滤波
+
+        :param ranges: [(起始ID, 结束ID, 是否扩展帧), ...]，为空的时候清除滤波，接收所有的帧
+
+        :return: 设置了硬件滤波返回True
+        """
+        self.__lib_can.GetIProperty.restype = POINTER(IProperty)
+        ip = self.__lib_can.GetIProperty(self.__device_handler)
+        self.__set_value(ip, "filter_clear", "0")
+        if not ranges:
+            return False
+        for start, end, is_extended in self.__merge_filter_ranges(ranges):
+            # 0为标准帧，1为扩展帧
+            self.__set_value(ip, "filter_mode", "1" if is_extended else "0")
+            self.__set_value(ip, "filter_start", f"0x{start:08X}")
+            self.__set_value(ip, "filter_end", f"0x{end:08X}")
+        # 使设置的滤波生效
+        self.__set_value(ip, "filter_ack", "0")
+        return True
+
     @control_decorator
     def __start_device(self):
         return self.__lib_can.ZCAN_StartCAN(self.__channel_handler)
 
-    def __data_package(self, message: Message, transmit_num: int = 1):
+    def __data_package(self, messages: Sequence[Message]):
+        transmit_num = len(messages)
         if self.__is_fd:
-            logger.trace("package canfd")
+            if log_level.trace:
+                logger.trace("package canfd")
             msgs = (ZCAN_TransmitFD_Data * transmit_num)()
-            for i in range(transmit_num):
+            for i, message in enumerate(messages):
+                data = bytes(message.data)
                 # 发送方式，0=正常发送，1=单次发送，2=自发自收，3=单次自发自收。
                 msgs[i].transmit_type = 1
                 msgs[i].frame.can_id = message.msg_id
-                msgs[i].frame.len = self._dlc[len(message.data)]
-                for j, value in enumerate(message.data):
-                    msgs[i].frame.data[j] = value
+                # 扩展帧标志
+                msgs[i].frame.eff = 1 if message.is_extended else 0
+                # 数据段加速
+                msgs[i].frame.brs = 1 if message.is_fd_frame else 0
+                msgs[i].frame.len = self._dlc[len(data)]
+                memmove(msgs[i].frame.data, data, len(data))
         else:
-            logger.trace("package can")
+            if log_level.trace:
+                logger.trace("package can")
             msgs = (ZCAN_Transmit_Data * transmit_num)()
-            for i in range(transmit_num):
+            for i, message in enumerate(messages):
+                data = bytes(message.data)
+                if len(data) > 8:
+                    raise RuntimeError(f"data length {len(data)} is larger than 8, please use can fd")
                 # 发送方式，0=正常发送，1=单次发送，2=自发自收，3=单次自发自收。
                 msgs[i].transmit_type = 1
                 msgs[i].frame.can_id = message.msg_id
-                msgs[i].frame.can_dlc = self._dlc[len(message.data)]
-                for j, value in enumerate(message.data):
-                    msgs[i].frame.data[j] = value
+                # 扩展帧标志
+                msgs[i].frame.eff = 1 if message.is_extended else 0
+                msgs[i].frame.can_dlc = self._dlc[len(data)]
+                memmove(msgs[i].frame.data, data, len(data))
         return msgs
 
     def __open_device(self, reserved: int = 0):
@@ -134,12 +205,18 @@ class ZlgUsbCanDevice(BaseCanDevice):
         :return:
         """
         reversed_ = c_uint(reserved)
-        self.__device_handler = self.__lib_can.ZCAN_OpenDevice(self.__device_type, self.__device_index, reversed_)
-        if self.__device_handler == INVALID_DEVICE_HANDLE:
-            self._is_open = False
-            raise RuntimeError("open device failed")
-        else:
-            self._is_open = True
+        with _devices_lock:
+            device = _devices.get(self.__device_index.value)
+            if device is None:
+                device_handler = self.__lib_can.ZCAN_OpenDevice(self.__device_type, self.__device_index, reversed_)
+                if device_handler == INVALID_DEVICE_HANDLE:
+                    self._is_open = False
+                    raise RuntimeError("open device failed")
+                device = [device_handler, 0]
+                _devices[self.__device_index.value] = device
+            device[1] += 1
+        self.__device_handler = device[0]
+        self._is_open = True
 
     def open_device(self, baud_rate: BaudRateEnum = BaudRateEnum.HIGH, data_rate: BaudRateEnum = BaudRateEnum.DATA,
                     channel: int = 1):
@@ -153,11 +230,20 @@ class ZlgUsbCanDevice(BaseCanDevice):
 
     def close_device(self):
         if self._is_open:
-            if self.__lib_can.ZCAN_CloseDevice(self.__device_handler) == 1:
-                self._is_open = False
-                self.__channel_handler = None
-                self.__channel_index = None
-                logger.debug(f"device is closed")
+            with _devices_lock:
+                device = _devices[self.__device_index.value]
+                if device[1] > 1:
+                    # 其他通道还在使用设备，只复位自己的通道
+                    self.__lib_can.ZCAN_ResetCAN(self.__channel_handler)
+                    device[1] -= 1
+                elif self.__lib_can.ZCAN_CloseDevice(self.__device_handler) == 1:
+                    _devices.pop(self.__device_index.value)
+                else:
+                    return
+            self._is_open = False
+            self.__channel_handler = None
+            self.__channel_index = None
+            logger.debug(f"device is closed")
 
     @check_connect("_is_open", can_tips)
     def read_board_info(self) -> str:
@@ -173,39 +259,71 @@ class ZlgUsbCanDevice(BaseCanDevice):
     @check_connect("_is_open", can_tips)
     def transmit(self, message: Message):
         # 只发一条message
-        transmit_num = 1
-        msgs = self.__data_package(message, transmit_num)
+        self.transmit_many([message])
+
+    @check_connect("_is_open", can_tips)
+    def transmit_many(self, messages: Sequence[Message]):
+        # ZCAN_Transmit本身支持数组，一次调用发送全部，返回值是实际发送成功的帧数
+        transmit_num = len(messages)
+        if transmit_num == 0:
+            return
+        msgs = self.__data_package(messages)
         if self.__is_fd:
-            logger.trace("transmit fd")
+            if log_level.trace:
+                logger.trace("transmit fd")
             result = self.__lib_can.ZCAN_TransmitFD(self.__channel_handler, msgs, transmit_num)
-            if result != ZCAN_STATUS_OK:
-                raise RuntimeError("transmit fd failed")
+            if result != transmit_num:
+                raise RuntimeError(f"transmit fd failed, need send {transmit_num} and actual send {result}")
         else:
-            logger.trace("transmit can")
+            if log_level.trace:
+                logger.trace("transmit can")
             result = self.__lib_can.ZCAN_Transmit(self.__channel_handler, msgs, transmit_num)
-            if result != ZCAN_STATUS_OK:
-                raise RuntimeError("transmit failed")
+            if result != transmit_num:
+                raise RuntimeError(f"transmit failed, need send {transmit_num} and actual send {result}")
 
-    @check_connect("_is_open", can_tips)
-    def receive(self, wait_time=c_int(-1)) -> Tuple:
+    def __read(self, wait_time: int) -> int:
+        """
+        读取到复用的接收缓存中
+
+        :param wait_time: 缓冲区为空的时候等待的时间，单位毫秒
+
+        :return: 实际读取的帧数
+        """
         if self.__is_fd:
-            rcv_num = self.__lib_can.ZCAN_GetReceiveNum(self.__channel_handler, ZCAN_TYPE_CANFD)
-            logger.trace(f"receive count is {rcv_num}")
-            if rcv_num:
-                rcv_canfd_msgs = (ZCAN_ReceiveFD_Data * rcv_num)()
-                counts = self.__lib_can.ZCAN_ReceiveFD(self.__channel_handler, byref(rcv_canfd_msgs), rcv_num,
-                                                       wait_time)
-                logger.info(f"real receive count is {counts}")
-                return counts, rcv_canfd_msgs
-            else:
-                raise RuntimeError("receive failed")
+            count = self.__lib_can.ZCAN_ReceiveFD(self.__channel_handler, byref(self.__receive_buffer),
+                                                  self.__buffer_size, c_int(wait_time))
         else:
-            rcv_num = self.__lib_can.ZCAN_GetReceiveNum(self.__channel_handler, ZCAN_TYPE_CAN)
-            logger.trace(f"receive count is {rcv_num}")
-            if rcv_num:
-                rcv_can_msgs = (ZCAN_Receive_Data * rcv_num)()
-                counts = self.__lib_can.ZCAN_Receive(self.__channel_handler, byref(rcv_can_msgs), rcv_num, wait_time)
-                logger.info(f"real receive count is {counts}")
-                return counts, rcv_can_msgs
-            else:
-                raise RuntimeError("receive buffer not  failed")
+            count = self.__lib_can.ZCAN_Receive(self.__channel_handler, byref(self.__receive_buffer),
+                                                self.__buffer_size, c_int(wait_time))
+        if log_level.trace:
+            logger.trace(f"receive count is {count}")
+        # 出错的时候返回的是0xFFFFFFFF
+        if count > self.__buffer_size:
+            raise RuntimeError(f"receive failed, return value is {count}")
+        return count
+
+    @check_connect("_is_open", can_tips)
+    def receive(self) -> Tuple:
+        """
+        接收CAN消息，不等待
+
+        :return: (实际收到的数量, 接收缓存)，接收缓存每次都会复用，需要在下一次调用receive之前处理完成
+        """
+        if self.__pending:
+            count = self.__pending
+            self.__pending = 0
+        else:
+            count = self.__read(0)
+        return count, self.__receive_buffer
+
+    def wait_for_receive(self, timeout: float) -> Optional[bool]:
+        """
+        通过ZCAN_Receive的等待时间阻塞等待，收到的帧留在接收缓存中，由下一次receive返回
+
+        :param timeout: 超时时间，单位秒
+
+        :return: 有数据返回True，超时返回False
+        """
+        if not self.__pending:
+            self.__pending = self.__read(int(timeout * 1000))
+        return self.__pending > 0
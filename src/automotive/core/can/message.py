@@ -6,11 +6,20 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:42
 # --------------------------------------------------------
-from typing import Union, Sequence, Tuple, Dict, List
+import os
+from collections import namedtuple
+from collections.abc import MutableMapping
+from threading import Lock
+from types import MappingProxyType
+from typing import Union, Sequence, Tuple, Dict, List, Optional, Iterable, Iterator
 
-from automotive.logger.logger import logger
+import numpy as np
+
+from automotive.logger.logger import logger, log_level, hex_list, HOT_TRACE
 from automotive.utils.utils import Utils, Number
+from .common.constant import dlc, MAX_STANDARD_ID, MAX_EXTENDED_ID, MAX_CAN_DATA_LENGTH, MAX_FD_DATA_LENGTH
 from .common.typehints import Messages, MessageType, SignalType
+from .codec import MessageCodec, SignalCodec
 from .tools.parser.dbc_parser import DbcParser
 
 """
@@ -19,11 +28,36 @@ from .tools.parser.dbc_parser import DbcParser
 该类的作用是根据start_bit和bit_length等值计算出来8byte的值或者反向计算。
 
 如需要可以将该类变成私有类
+
+PS: Message.update已经改为使用codec.py中预先编译好的编解码器，set_data/get_data保留作为参照实现
+
+矩阵表解析后生成只读的MessageSchema(包含signal的定义、编译好的编解码器以及默认数据)，同一个矩阵表文件的schema在进程内共享，
+
+Message对象只保存当前的数据以及被访问/修改过的Signal对象，恢复默认值的时候只需要把数据重置为schema中的默认数据
+
+Message的数据使用bytes/bytearray保存，从CAN盒收到的数据是只读的bytes，需要编码的时候才转换成bytearray，
+
+ID大于0x7FF或者external_flag为1的是29位的扩展帧，数据长度大于8或者is_fd为True的是CAN FD帧(最长64字节)
 """
 
 # 位长度
 _bit_length = 8
 
+# signal的只读定义
+SignalSchema = namedtuple("SignalSchema", ["signal_name", "bit_length", "start_bit", "is_sign", "byte_type", "factor",
+                                           "offset", "minimum", "maximum", "unit", "receiver", "start_value", "values",
+                                           "comment"])
+# message的只读定义，signals是signal名字到SignalSchema的只读字典，default_data是signal初始值编码后的数据
+MessageSchema = namedtuple("MessageSchema", ["msg_id", "msg_name", "data_length", "sender", "msg_send_type",
+                                             "cycle_time", "delay_time", "cycle_time_fast", "cycle_time_fast_times",
+                                             "nm_message", "diag_request", "diag_response", "diag_state",
+                                             "is_standard_can", "is_extended", "is_fd", "signals", "codec",
+                                             "default_data"])
+
+# 进程内共享的schema，key是(文件路径, 编码, 修改时间, 文件大小)
+_schemas = dict()  # type: Dict[Tuple[str, str, int, int], List[MessageSchema]]
+_schemas_lock = Lock()
+
 
 def __completion_byte(byte_value: str, size: int = 8) -> str:
     """
@@ -47,7 +81,8 @@ def __get_position(start_bit: int, byte_length: int = 8) -> Tuple[int, int]:
     # 根据start_bit以及bin_value_length计算占据的byte有几个
     # 计算start_bit是在第几个byte中，以及在byte中占据第几个bit
     # 获取开始点在整个8byte数据的位置
-    logger.trace(f"start_bit = [{start_bit}] && byte_length = [{byte_length}]")
+    if HOT_TRACE:
+        logger.trace(f"start_bit = [{start_bit}] && byte_length = [{byte_length}]")
     byte_index = -1
     for i in range(byte_length):
         if _bit_length * i <= start_bit <= _bit_length * i + 7:
@@ -55,7 +90,8 @@ def __get_position(start_bit: int, byte_length: int = 8) -> Tuple[int, int]:
             break
     # 获取在单独这个byte中所占据的位置
     bit_index = 7 - (start_bit - (start_bit // 8 * 8))
-    logger.trace(f"byte_index = [{byte_index}] && bit_index = [{bit_index}]")
+    if HOT_TRACE:
+        logger.trace(f"byte_index = [{byte_index}] && bit_index = [{bit_index}]")
     return byte_index, bit_index
 
 
@@ -67,14 +103,16 @@ def __split_bytes(value: str, length: int, bit_index: int, byte_type: bool) -> S
     :param bit_index: start_bit在一个byte中的位置
     :return: byte集合
     """
-    logger.trace(f"length is {length}, bit_index = {bit_index}")
+    if HOT_TRACE:
+        logger.trace(f"length is {length}, bit_index = {bit_index}")
     values = []
     if byte_type:
         if length > bit_index + 1:
             values.append(value[-bit_index - 1:])
             # 把剩下的拿出来
             value = value[:-bit_index - 1]
-            logger.trace(f"rest value is [{value}]")
+            if HOT_TRACE:
+                logger.trace(f"rest value is [{value}]")
             while len(value) > _bit_length:
                 # 当剩余数据长度大于8表示还有一个byte， 先把数据加入列表中
                 values.append(value[-_bit_length:])
@@ -90,7 +128,8 @@ def __split_bytes(value: str, length: int, bit_index: int, byte_type: bool) -> S
             values.append(value[:_bit_length - bit_index])
             # 把剩下的拿出来
             value = value[_bit_length - bit_index:]
-            logger.trace(f"rest value is [{value}]")
+            if HOT_TRACE:
+                logger.trace(f"rest value is [{value}]")
             while len(value) > _bit_length:
                 # 当剩余数据长度大于8表示还有一个byte， 先把数据加入列表中
                 values.append(value[:_bit_length])
@@ -126,13 +165,16 @@ def __calc_singed_set_value(value: int, size: int) -> int:
     value = __completion_byte(bin(value)[2:], size - 1)
     # 原码，带符号位
     true_code = f"1{value}"
-    logger.debug(f"true code is {true_code}")
+    if log_level.debug:
+        logger.debug(f"true code is {true_code}")
     # 除符号位的反码
     no_sign_ones_complement_code = "".join(map(lambda x: "1" if x == "0" else "0", value))
     ones_complement_code = f"1{no_sign_ones_complement_code}"
-    logger.debug(f"ones-complement code is {ones_complement_code}")
+    if log_level.debug:
+        logger.debug(f"ones-complement code is {ones_complement_code}")
     complemental_code = int(ones_complement_code, 2) + 1
-    logger.debug(f"complemental code = {bin(complemental_code)[2:]}")
+    if log_level.debug:
+        logger.debug(f"complemental code = {bin(complemental_code)[2:]}")
     return complemental_code
 
 
@@ -159,50 +201,64 @@ def set_data(data: List[int], start_bit: int, byte_type: bool, value: int, bit_l
     """
     if value < 0 and is_sign:
         value = __calc_singed_set_value(value, bit_length)
-    logger.trace(f"data = {list(map(lambda x: hex(x), data))}), start_bit = [{start_bit}], "
-                 f"byte_type = [{byte_type}], value = [{value}], bit_length = [{bit_length}]")
+    if HOT_TRACE:
+        logger.trace(f"data = {list(map(lambda x: hex(x), data))}), start_bit = [{start_bit}], "
+                     f"byte_type = [{byte_type}], value = [{value}], bit_length = [{bit_length}]")
     byte_index, bit_index = __get_position(start_bit, byte_length)
     # True表示Intel， False表示Motorola MSB模式, DBC解析出来只支持MSB模式, 不支持LSB模式，
     # 对于LSB来说，在变成DBC的时候就处理了start bit
     # 根据位数来算， 其中把value转换成了二进制的字符串
     bin_value = __completion_byte(bin(value)[2:], bit_length)
-    logger.trace(f"bin_value = {bin_value}")
+    if HOT_TRACE:
+        logger.trace(f"bin_value = {bin_value}")
     # 计算占据几个byte
     holder_bytes = __split_bytes(bin_value, bit_length, bit_index, byte_type)
-    logger.trace(f"holder_bytes = {holder_bytes}")
+    if HOT_TRACE:
+        logger.trace(f"holder_bytes = {holder_bytes}")
     for index, byte in enumerate(holder_bytes):
         actual_index = byte_index + index
-        logger.trace(f"actual index = {actual_index}")
+        if HOT_TRACE:
+            logger.trace(f"actual index = {actual_index}")
         byte_value = __completion_byte(bin(data[actual_index])[2:])
-        logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+        if HOT_TRACE:
+            logger.trace(f"the [{byte_index}] value is [{byte_value}]")
         length = len(byte)
-        logger.trace(f"byte  = {byte}")
+        if HOT_TRACE:
+            logger.trace(f"byte  = {byte}")
         # 填充第一位
         if index == 0:
             if byte_type:
-                logger.trace(f"intel mode")
+                if HOT_TRACE:
+                    logger.trace(f"intel mode")
                 byte_value = byte_value[:bit_index + 1 - length] + byte + byte_value[bit_index + 1:]
             else:
-                logger.trace("motorola mode")
+                if HOT_TRACE:
+                    logger.trace("motorola mode")
                 byte_value = byte_value[:bit_index] + byte + byte_value[bit_index + length:]
-            logger.trace(f"first byte value = {byte_value}")
+            if HOT_TRACE:
+                logger.trace(f"first byte value = {byte_value}")
         # 填充最后一位
         elif index == len(holder_bytes) - 1:
             if byte_type:
-                logger.trace(f"intel mode")
+                if HOT_TRACE:
+                    logger.trace(f"intel mode")
                 byte_value = byte_value[:_bit_length - length] + byte
             else:
-                logger.trace("motorola mode")
+                if HOT_TRACE:
+                    logger.trace("motorola mode")
                 byte_value = byte + byte_value[length:]
-            logger.trace(f"last byte value = {byte_value}")
+            if HOT_TRACE:
+                logger.trace(f"last byte value = {byte_value}")
         # 填充中间的数据
         else:
             byte_value = byte
-        logger.trace(f"after handle byte_value = {byte_value}")
-        logger.trace(f"set {actual_index} data {bin(data[actual_index])[2:]} to {byte_value}")
+        if HOT_TRACE:
+            logger.trace(f"after handle byte_value = {byte_value}")
+            logger.trace(f"set {actual_index} data {bin(data[actual_index])[2:]} to {byte_value}")
         # 把计算后的值设置会data中去, 此处注意字符串要转成2进制
         data[actual_index] = int(byte_value, 2)
-    logger.trace(f"parser data is = {list(map(lambda x: hex(x), data))}")
+    if HOT_TRACE:
+        logger.trace(f"parser data is = {list(map(lambda x: hex(x), data))}")
 
 
 def __calc_singed_get_value(value: str) -> int:
@@ -237,56 +293,73 @@ def get_data(data: Sequence[int], start_bit: int, byte_type: bool, bit_length: i
 
     :return 查询到的值
     """
-    logger.trace(f"data = {list(map(lambda x: hex(x), data))}), start_bit = [{start_bit}], "
-                 f"byte_type = [{byte_type}], bit_length = [{bit_length}]")
+    if HOT_TRACE:
+        logger.trace(f"data = {list(map(lambda x: hex(x), data))}), start_bit = [{start_bit}], "
+                     f"byte_type = [{byte_type}], bit_length = [{bit_length}]")
     byte_index, bit_index = __get_position(start_bit, byte_length)
     byte_value = __completion_byte(bin(data[byte_index])[2:])
-    logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+    if HOT_TRACE:
+        logger.trace(f"the [{byte_index}] value is [{byte_value}]")
     if byte_type:
-        logger.trace(f"intel mode")
+        if HOT_TRACE:
+            logger.trace(f"intel mode")
         if bit_length > bit_index + 1:
             signal_value = byte_value[:bit_index + 1]
-            logger.trace(f"intel first signal_value = {signal_value}")
+            if HOT_TRACE:
+                logger.trace(f"intel first signal_value = {signal_value}")
             rest_length = bit_length - bit_index - 1
-            logger.trace(f"intel rest length = {rest_length}")
+            if HOT_TRACE:
+                logger.trace(f"intel rest length = {rest_length}")
             while rest_length > _bit_length:
                 byte_index += 1
                 byte_value = __completion_byte(bin(data[byte_index])[2:])
-                logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+                if HOT_TRACE:
+                    logger.trace(f"the [{byte_index}] value is [{byte_value}]")
                 signal_value = byte_value[:_bit_length] + signal_value
-                logger.trace(f"intel middle signal_value = {signal_value}")
+                if HOT_TRACE:
+                    logger.trace(f"intel middle signal_value = {signal_value}")
                 rest_length = rest_length - _bit_length
             # 最后一个value
             byte_index += 1
             byte_value = __completion_byte(bin(data[byte_index])[2:])
-            logger.trace(f"the [{byte_index}] value is [{byte_value}]")
-            logger.trace(f"rest_length = {rest_length}")
+            if HOT_TRACE:
+                logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+                logger.trace(f"rest_length = {rest_length}")
             signal_value = byte_value[-rest_length:] + signal_value
-            logger.trace(f"intel last signal_value = {signal_value}")
+            if HOT_TRACE:
+                logger.trace(f"intel last signal_value = {signal_value}")
         else:
             signal_value = byte_value[bit_index + 1 - bit_length:bit_index + 1]
-            logger.trace(f"only one byte value = {signal_value}")
+            if HOT_TRACE:
+                logger.trace(f"only one byte value = {signal_value}")
     else:
-        logger.trace(f"motorola mode")
+        if HOT_TRACE:
+            logger.trace(f"motorola mode")
         if bit_length > (_bit_length - bit_index):
             signal_value = byte_value[bit_index:]
-            logger.trace(f"motorola first signal_value = {signal_value}")
+            if HOT_TRACE:
+                logger.trace(f"motorola first signal_value = {signal_value}")
             rest_length = bit_length - (_bit_length - bit_index)
-            logger.trace(f"rest length = {rest_length}")
+            if HOT_TRACE:
+                logger.trace(f"rest length = {rest_length}")
             while rest_length > _bit_length:
                 byte_index += 1
                 byte_value = __completion_byte(bin(data[byte_index])[2:])
-                logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+                if HOT_TRACE:
+                    logger.trace(f"the [{byte_index}] value is [{byte_value}]")
                 signal_value = signal_value + byte_value[:_bit_length]
-                logger.trace(f"motorola middle signal_value = {signal_value}")
+                if HOT_TRACE:
+                    logger.trace(f"motorola middle signal_value = {signal_value}")
                 rest_length = rest_length - _bit_length
             # 最后一个value
             byte_index += 1
             byte_value = __completion_byte(bin(data[byte_index])[2:])
-            logger.trace(f"the [{byte_index}] value is [{byte_value}]")
-            logger.trace(f"rest_length = {rest_length}")
+            if HOT_TRACE:
+                logger.trace(f"the [{byte_index}] value is [{byte_value}]")
+                logger.trace(f"rest_length = {rest_length}")
             signal_value = signal_value + byte_value[:rest_length]
-            logger.trace(f"motorola last signal_value = {signal_value}")
+            if HOT_TRACE:
+                logger.trace(f"motorola last signal_value = {signal_value}")
         else:
             signal_value = byte_value[bit_index:bit_index + bit_length]
     if is_sign and signal_value[0] == "1":
@@ -296,6 +369,126 @@ def get_data(data: Sequence[int], start_bit: int, byte_type: bool, bit_length: i
         return int(signal_value, 2)
 
 
+def get_frame_array(messages: Sequence["Message"]) -> np.ndarray:
+    """
+    把消息列表中的数据转换成(N, dlc)的uint8数组，长度不足的帧在尾部补0
+
+    :param messages: 消息列表(一般是栈中过滤出来的同一个msg id的消息)
+
+    :return: (N, dlc)的uint8数组
+    """
+    size = len(messages)
+    width = max(map(lambda x: len(x.data), messages)) if size > 0 else 0
+    frames = np.zeros((size, width), dtype=np.uint8)
+    for index, message in enumerate(messages):
+        data = message.data
+        # NumPy不能直接把bytes赋值给uint8数组，需要通过memoryview
+        frames[index, :len(data)] = memoryview(data) if isinstance(data, (bytes, bytearray)) else data
+    return frames
+
+
+def get_signal_schema(signal: SignalType) -> SignalSchema:
+    """
+    根据signal字典生成signal的只读定义
+
+    TAG: 如果要增加或者变更内容，修改这里
+
+    :param signal: signal字典
+
+    :return: SignalSchema
+    """
+    return SignalSchema(signal_name=signal["name"],
+                        bit_length=signal["signal_size"],
+                        start_bit=signal["start_bit"],
+                        is_sign=signal["is_sign"],
+                        byte_type=signal["byte_type"],
+                        factor=signal["factor"],
+                        offset=signal["offset"],
+                        minimum=signal["minimum"],
+                        maximum=signal["maximum"],
+                        unit=signal["unit"],
+                        receiver=signal["receiver"],
+                        start_value=signal.get("start_value", 0),
+                        values=signal.get("values", None),
+                        comment=signal.get("comment", ""))
+
+
+def get_message_schema(message: MessageType) -> MessageSchema:
+    """
+    根据message字典生成message的只读定义，同时编译好编解码器并计算出signal初始值对应的默认数据
+
+    TAG: 如果要增加或者变更内容，修改这里
+
+    :param message: message字典
+
+    :return: MessageSchema
+    """
+    data_length = message["length"]
+    msg_id = message["id"]
+    #  特殊处理，如果不是Cycle/Event就是CE
+    send_type = message["msg_send_type"]
+    if send_type.upper() == "CYCLE":
+        msg_send_type = "Cycle"
+    elif send_type.upper() == "EVENT":
+        msg_send_type = "Event"
+    else:
+        msg_send_type = "Cycle and Event"
+    cycle_time = message.get("msg_cycle_time", 0)
+    # 必须加上msg_cycle_time大于0才可以判断当前信号为周期信号
+    if cycle_time > 0:
+        msg_send_type = "Cycle"
+    signals = dict()
+    for sig in message["signals"]:
+        signal = get_signal_schema(sig)
+        signals[signal.signal_name] = signal
+    codec = MessageCodec(SignalCodec(name, signal.start_bit, signal.bit_length, signal.byte_type, signal.is_sign)
+                         for name, signal in signals.items())
+    default_data = bytes(data_length)
+    if data_length:
+        codec.compile(data_length)
+        default_data = codec.encode(default_data, {name: signal.start_value for name, signal in signals.items()})
+    return MessageSchema(msg_id=msg_id,
+                         msg_name=message["name"],
+                         data_length=data_length,
+                         sender=message["sender"],
+                         msg_send_type=msg_send_type,
+                         cycle_time=cycle_time,
+                         delay_time=message.get("msg_delay_time", 0),
+                         cycle_time_fast=message.get("msg_cycle_time_fast", 0),
+                         cycle_time_fast_times=message.get("gen_msg_nr_of_repetition", 0),
+                         nm_message=message.get("nm_message", False),
+                         diag_request=message["diag_request"],
+                         diag_response=message["diag_response"],
+                         diag_state=message["diag_state"],
+                         is_standard_can=message.get("is_standard_can", True),
+                         is_extended=message.get("is_extended", msg_id > MAX_STANDARD_ID),
+                         is_fd=message.get("is_can_fd", False) or data_length > MAX_CAN_DATA_LENGTH,
+                         signals=MappingProxyType(signals),
+                         codec=codec,
+                         default_data=default_data)
+
+
+def __read_schemas(message_name: str, encoding: str) -> List[MessageSchema]:
+    """
+    从json或者dbc文件中读取schema，同一个文件(修改时间和大小都没有变化)只解析一次
+    """
+    stat = os.stat(message_name)
+    key = os.path.abspath(message_name), encoding, stat.st_mtime_ns, stat.st_size
+    with _schemas_lock:
+        if key in _schemas:
+            return _schemas[key]
+    if message_name.endswith(".json"):
+        messages = Utils().get_json_obj(message_name, encoding=encoding)
+    elif message_name.endswith(".dbc"):
+        dbc_parser = DbcParser()
+        messages = dbc_parser.parse(message_name, encoding="gbk")
+    else:
+        raise RuntimeError("messages only support json or dbc file")
+    schemas = [get_message_schema(msg) for msg in messages]
+    with _schemas_lock:
+        return _schemas.setdefault(key, schemas)
+
+
 def get_message(messages: Union[str, Messages], encoding: str = "utf-8") -> Tuple[Dict, Dict]:
     """
     从Json或者python文件中获取id和name的message字典
@@ -314,23 +507,81 @@ def get_message(messages: Union[str, Messages], encoding: str = "utf-8") -> Tupl
     id_messages = dict()
     name_messages = dict()
     if isinstance(messages, str):
-        message_name = messages
-        if message_name.endswith(".json"):
-            messages = Utils().get_json_obj(message_name, encoding=encoding)
-        elif message_name.endswith(".dbc"):
-            dbc_parser = DbcParser()
-            messages = dbc_parser.parse(message_name, encoding="gbk")
-        else:
+        if not (messages.endswith(".json") or messages.endswith(".dbc")):
             raise RuntimeError("messages only support json or dbc file")
-    for msg in messages:
+        schemas = __read_schemas(messages, encoding)
+    else:
+        schemas = [get_message_schema(msg) for msg in messages]
+    for schema in schemas:
         message = Message()
-        message.set_value(msg)
+        message.set_schema(schema)
         id_messages[message.msg_id] = message
         name_messages[message.msg_name] = message
     logger.trace(f"total read message is {len(id_messages)}")
     return id_messages, name_messages
 
 
+class SignalDict(MutableMapping):
+    """
+    Message中的signals字典
+
+    Signal对象只有在第一次访问的时候才根据schema生成，其值从message当前的数据中解码，
+
+    没有被访问过的signal的值就是当前数据中的值，发送的时候只需要把生成过的Signal对象的值编码到数据中
+    """
+
+    def __init__(self, message: "Message"):
+        self.__message = message
+        self.__signals = dict()  # type: Dict[str, Signal]
+
+    def __getitem__(self, name: str) -> "Signal":
+        try:
+            return self.__signals[name]
+        except KeyError:
+            schema = self.__message.schema
+            if schema is None or name not in schema.signals:
+                raise KeyError(name)
+            signal = Signal()
+            signal.set_schema(schema.signals[name])
+            signal.value = schema.codec.decode(self.__message.data, (name,))[name]
+            self.__signals[name] = signal
+            return signal
+
+    def __setitem__(self, name: str, signal: "Signal"):
+        self.__signals[name] = signal
+
+    def __delitem__(self, name: str):
+        del self.__signals[name]
+
+    def __contains__(self, name: object) -> bool:
+        schema = self.__message.schema
+        return name in self.__signals or (schema is not None and name in schema.signals)
+
+    def __iter__(self) -> Iterator[str]:
+        schema = self.__message.schema
+        names = schema.signals if schema is not None else ()
+        yield from names
+        for name in self.__signals:
+            if name not in names:
+                yield name
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    @property
+    def changed_signals(self) -> Dict[str, "Signal"]:
+        """
+        已经生成过的Signal对象
+        """
+        return self.__signals
+
+    def reset(self):
+        """
+        丢弃所有生成过的Signal对象
+        """
+        self.__signals.clear()
+
+
 class Message(object):
     """
     CAN总线定义的Message，集合了CAN box发送的相关内容， 如msg_send_type/external_flag等
@@ -348,7 +599,7 @@ class Message(object):
         # 信号数据长度
         self.data_length = None
         # 信号数据
-        self.data = []
+        self.data = bytearray()
         # 信号停止标志
         self.stop_flag = False
         # 信号的名字
@@ -381,27 +632,52 @@ class Message(object):
         self.diag_state = False
         # 是否标准can
         self.is_standard_can = None
-        # USB CAN特有的东西
+        # 是否是扩展帧，1表示29位的扩展帧
         self.external_flag = None
+        # 是否是CAN FD帧
+        self.is_fd = False
+        # signal编解码器
+        self.codec = None
+        # 只读的message定义，从矩阵表生成的message才有
+        self.schema = None
 
     def __str__(self):
         data = [hex(x) for x in self.data]
         return f"id = {hex(self.msg_id)}, data = {data}"
 
+    @property
+    def is_extended(self) -> bool:
+        """
+        是否是29位的扩展帧，设置了external_flag或者ID大于0x7FF的都是扩展帧
+        """
+        return bool(self.external_flag) or (self.msg_id is not None and self.msg_id > MAX_STANDARD_ID)
+
+    @property
+    def is_fd_frame(self) -> bool:
+        """
+        是否需要按照CAN FD帧发送
+        """
+        return self.is_fd or len(self.data) > MAX_CAN_DATA_LENGTH
+
     def __check_msg_id(self):
         """
-        检查msg id是否在0-07ff之间
+        检查msg id，标准帧在0-0x7ff之间，扩展帧在0-0x1fffffff之间
         """
-        if not check_value(self.msg_id, 0, 0x7FF):
-            raise ValueError(f"msg id [{self.msg_id}] is incorrect, only support [0 - 0x7ff]")
+        max_id = MAX_EXTENDED_ID if self.is_extended else MAX_STANDARD_ID
+        if not check_value(self.msg_id, 0, max_id):
+            raise ValueError(f"msg id [{self.msg_id}] is incorrect, only support [0 - {hex(max_id)}]")
 
     def __check_msg_data(self):
         """
-        检查msg数据，8byte是否每个数据都在0-0xff之间
+        检查msg数据，长度是否是CAN/CAN FD支持的长度，每个数据是否都在0-0xff之间
         """
-        for value in self.data:
-            if not check_value(value, 0, 0xff):
-                raise ValueError(f"data[{self.data}] is incorrect, each value only support [0 - 0xff]")
+        if len(self.data) not in dlc:
+            raise ValueError(f"data length[{len(self.data)}] is incorrect, only support {list(dlc.keys())}")
+        # bytes中的每个数据一定在0-0xff之间
+        if not isinstance(self.data, (bytes, bytearray)):
+            for value in self.data:
+                if not check_value(value, 0, 0xff):
+                    raise ValueError(f"data[{self.data}] is incorrect, each value only support [0 - 0xff]")
 
     def __check_signals(self):
         """
@@ -426,6 +702,21 @@ class Message(object):
         else:
             self.__check_signals()
 
+    def compile(self):
+        """
+        根据signals生成编解码器，并预先计算当前数据长度下的位移和掩码
+        """
+        if self.schema is not None:
+            # schema中已经编译好了
+            self.codec = self.schema.codec
+            return
+        codecs = []
+        for name, signal in self.signals.items():
+            codecs.append(SignalCodec(name, signal.start_bit, signal.bit_length, signal.byte_type, signal.is_sign))
+        self.codec = MessageCodec(codecs)
+        if self.data_length:
+            self.codec.compile(self.data_length)
+
     def update(self, type_: bool):
         """
         更新8byte数据。
@@ -436,83 +727,110 @@ class Message(object):
 
             False:  收到数据
         """
+        if self.codec is None:
+            self.compile()
+        signals = self.__get_changed_signals()
         # 发送数据
         if type_:
-            logger.trace("send message")
-            for name, signal in self.signals.items():
-                logger.trace(f"signal name = {signal.signal_name} and signal value = {signal.value}")
-                # 根据原来的数据message_data，替换某一部分的内容
-                set_data(self.data, signal.start_bit, signal.byte_type, signal.value, signal.bit_length,
-                         signal.is_sign, self.data_length)
-            logger.trace(f"msg id {hex(self.msg_id)} and data is {list(map(lambda x: hex(x), self.data))}")
+            if HOT_TRACE:
+                logger.trace("send message")
+            values = dict()
+            for name, signal in signals.items():
+                values[name] = signal.value
+            # 根据原来的数据message_data，替换某一部分的内容
+            self.__get_mutable_data()[:] = self.codec.encode(self.data, values)
+            if HOT_TRACE:
+                logger.trace(f"msg id {hex(self.msg_id)} and data is {hex_list(self.data)}")
         # 收到数据
         else:
-            logger.trace("receive message")
-            for name, signal in self.signals.items():
-                logger.trace(f"signal name = {signal.signal_name} and signal value = {signal.value}")
-                value = get_data(self.data, signal.start_bit, signal.byte_type, signal.bit_length, signal.is_sign,
-                                 self.data_length)
-                logger.trace(f"value is {value}")
-                signal.value = value
+            if HOT_TRACE:
+                logger.trace("receive message")
+            if signals:
+                for name, value in self.codec.decode(self.data, signals.keys()).items():
+                    signals[name].value = value
+
+    def __get_mutable_data(self):
+        """
+        获取可以修改的数据，从CAN盒收到的数据是只读的bytes，先转换成bytearray
+        """
+        if isinstance(self.data, (bytes, memoryview)):
+            self.data = bytearray(self.data)
+        return self.data
+
+    def __get_changed_signals(self) -> Dict[str, "Signal"]:
+        """
+        获取需要编解码的Signal对象，从schema生成的message只需要处理已经生成过的Signal对象
+        """
+        if isinstance(self.signals, SignalDict):
+            return self.signals.changed_signals
+        return self.signals
+
+    def reset(self):
+        """
+        恢复为schema中定义的默认数据，同时丢弃所有修改过的signal
+        """
+        if self.schema is None:
+            raise RuntimeError(f"message {self.msg_id} is not created from schema")
+        self.__get_mutable_data()[:] = self.schema.default_data
+        self.signals.reset()
+
+    def decode_frames(self, frames: np.ndarray,
+                      names: Optional[Iterable[str]] = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        批量计算多帧数据中signal的值，不会修改当前message的数据
+
+        :param frames: (N, dlc)的uint8数组，每一行是一帧数据
+
+        :param names: 需要计算的signal名字，默认计算全部
+
+        :return: signal的值，其中key是signal名字，value是(总线值数组, 物理值数组)
+        """
+        if self.codec is None:
+            self.compile()
+        result = dict()
+        for name, value in self.codec.decode_array(frames, names).items():
+            signal = self.schema.signals[name] if self.schema is not None else self.signals[name]
+            # 和Signal.value的计算方式保持一致，物理值取整
+            physical_value = np.trunc(value.astype(np.float64) * float(signal.factor) + float(signal.offset))
+            result[name] = value, physical_value.astype(np.int64)
+        return result
 
     def set_value(self, message: MessageType):
         """
         设置message对象
 
-        TAG: 如果要增加或者变更内容，修改这里
+        TAG: 如果要增加或者变更内容，修改get_message_schema
 
         :param message: message字典
         """
-        self.msg_id = message["id"]
-        self.msg_name = message["name"]
-        self.data_length = message["length"]
-        # 根据data的长度来设置data的值
-        for i in range(self.data_length):
-            self.data.append(0)
-        self.sender = message["sender"]
-        #  特殊处理，如果不是Cycle/Event就是CE
-        send_type = message["msg_send_type"]
-        if send_type.upper() == "CYCLE":
-            self.msg_send_type = "Cycle"
-        elif send_type.upper() == "EVENT":
-            self.msg_send_type = "Event"
-        else:
-            self.msg_send_type = "Cycle and Event"
-        if "nm_message" in message:
-            self.nm_message = message["nm_message"]
-        else:
-            self.nm_message = False
-        self.diag_request = message["diag_request"]
-        self.diag_response = message["diag_response"]
-        self.diag_state = message["diag_state"]
-        try:
-            self.is_standard_can = message["is_standard_can"]
-        except KeyError:
-            self.is_standard_can = True
-        try:
-            self.cycle_time = message["msg_cycle_time"]
-            # 必须加上msg_cycle_time大于0才可以判断当前信号为周期信号
-            if self.cycle_time > 0:
-                self.msg_send_type = "Cycle"
-        except KeyError:
-            self.cycle_time = 0
-        try:
-            self.delay_time = message["msg_delay_time"]
-        except KeyError:
-            self.delay_time = 0
-        try:
-            self.cycle_time_fast = message["msg_cycle_time_fast"]
-        except KeyError:
-            self.cycle_time_fast = 0
-        try:
-            self.cycle_time_fast_times = message["gen_msg_nr_of_repetition"]
-        except KeyError:
-            self.cycle_time_fast_times = 0
+        self.set_schema(get_message_schema(message))
 
-        for sig in message["signals"]:
-            signal = Signal()
-            signal.set_value(sig)
-            self.signals[signal.signal_name] = signal
+    def set_schema(self, schema: MessageSchema):
+        """
+        根据只读的schema设置message对象，数据为schema中的默认数据，signal在访问的时候才生成
+
+        :param schema: message的只读定义
+        """
+        self.schema = schema
+        self.msg_id = schema.msg_id
+        self.msg_name = schema.msg_name
+        self.data_length = schema.data_length
+        self.data = bytearray(schema.default_data)
+        self.sender = schema.sender
+        self.msg_send_type = schema.msg_send_type
+        self.nm_message = schema.nm_message
+        self.diag_request = schema.diag_request
+        self.diag_response = schema.diag_response
+        self.diag_state = schema.diag_state
+        self.is_standard_can = schema.is_standard_can
+        self.external_flag = 1 if schema.is_extended else 0
+        self.is_fd = schema.is_fd
+        self.cycle_time = schema.cycle_time
+        self.delay_time = schema.delay_time
+        self.cycle_time_fast = schema.cycle_time_fast
+        self.cycle_time_fast_times = schema.cycle_time_fast_times
+        self.signals = SignalDict(self)
+        self.codec = schema.codec
 
 
 class Signal(object):
@@ -552,33 +870,32 @@ class Signal(object):
         """
         设置signal的值
 
-        TAG: 如果要增加或者变更内容，修改这里
+        TAG: 如果要增加或者变更内容，修改get_signal_schema
 
         :param signal: signal字典
         """
-        self.signal_name = signal["name"]
-        self.bit_length = signal['signal_size']
-        self.start_bit = signal["start_bit"]
-        self.is_sign = signal["is_sign"]
-        self.byte_type = signal["byte_type"]
-        self.factor = signal["factor"]
-        self.offset = signal["offset"]
-        self.minimum = signal["minimum"]
-        self.maximum = signal["maximum"]
-        self.unit = signal["unit"]
-        self.receiver = signal["receiver"]
-        if "start_value" in signal:
-            self.value = signal["start_value"]
-        else:
-            self.value = 0
-        try:
-            self.values = signal["values"]
-        except KeyError:
-            self.values = None
-        try:
-            self.comment = signal["comment"]
-        except KeyError:
-            self.comment = ""
+        self.set_schema(get_signal_schema(signal))
+
+    def set_schema(self, schema: SignalSchema):
+        """
+        根据只读的schema设置signal对象
+
+        :param schema: signal的只读定义
+        """
+        self.signal_name = schema.signal_name
+        self.bit_length = schema.bit_length
+        self.start_bit = schema.start_bit
+        self.is_sign = schema.is_sign
+        self.byte_type = schema.byte_type
+        self.factor = schema.factor
+        self.offset = schema.offset
+        self.minimum = schema.minimum
+        self.maximum = schema.maximum
+        self.unit = schema.unit
+        self.receiver = schema.receiver
+        self.value = schema.start_value
+        self.values = schema.values
+        self.comment = schema.comment
 
     def check_value(self, need_check: bool = False):
         """
@@ -600,17 +917,18 @@ class Signal(object):
 
     def check_start_bit_value(self):
         """
-        检查start bit是否设置正确
+        检查start bit是否设置正确，CAN FD最长64字节，即512位
         """
-        if not check_value(self.start_bit, 0, 0x3f):
-            raise ValueError(f"start bit[{self.start_bit}] must in [0, 0x3f]")
+        max_start_bit = MAX_FD_DATA_LENGTH * _bit_length - 1
+        if not check_value(self.start_bit, 0, max_start_bit):
+            raise ValueError(f"start bit[{self.start_bit}] must in [0, {max_start_bit}]")
 
     def check_bit_length_value(self):
         """
-        检查bit length是否设置正确
+        检查bit length是否设置正确，signal的值最长64位
         """
-        if not check_value(self.bit_length, 0, 0x3f):
-            raise ValueError(f"start bit[{self.bit_length}] must in [0, 0x3f]")
+        if not check_value(self.bit_length, 0, 64):
+            raise ValueError(f"bit length[{self.bit_length}] must in [0, 64]")
 
     @property
     def value(self):
@@ -623,7 +941,9 @@ class Signal(object):
         """
         self.__value = value
         self.__physical_value = int((float(value) * float(self.factor)) + float(self.offset))
-        logger.trace(f"signal[{self.signal_name}]value is {self.__value} and physical value is {self.__physical_value}")
+        if HOT_TRACE:
+            logger.trace(f"signal[{self.signal_name}]value is {self.__value} and "
+                         f"physical value is {self.__physical_value}")
 
     @property
     def physical_value(self):
@@ -636,4 +956,5 @@ class Signal(object):
         if not self.is_sign:
             if self.__value < 0 or self.__value > (2 ** self.bit_length - 1):
                 raise RuntimeError("it need input physical value not bus value")
-        logger.trace(f"physical value is {self.__physical_value} and value is {self.__value}")
+        if HOT_TRACE:
+            logger.trace(f"physical value is {self.__physical_value} and value is {self.__value}")
@@ -0,0 +1,394 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        benchmark.py
+# @Author:      lizhe
+# @Created:     2023/3/28 - 20:16
+# --------------------------------------------------------
+import json
+import platform
+import random
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Dict, List, Sequence, Tuple, Optional
+
+import numpy as np
+
+from automotive.logger.logger import logger, lazy_logger, log_level, hex_list
+from ...can_service import CANService
+from ...message import Message
+from ...common.enums import CanBoxDeviceEnum
+from ...common.typehints import Messages
+from ...hardware.virtual.responder import IsoTpEchoResponder
+
+"""
+CAN性能测试
+
+通过虚拟设备(CanBoxDeviceEnum.VIRTUAL)测试CANService能够承受的性能，包括：
+
+1、transmit、send_can_signal_message、receive_can_message每秒能够处理的帧数
+
+2、N个周期信号的周期误差的百分位数
+
+3、send_and_receive_uds_message的往返时间
+
+4、栈中有10k/100k/500k帧的时候check_signal_value的耗时
+
+5、当前日志等级下，热点路径中一条不会输出的日志在直接格式化、先判断等级以及延迟格式化三种写法下每一帧的耗时
+
+测试结果是一个扁平的字典，key是测试项的名字，以fps结尾的数值越大越好，其他的(毫秒，以_us结尾的是微秒)越小越好，
+
+可以保存成json文件，并通过compare对比两次的结果，找出性能下降的测试项。
+"""
+
+# 诊断的请求ID、响应ID和功能寻址ID
+_request_id = 0x7A0
+_response_id = 0x7A8
+_function_id = 0x7DF
+
+
+def get_benchmark_messages(size: int = 20, cycle_time: int = 10) -> Messages:
+    """
+    生成测试用的矩阵表
+
+    :param size: message的数量
+
+    :param cycle_time: 周期，单位毫秒
+
+    :return: 可以用于CANService的messages
+    """
+    messages = []
+    for index in range(size):
+        signals = []
+        for signal_index in range(4):
+            signals.append({
+                "name": f"BENCH_{index}_{signal_index}",
+                "signal_size": 16,
+                "start_bit": signal_index * 16,
+                "is_sign": signal_index % 2 == 1,
+                "byte_type": True,
+                "factor": 1,
+                "offset": 0,
+                "minimum": -32768,
+                "maximum": 32767,
+                "unit": "",
+                "receiver": ""
+            })
+        messages.append({
+            "id": 0x100 + index,
+            "name": f"BENCH_{index}",
+            "length": 8,
+            "sender": "BENCH",
+            "msg_send_type": "Cycle",
+            "msg_cycle_time": cycle_time,
+            "diag_request": False,
+            "diag_response": False,
+            "diag_state": False,
+            "signals": signals
+        })
+    return messages
+
+
+def get_percentiles(values: Sequence[float], prefix: str) -> Dict[str, float]:
+    """
+    计算百分位数
+
+    :param values: 数值
+
+    :param prefix: 结果的key的前缀
+
+    :return: p50/p90/p99/max
+    """
+    if len(values) == 0:
+        return dict()
+    values = np.asarray(values, dtype=np.float64)
+    result = dict()
+    for percent in 50, 90, 99:
+        result[f"{prefix}.p{percent}_ms"] = float(np.percentile(values, percent))
+    result[f"{prefix}.max_ms"] = float(np.max(values))
+    return result
+
+
+class CanBenchmark(object):
+    """
+    CAN性能测试
+    """
+
+    def __init__(self, message_size: int = 20, cycle_time: int = 10, can_fd: bool = False,
+                 use_scheduler: bool = False):
+        """
+        :param message_size: 测试用的message数量
+
+        :param cycle_time: 周期信号的周期，单位毫秒
+
+        :param can_fd: 是否使用CANFD
+
+        :param use_scheduler: 是否使用单线程的发送调度器
+        """
+        self.__message_size = message_size
+        self.__cycle_time = cycle_time
+        self.__can_fd = can_fd
+        self.__use_scheduler = use_scheduler
+        self.__service = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        """
+        在虚拟设备上创建CANService，并挂载UDS的应答器
+        """
+        messages = get_benchmark_messages(self.__message_size, self.__cycle_time)
+        self.__service = CANService(messages, can_box_device=CanBoxDeviceEnum.VIRTUAL, can_fd=self.__can_fd,
+                                    use_scheduler=self.__use_scheduler)
+        self.__service.open_can()
+        responder = IsoTpEchoResponder(_request_id, _response_id, _function_id, self.__can_fd)
+        self.__service.can_bus.can_device.add_responder(responder)
+        self.__service.init_uds(_request_id, _response_id, _function_id)
+
+    def close(self):
+        """
+        关闭CANService
+        """
+        if self.__service:
+            self.__service.close_can()
+            # CANService是单例，测试完成后需要释放，否则下一次测试拿到的是同一个已经关闭的对象
+            CANService._instance = None
+            self.__service = None
+
+    @staticmethod
+    def __get_fps(count: int, function, *args) -> float:
+        start_time = perf_counter()
+        for _ in range(count):
+            function(*args)
+        return count / (perf_counter() - start_time)
+
+    def __get_message(self, index: int = 0) -> Message:
+        message = Message()
+        message.msg_id = 0x100 + index
+        message.data = [random.randint(0, 0xFF) for _ in range(8)]
+        message.data_length = 8
+        return message
+
+    def transmit(self, count: int = 20000) -> Dict[str, float]:
+        """
+        测试单帧发送和批量发送每秒的帧数
+
+        :param count: 发送的帧数
+        """
+        message = self.__get_message()
+        result = {"transmit.fps": self.__get_fps(count, self.__service.transmit_one, message)}
+        batch = [self.__get_message(x % self.__message_size) for x in range(100)]
+        batch_count = max(count // len(batch), 1)
+        fps = self.__get_fps(batch_count, self.__service.transmit_many, batch) * len(batch)
+        result["transmit_many.fps"] = fps
+        return result
+
+    def send_can_signal_message(self, count: int = 5000) -> Dict[str, float]:
+        """
+        测试设置signal并发送message每秒的次数
+
+        :param count: 调用的次数
+        """
+        service = self.__service
+        start_time = perf_counter()
+        for index in range(count):
+            service.send_can_signal_message("BENCH_0", {"BENCH_0_0": index & 0x7FFF, "BENCH_0_1": -(index & 0x7FFF)})
+        fps = count / (perf_counter() - start_time)
+        service.stop_transmit()
+        return {"send_can_signal_message.fps": fps}
+
+    def receive_can_message(self, count: int = 20000) -> Dict[str, float]:
+        """
+        测试接收并解析message每秒的次数
+
+        :param count: 调用的次数
+        """
+        message = self.__get_message()
+        self.__service.transmit_one(message)
+        # 等待接收线程收到数据
+        start_time = perf_counter()
+        while perf_counter() - start_time < 1:
+            try:
+                self.__service.receive(message.msg_id)
+                break
+            except RuntimeError:
+                sleep(0.001)
+        return {"receive_can_message.fps": self.__get_fps(count, self.__service.receive_can_message, message.msg_id)}
+
+    def jitter(self, continue_time: float = 5) -> Dict[str, float]:
+        """
+        所有message按照周期发送，计算接收到的帧的间隔和周期的误差(绝对值)
+
+        :param continue_time: 持续时间，单位秒
+        """
+        service = self.__service
+        service.clear_stack_data()
+        for message in service.messages.values():
+            service.send_can_message(message)
+        sleep(continue_time)
+        service.stop_transmit()
+        errors = []
+        for msg_id in service.messages:
+            time_stamps = [x.time_stamp for x in service.get_stack_by_id(msg_id)]
+            if len(time_stamps) > 1:
+                # 虚拟设备的时间戳单位是微秒
+                intervals = np.diff(np.asarray(time_stamps, dtype=np.float64)) / 1000
+                errors.extend(np.abs(intervals - self.__cycle_time).tolist())
+        result = {"jitter.frames": float(len(errors))}
+        result.update(get_percentiles(errors, "jitter"))
+        return result
+
+    def uds(self, times: int = 20) -> Dict[str, float]:
+        """
+        测试单帧和多帧诊断的往返时间
+
+        :param times: 每种诊断的次数
+        """
+        result = dict()
+        requests = ("uds_single", [0x22, 0xF1, 0x90]), ("uds_multi", [0x2E, 0xF1, 0x90] + list(range(60)))
+        for name, request in requests:
+            costs = []
+            for _ in range(times):
+                start_time = perf_counter()
+                response = self.__service.send_and_receive_uds_message(request)
+                costs.append((perf_counter() - start_time) * 1000)
+                if len(response) == 0:
+                    logger.warning(f"{name} receive nothing")
+            result.update(get_percentiles(costs, name))
+        return result
+
+    def stack_analysis(self, sizes: Sequence[int] = (10000, 100000, 500000), repeat: int = 3) -> Dict[str, float]:
+        """
+        往栈中填入指定数量的帧，测试check_signal_value的耗时
+
+        :param sizes: 栈中的帧数
+
+        :param repeat: 重复次数，取最小值
+        """
+        service = self.__service
+        bus = service.can_bus
+        result = dict()
+        for size in sizes:
+            service.clear_stack_data()
+            for index in range(size):
+                message = self.__get_message(index % self.__message_size)
+                message.time_stamp = index
+                # 直接放入栈中，不经过设备，只测试分析的耗时
+                bus._append(message)
+            stack = service.get_stack()
+            costs = []
+            for _ in range(repeat):
+                start_time = perf_counter()
+                service.check_signal_value(stack, "BENCH_0_0", 0, count=1, exact=False)
+                costs.append((perf_counter() - start_time) * 1000)
+            result[f"check_signal_value.{size}_ms"] = min(costs)
+        service.clear_stack_data()
+        return result
+
+    def logging(self, count: int = 100000) -> Dict[str, float]:
+        """
+        测试热点路径中每一帧打印trace日志的耗时，日志等级高于trace的时候日志不会输出，只有格式化的开销
+
+        eager是原来直接格式化f-string的写法，guard是先判断log_level，lazy是lazy_logger延迟格式化
+
+        :param count: 调用的次数
+        """
+        message = self.__get_message()
+        msg_id, data = message.msg_id, message.data
+
+        def eager():
+            logger.trace(f"msg id {hex(msg_id)} and data is {list(map(lambda x: hex(x), data))}")
+
+        def guard():
+            if log_level.trace:
+                logger.trace(f"msg id {hex(msg_id)} and data is {hex_list(data)}")
+
+        def lazy():
+            lazy_logger.trace("msg id {} and data is {}", lambda: hex(msg_id), lambda: hex_list(data))
+
+        result = dict()
+        for name, function in ("eager", eager), ("guard", guard), ("lazy", lazy):
+            result[f"logging.{name}_us"] = 1000000 / self.__get_fps(count, function)
+        # 发送的时候每一帧都需要编码
+        message = self.__service.messages[0x100]
+        result["message_update.frame_us"] = 1000000 / self.__get_fps(count, message.update, True)
+        return result
+
+    def run(self) -> Dict[str, float]:
+        """
+        执行所有的测试
+
+        :return: 测试结果
+        """
+        result = dict()
+        for function in (self.transmit, self.send_can_signal_message, self.receive_can_message, self.jitter,
+                         self.uds, self.stack_analysis, self.logging):
+            logger.info(f"benchmark {function.__name__} start")
+            result.update(function())
+        return result
+
+
+def run_benchmark(output_file: Optional[str] = None, **kwargs) -> Dict:
+    """
+    执行所有的性能测试
+
+    :param output_file: 保存结果的json文件，为空则不保存
+
+    :param kwargs: CanBenchmark的参数
+
+    :return: 包含运行环境和测试结果的字典
+    """
+    with CanBenchmark(**kwargs) as benchmark:
+        results = benchmark.run()
+    report = {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": kwargs,
+        "results": results
+    }
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False, indent=4))
+    return report
+
+
+def compare(baseline: str, current: str, tolerance: float = 0.1) -> List[Tuple[str, float, float, float, bool]]:
+    """
+    对比两次性能测试的结果
+
+    :param baseline: 基准结果的json文件
+
+    :param current: 本次结果的json文件
+
+    :param tolerance: 允许的性能下降比例，默认10%
+
+    :return: [(测试项, 基准值, 本次值, 变化比例, 是否性能下降), ...]
+    """
+    with open(baseline, "r", encoding="utf-8") as f:
+        baseline_results = json.load(f)["results"]
+    with open(current, "r", encoding="utf-8") as f:
+        current_results = json.load(f)["results"]
+    rows = []
+    for name, baseline_value in baseline_results.items():
+        if name not in current_results:
+            logger.warning(f"{name} is not in {current}")
+            continue
+        current_value = current_results[name]
+        change = (current_value - baseline_value) / baseline_value if baseline_value else 0.0
+        if name.endswith("fps"):
+            regression = change < -tolerance
+        elif name.endswith(("_ms", "_us")):
+            regression = change > tolerance
+        else:
+            regression = False
+        rows.append((name, baseline_value, current_value, change, regression))
+        flag = "REGRESSION" if regression else ""
+        logger.info(f"{name:<40} {baseline_value:>14.3f} {current_value:>14.3f} {change:>+8.1%} {flag}")
+    return rows
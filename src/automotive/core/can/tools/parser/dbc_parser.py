@@ -7,16 +7,20 @@
 # @Created:     2021/5/1 - 23:38
 # --------------------------------------------------------
 import copy
+import hashlib
 import json
 import os
 import re
-from typing import Dict, Sequence, List
+import tempfile
+from typing import Dict, Sequence, List, Tuple, Optional, Iterable, Iterator
 
 from automotive.logger.logger import logger
 from automotive.utils.excel_utils import ExcelUtils
 
 
 class DbcParser(object):
+    # 缓存格式的版本，解析结果的格式变化的时候需要修改，使旧的缓存失效
+    CACHE_VERSION = 3
     # 定义常量
     TWO_BLANK = "  "
     BLANK = " "
@@ -67,6 +71,13 @@ class DbcParser(object):
     DIAG_RESPONSE = "DiagResponse"
     STANDARD_CAN = "StandardCAN"
     STANDARD_CAN_FD = "StandardCAN_FD"
+    EXTENDED_CAN = "ExtendedCAN"
+    J1939 = "J1939"
+    CAN_FD_SUFFIX = "_FD"
+    # DBC中扩展帧的ID最高位为1
+    EXTENDED_ID_FLAG = 0x80000000
+    MAX_STANDARD_ID = 0x7FF
+    MAX_EXTENDED_ID = 0x1FFFFFFF
     GEN_SIG_START_VALUE = "GenSigStartValue"
     MODE_TRANSMISSION = "ModeTransmission"
     PERIOD = "P茅riode"
@@ -83,17 +94,73 @@ class DbcParser(object):
     RIGHT_BRACKETS = ")"
     RIGHT_CENTER_BRACKETS = "]"
 
-    def parse(self, dbc_file: str, encoding: str = "gbk") -> Sequence[Dict]:
+    def __init__(self, cache_folder: Optional[str] = None):
+        """
+        :param cache_folder: 解析结果缓存的文件夹，默认为系统临时文件夹下的automotive_dbc
+        """
+        self.__cache_folder = cache_folder if cache_folder else os.path.join(tempfile.gettempdir(), "automotive_dbc")
+        # 解析过程中使用的索引，msg_id -> message， (msg_id, signal_name) -> signal
+        self.__message_index = dict()  # type: Dict[int, Dict]
+        self.__signal_index = dict()  # type: Dict[Tuple[int, str], Dict]
+
+    def parse(self, dbc_file: str, encoding: str = "gbk", use_cache: bool = True) -> Sequence[Dict]:
         """
         解析DBC文件为列表类型
+
+        以文件内容的哈希值为key缓存解析结果，文件内容不变的时候直接读取缓存，缓存是json格式，只保存数据
         :param encoding: 编码格式
         :param dbc_file: DBC文件
+        :param use_cache: 是否使用缓存
         :return: messages
         """
-        contents = self.__read_content(dbc_file, encoding)
-        logger.trace(f"contents = {contents}")
-        messages = self.__parse_message(contents)
-        return self.__filter_messages(messages)
+        with open(dbc_file, "rb") as f:
+            raw = f.read()
+        cache_file = self.__get_cache_file(raw, encoding)
+        if use_cache:
+            messages = self.__read_cache(cache_file)
+            if messages is not None:
+                logger.debug(f"read {dbc_file} from cache {cache_file}")
+                return messages
+        contents = raw.decode(encoding, errors="ignore").splitlines()
+        messages = self.__filter_messages(self.__parse_message(contents))
+        if use_cache:
+            self.__write_cache(cache_file, messages)
+        return messages
+
+    def __get_cache_file(self, raw: bytes, encoding: str) -> str:
+        """
+        根据文件内容、编码以及解析器版本计算缓存文件的路径
+        """
+        digest = hashlib.sha1(raw)
+        digest.update(f"{encoding}:{self.CACHE_VERSION}".encode("utf-8"))
+        return os.path.join(self.__cache_folder, f"{digest.hexdigest()}.json")
+
+    @staticmethod
+    def __read_cache(cache_file: str) -> Optional[List[Dict]]:
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                messages = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"read cache {cache_file} failed, error is {e}")
+            return None
+        if not isinstance(messages, list):
+            logger.debug(f"cache {cache_file} is not a message list")
+            return None
+        return messages
+
+    @staticmethod
+    def __write_cache(cache_file: str, messages: List[Dict]):
+        # 先写临时文件再替换，避免多个进程同时解析的时候读到写了一半的缓存
+        temp_file = f"{cache_file}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(messages, f, ensure_ascii=False)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            logger.debug(f"write cache {cache_file} failed, error is {e}")
 
     def parse_to_file(self, dbc_file: str, output_file: str):
         """
@@ -232,19 +299,14 @@ class DbcParser(object):
         with open(json_file, "w", encoding="utf-8") as f:
             f.write(json_str)
 
-    def __filter_messages(self, messages: List[Dict]) -> Sequence[Dict]:
+    def __filter_messages(self, messages: List[Dict]) -> List[Dict]:
         """
-        去除掉大于0x7ff的数据
+        去除掉大于0x7ff且不是扩展帧的数据(如VECTOR__INDEPENDENT_SIG_MSG)
         :param messages:
         :return:
         """
-        new_messages = copy.deepcopy(messages)
-        msg_ids = []
-        for i, message in enumerate(new_messages):
-            if message["id"] > 0x7ff:
-                msg_ids.append(i)
-        for msg_id in msg_ids:
-            new_messages.pop(msg_id)
+        new_messages = [message for message in messages
+                        if message["id"] <= self.MAX_STANDARD_ID or message.get("is_extended", False)]
         self.__set_message_default_value(new_messages)
         return new_messages
 
@@ -284,41 +346,29 @@ class DbcParser(object):
             .replace(f"{self.BLANK}{self.QUOTATION}{self.BLANK}", f"{self.BLANK}{self.QUOTATION}") \
             .strip()
 
-    @staticmethod
-    def __get_message_by_id(messages: Sequence[Dict[str, Sequence]], message_id: int) -> Dict[str, Sequence]:
+    def __get_message_by_id(self, message_id: int) -> Dict[str, Sequence]:
         """
         根据id获取message字典
         """
-        for message in messages:
-            if message["id"] == message_id:
-                return message
-        raise RuntimeError(f"no message id[{message_id}] found in messages")
+        if message_id not in self.__message_index:
+            raise RuntimeError(f"no message id[{message_id}] found in messages")
+        return self.__message_index[message_id]
 
-    @staticmethod
-    def __get_signal_by_name(signals: Sequence[Dict], name: str) -> Dict:
+    def __get_signal_by_name(self, message_id: int, name: str) -> Dict:
         """
-        根据名字获取signal
+        根据message id和名字获取signal
         """
-        for signal in signals:
-            if signal["name"] == name:
-                return signal
-        raise RuntimeError(f"no signal name[{name}] found in signal")
-
-    @staticmethod
-    def __read_from_file(dbc_file: str, encoding: str) -> Sequence[str]:
-        with open(dbc_file, "r", encoding=encoding, errors="ignore") as f:
-            contents = f.readlines()
-            return contents
+        key = message_id, name
+        if key not in self.__signal_index:
+            raise RuntimeError(f"no signal name[{name}] found in signal")
+        return self.__signal_index[key]
 
-    def __read_content(self, dbc_file: str, encoding: str) -> Sequence[str]:
+    def __read_content(self, contents: Iterable[str]) -> Iterator[str]:
         """
-        从DBC文件中读取数据并且处理多行的情况
-        :param dbc_file: dbc文件
-        :return: 处理后的数据串列表
+        逐行读取DBC文件的数据并且处理多行的情况
+        :param contents: dbc文件的每一行
+        :return: 处理后的数据串
         """
-        # 处理后的数据
-        after_handle_contents = []
-        contents = self.__read_from_file(dbc_file, encoding)
         final_content = ""
         need_add = True
         for index, content in enumerate(contents):
@@ -329,15 +379,15 @@ class DbcParser(object):
                                     self.BA_DEF_DEF_REL, self.BA_DEF_REL, self.BA, self.VAL):
                 need_add = True
                 if len(final_content) != 0:
-                    after_handle_contents.append(final_content)
-                    final_content = ""
-                final_content += content
+                    yield final_content
+                final_content = content
             elif self.__judge_content(content, self.CM_ONLY_QUOTATION):
                 need_add = False
             else:
                 if need_add:
                     final_content += content + self.BLANK
-        return after_handle_contents
+        if len(final_content) != 0:
+            yield final_content
 
     @staticmethod
     def __set_message_default_value(messages: Sequence[Dict]):
@@ -357,6 +407,8 @@ class DbcParser(object):
                 message["is_can_fd"] = False
             if "is_standard_can" not in message:
                 message["is_standard_can"] = False
+            if "is_extended" not in message:
+                message["is_extended"] = False
             if "msg_cycle_time_fast" not in message:
                 message["msg_cycle_time_fast"] = 0
             if "msg_delay_time" not in message:
@@ -364,58 +416,56 @@ class DbcParser(object):
             if "nm_message" not in message:
                 message["nm_message"] = False
 
-    def __parse_message(self, contents: Sequence[str]) -> List[Dict]:
-        cm_flag = True
+    def __parse_message(self, contents: Iterable[str]) -> List[Dict]:
+        """
+        一次遍历解析所有的数据，message和signal解析出来以后放到索引中，后面的CM_、BA_、VAL_直接通过索引查找
+        :param contents: dbc文件的每一行
+        :return: messages
+        """
         attr_dict = dict()
         messages = []
-        message = dict()
-        signals = []
-        # 上一行是BO，这一行不是BO导致没有把数据传上去
-        for content in contents:
+        message = None
+        self.__message_index.clear()
+        self.__signal_index.clear()
+        for content in self.__read_content(contents):
             # 处理BO行，及Message
             if content.startswith(self.BO):
-                if len(message) != 0:
-                    if not content.startswith(self.SG):
-                        message["signals"] = signals
-                        messages.append(message)
-                        message = dict()
-                        signals = []
-                    if content.startswith(self.BO):
-                        self.__set_message(message, content)
-                else:
-                    # 解析到了一个message
-                    self.__set_message(message, content)
+                message = dict()
+                # CM_、BA_、VAL_中使用的是DBC中原始的ID
+                dbc_id = self.__set_message(message, content)
+                message["signals"] = []
+                messages.append(message)
+                self.__message_index[dbc_id] = message
             # 处理SG行，主要是signal
-            if content.startswith(self.SG):
+            elif content.startswith(self.SG):
+                if message is None:
+                    logger.debug(f"no message found for signal[{content}]")
+                    continue
                 signal = self.__get_signal(content)
                 logger.trace(f"signal = {signal}")
-                signals.append(signal)
+                message["signals"].append(signal)
+                self.__signal_index[(dbc_id, signal["name"])] = signal
             # 处理CM行
-            if content.startswith(self.CM):
-                # 处理剩下的BO
-                if cm_flag:
-                    message["signals"] = signals
-                    messages.append(message)
-                    signals = []
-                    # message.clear()
-                    cm_flag = False
-                self.__set_comments(messages, content)
+            elif content.startswith(self.CM):
+                self.__set_comments(content)
             # 处理BA_DEF行 （BA的定义）
-            if content.startswith(self.BA_DEF):
+            elif content.startswith(self.BA_DEF):
                 self.__set_message_attribute(attr_dict, content)
             # 处理BA_DEF_DEF行 （BA的默认值）
-            if content.startswith(self.BA_DEF_DEF):
+            elif content.startswith(self.BA_DEF_DEF):
                 self.__set_default_value(messages, content)
             # 处理BA行
-            if content.startswith(self.BA):
-                self.__set_ba_values(messages, attr_dict, content)
+            elif content.startswith(self.BA):
+                self.__set_ba_values(attr_dict, content)
             # 处理VAL行
-            if content.startswith(self.VAL):
-                self.__set_val_values(messages, content)
+            elif content.startswith(self.VAL):
+                self.__set_val_values(content)
+        self.__message_index.clear()
+        self.__signal_index.clear()
         logger.trace(f"messages = {messages}")
         return messages
 
-    def __set_val_values(self, messages: Sequence[Dict], content: str):
+    def __set_val_values(self, content: str):
         """
         /*
          *  处理VAL模块，返回键值对
@@ -450,11 +500,10 @@ class DbcParser(object):
                 other = other[quotation_index + 1:].strip()
                 # 0 "默认状态"  key = 0 value = 默认状态
                 values[key] = re.sub(self.TRIM_BLANK, self.BLANK, value)
-            message = self.__get_message_by_id(messages, message_id)
-            signal = self.__get_signal_by_name(message["signals"], signal_name)
+            signal = self.__get_signal_by_name(message_id, signal_name)
             signal["values"] = values
 
-    def __set_ba_values(self, messages: Sequence[Dict], attr_dict: Dict, content: str):
+    def __set_ba_values(self, attr_dict: Dict, content: str):
         """
         /*
          * 处理BA_ "GenMsgDelayTime" BO_ 1069 0;
@@ -474,7 +523,7 @@ class DbcParser(object):
             name = split[0].strip()
             message_id = int(split[2].strip())
             value = split[3].strip()
-            message = self.__get_message_by_id(messages, message_id)
+            message = self.__get_message_by_id(message_id)
             logger.trace(f"msg id = [{message_id}] && message is {message}")
             self.__handle_bo(message, name, value, attr_dict)
         elif self.SG in ba:
@@ -483,9 +532,7 @@ class DbcParser(object):
             message_id = int(split[2].strip())
             signal_name = split[3].strip()
             value = split[4].strip()
-            message = self.__get_message_by_id(messages, message_id)
-            logger.trace(f"msg id = [{message_id}] && message is {message}")
-            self.__handle_sg(message, name, signal_name, value)
+            self.__handle_sg(message_id, name, signal_name, value)
         else:
             logger.trace(f"not standard ba")
 
@@ -516,7 +563,10 @@ class DbcParser(object):
             diag_value = attr_dict[name][int(value)]
             message["diag_response"] = True if self.YES.upper() == diag_value.upper() else False
         elif name == self.V_FRAME_FORMAT:
-            message["is_standard_can"] = True if self.STANDARD_CAN.upper() == value.upper() else False
+            # 枚举类型的属性值是枚举的序号
+            if name in attr_dict and value.isdigit():
+                value = attr_dict[name][int(value)]
+            self.__set_frame_format(message, value)
         # 针对PSA的DBC做的workaround
         elif name == self.MODE_TRANSMISSION:
             mode_value = attr_dict[name][int(value)]
@@ -531,8 +581,8 @@ class DbcParser(object):
         else:
             logger.debug(f"type is {name}, so nothing to do")
 
-    def __handle_sg(self, message: Dict, name: str, signal_name: str, value: str):
-        signal = self.__get_signal_by_name(message["signals"], signal_name)
+    def __handle_sg(self, message_id: int, name: str, signal_name: str, value: str):
+        signal = self.__get_signal_by_name(message_id, signal_name)
         if name.upper() == self.GEN_SIG_START_VALUE.upper():
             logger.trace(f"value is {value}")
             if self.POINT in value:
@@ -560,7 +610,7 @@ class DbcParser(object):
                     message["msg_cycle_time_fast"] = int(value)
             elif name.upper() == self.V_FRAME_FORMAT.upper():
                 for message in messages:
-                    message["is_standard_can"] = True if self.STANDARD_CAN == value else False
+                    self.__set_frame_format(message, value)
             elif name == self.GEN_MSG_NR_OF_REPETITION:
                 for message in messages:
                     message["gen_msg_nr_of_repetition"] = int(value)
@@ -597,6 +647,19 @@ class DbcParser(object):
             else:
                 logger.trace(f"ba default type is [{name}], so nothing to do")
 
+    def __set_frame_format(self, message: Dict, frame_format: str):
+        """
+        根据VFrameFormat设置帧的类型，如StandardCAN、ExtendedCAN、J1939PG、StandardCAN_FD、ExtendedCAN_FD
+
+        扩展帧也可以通过DBC中ID的最高位判断，所以这里只会设置为扩展帧
+        """
+        frame_format = frame_format.strip()
+        upper = frame_format.upper()
+        message["is_standard_can"] = True if self.STANDARD_CAN.upper() == upper else False
+        message["is_can_fd"] = upper.endswith(self.CAN_FD_SUFFIX)
+        if upper.startswith(self.EXTENDED_CAN.upper()) or upper.startswith(self.J1939):
+            message["is_extended"] = True
+
     def __set_message_attribute(self, attr_dict: Dict, content: str):
         """
         /*
@@ -642,7 +705,7 @@ class DbcParser(object):
                     attr_dict[name] = other.split(self.COMMA)
                     logger.trace(f"ENUM attr_dict[{name}] = {other}")
 
-    def __set_comments(self, messages: Sequence[Dict], content: str):
+    def __set_comments(self, content: str):
         """
         /*
          *  处理CM模块的，返回键值对
@@ -675,11 +738,10 @@ class DbcParser(object):
             logger.trace(f"parse blank_index other = [{other}]")
             # "Seat Vertical Adjust Motor Target Position 座椅垂直调节电机目标位置";
             comment = other.replace(self.QUOTATION, self.BLANK).replace(self.SEMICOLON, self.BLANK)
-            message = self.__get_message_by_id(messages, message_id)
-            signal = self.__get_signal_by_name(message["signals"], signal_name)
+            signal = self.__get_signal_by_name(message_id, signal_name)
             signal["comment"] = re.sub(self.TRIM_BLANK, self.BLANK, comment).strip()
 
-    def __set_message(self, message: Dict, content: str):
+    def __set_message(self, message: Dict, content: str) -> int:
         """
         /*
          * 处理BO模块的，返回键值对
@@ -687,14 +749,21 @@ class DbcParser(object):
          * 解析案例
          * BO_ message_id message_name ':' message_size transmitter {signal} ;
          * 以及SG_ BCM_PMSErrorFlag : 13|2@0+ (1,0) [0|3] ""  HU
+         * 扩展帧的message_id最高位为1，如BO_ 2566844926 J1939_Msg: 8 Vector__XXX
          */
+        :return: DBC中原始的ID
         """
         bo = self.__get_content(content, self.BO)
         logger.trace(f"bo = {bo}")
         # 883 GW_373: 8 Vector__XXX
         blank_index = bo.index(self.BLANK)
-        message_id = bo[:blank_index].strip()
-        message["id"] = int(message_id)
+        dbc_id = int(bo[:blank_index].strip())
+        # VECTOR__INDEPENDENT_SIG_MSG的ID是0xC0000000，去掉最高位以后仍然超出扩展帧的范围，保留原始的ID
+        if dbc_id & self.EXTENDED_ID_FLAG and (dbc_id & ~self.EXTENDED_ID_FLAG) <= self.MAX_EXTENDED_ID:
+            message["id"] = dbc_id & ~self.EXTENDED_ID_FLAG
+            message["is_extended"] = True
+        else:
+            message["id"] = dbc_id
         # GW_373: 8 Vector__XXX
         other = bo[blank_index + 1:]
         logger.trace(f"parse blank_index other = [{other}]")
@@ -710,6 +779,7 @@ class DbcParser(object):
         message["length"] = int(length)
         message["sender"] = sender
         logger.trace(f"message = {message}")
+        return dbc_id
 
     def __get_signal(self, content: str) -> Dict:
         """
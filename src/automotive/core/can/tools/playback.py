@@ -6,26 +6,51 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:42
 # --------------------------------------------------------
-import importlib
-from typing import Sequence, Tuple, Optional
-from time import sleep
+from array import array
+from collections import namedtuple
+from typing import Sequence, Tuple, Optional, Iterable, Iterator, Union
+from time import sleep, perf_counter_ns
+
+import numpy as np
 
 from automotive.logger.logger import logger
 from ..can_service import Can
 from ..message import Message
 from ..common.enums import CanBoxDeviceEnum, BaudRateEnum, TraceTypeEnum
+from .reader.trace_reader import get_messages
+from .reader.registry import get_reader, detect_trace_type, open_trace, Trace
+
+"""
+trace回放
+
+send_trace按照相邻两帧的时间差sleep，sleep本身的误差会一直累加，回放的时间越长偏差越大。
+
+play按照trace中的绝对时间计算每一批帧的发送时间(相对于回放开始的时间)，先sleep到发送时间之前spin_time，剩下的时间忙等，
+
+某一批发送晚了也不会影响后面的帧。trace文件通过Trace.iter_chunks逐块读取，时间相同的帧合并成一批发送，
+
+通过start_time可以从trace中间的某个时间开始回放。
+"""
+
+# 回放的统计，frames和batches是发送的帧数和批数，duration单位秒，其他的是实际发送时间和计划时间的误差，单位毫秒
+PlaybackStatistics = namedtuple("PlaybackStatistics",
+                                ["frames", "batches", "duration", "mean", "std", "p50", "p99", "max"])
+
+# 纳秒和毫秒的转换
+_ns_per_ms = 1000000
 
 
 class TracePlayback(object):
     """
     用于回放CAN设备抓取的trace
 
-    目前支持PCAN、USB_CAN、SPY3（CSV、ASC)和CANoe（ASC)
+    目前支持PCAN、USB_CAN、SPY3（CSV、ASC)、CANoe（ASC)以及CANService录制的二进制日志
     """
 
     def __init__(self, can_box_device: Optional[CanBoxDeviceEnum] = None, baud_rate: BaudRateEnum = BaudRateEnum.HIGH,
                  can_fd: bool = False):
         self.__can = Can(can_box_device=can_box_device, baud_rate=baud_rate, can_fd=can_fd)
+        self.__need_stop = False
 
     @staticmethod
     def __handle_traces(traces: Sequence[Tuple[float, Message]]) -> Sequence[Tuple]:
@@ -45,6 +70,138 @@ class TracePlayback(object):
                 handle_traces.append((current_time - last_time, message))
         return handle_traces
 
+    @staticmethod
+    def __get_batches(trace: Trace, include_ids: Optional[np.ndarray],
+                      exclude_ids: Optional[np.ndarray]) -> Iterator[Tuple[float, np.ndarray]]:
+        """
+        逐块读取trace，并按照时间分批
+
+        :return: (时间，同一时间的帧)的生成器
+        """
+        for chunk in trace.iter_chunks():
+            if include_ids is not None:
+                chunk = chunk[np.isin(chunk["msg_id"], include_ids)]
+            if exclude_ids is not None:
+                chunk = chunk[~np.isin(chunk["msg_id"], exclude_ids)]
+            if len(chunk) == 0:
+                continue
+            time_stamps = chunk["time_stamp"]
+            # 时间变化的位置就是每一批的起点，跨chunk的同一时间的帧会分成两批，发送时间相同
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(time_stamps)) + 1, [len(chunk)]))
+            for start, end in zip(starts[:-1].tolist(), starts[1:].tolist()):
+                yield float(time_stamps[start]), chunk[start:end]
+
+    @staticmethod
+    def __wait_until(deadline: int, spin_time: int):
+        """
+        等待到deadline，先sleep到deadline之前spin_time，剩下的时间忙等
+
+        :param deadline: perf_counter_ns的绝对时间
+
+        :param spin_time: 忙等的时间，单位纳秒
+        """
+        wait_time = deadline - perf_counter_ns()
+        if wait_time > spin_time:
+            sleep((wait_time - spin_time) / 1e9)
+        while perf_counter_ns() < deadline:
+            # 让出GIL，避免接收线程饿死
+            sleep(0)
+
+    @staticmethod
+    def __get_statistics(errors: array, frames: int, duration: float) -> PlaybackStatistics:
+        if len(errors) == 0:
+            return PlaybackStatistics(frames, 0, duration, 0.0, 0.0, 0.0, 0.0, 0.0)
+        values = np.frombuffer(errors, dtype=np.float64)
+        p50, p99 = np.percentile(values, (50, 99)).tolist()
+        return PlaybackStatistics(frames, len(values), duration, float(values.mean()), float(values.std()),
+                                  p50, p99, float(values.max()))
+
+    def stop(self):
+        """
+        停止play，可以在其他线程中调用
+        """
+        self.__need_stop = True
+
+    @staticmethod
+    def open_trace(file: str, trace_type: Optional[TraceTypeEnum] = None) -> Trace:
+        """
+        打开trace文件，不会读取文件内容，可以通过seek跳转到某个时间
+
+        :param file: trace文件
+
+        :param trace_type: 存trace的类型，为空的时候根据文件头自动检测
+
+        :return: Trace
+        """
+        return open_trace(file, trace_type)
+
+    def play(self, trace: Union[str, Trace], trace_type: Optional[TraceTypeEnum] = None, speed: float = 1.0,
+             include_ids: Optional[Iterable[int]] = None, exclude_ids: Optional[Iterable[int]] = None,
+             loop: int = 1, spin_time: float = 1, start_time: Optional[float] = None) -> PlaybackStatistics:
+        """
+        按照trace中的绝对时间回放trace文件，不需要先读取整个文件
+
+        :param trace: trace文件或者open_trace返回的Trace
+
+        :param trace_type: 存trace的类型，为空的时候根据文件头自动检测
+
+        :param speed: 回放速度，2表示两倍速
+
+        :param include_ids: 只回放这些msg id，默认全部
+
+        :param exclude_ids: 不回放这些msg id
+
+        :param loop: 循环次数，0表示一直循环直到调用stop
+
+        :param spin_time: 发送前忙等的时间，单位毫秒，为0的时候完全依赖sleep
+
+        :param start_time: 从trace中的这个时间开始回放，默认从头开始，每次循环都从这个时间开始
+
+        :return: PlaybackStatistics(帧数, 批数, 回放时间, 误差的平均值, 标准差, p50, p99, 最大值)
+        """
+        if speed <= 0:
+            raise ValueError(f"speed must > 0, but now is {speed}")
+        if loop < 0:
+            raise ValueError(f"loop must >= 0, but now is {loop}")
+        if isinstance(trace, str):
+            trace = open_trace(trace, trace_type)
+        if start_time is not None:
+            trace.seek(start_time)
+        include_ids = None if include_ids is None else np.asarray(list(include_ids), dtype=np.uint32)
+        exclude_ids = None if exclude_ids is None else np.asarray(list(exclude_ids), dtype=np.uint32)
+        spin_time = int(spin_time * _ns_per_ms)
+        self.__need_stop = False
+        # 每一批的误差，单位毫秒
+        errors = array("d")
+        frames = 0
+        count = 0
+        start_time = perf_counter_ns()
+        logger.info(f"start to play trace file[{trace.file}] with speed {speed}")
+        while not self.__need_stop and (loop == 0 or count < loop):
+            count += 1
+            loop_start_time = perf_counter_ns()
+            first_time_stamp = None
+            for time_stamp, batch in self.__get_batches(trace, include_ids, exclude_ids):
+                if self.__need_stop:
+                    break
+                if first_time_stamp is None:
+                    first_time_stamp = time_stamp
+                deadline = loop_start_time + int((time_stamp - first_time_stamp) / speed * 1e9)
+                messages = get_messages(batch)
+                self.__wait_until(deadline, spin_time)
+                errors.append((perf_counter_ns() - deadline) / _ns_per_ms)
+                try:
+                    self.__can.transmit_many(messages)
+                except RuntimeError as e:
+                    logger.error(f"the {len(errors)} batch messages transmit failed, error is {e}")
+                frames += len(messages)
+            if first_time_stamp is None:
+                logger.warning(f"no message need to play in trace file[{trace.file}]")
+                break
+        statistics = self.__get_statistics(errors, frames, (perf_counter_ns() - start_time) / 1e9)
+        logger.info(f"play done, {statistics}")
+        return statistics
+
     def open_can(self):
         """
         对CAN设备进行打开、初始化等操作，并同时开启设备的帧接收线程。
@@ -57,21 +214,17 @@ class TracePlayback(object):
         """
         self.__can.close_can()
 
-    def read_trace(self, file: str, trace_type: TraceTypeEnum) -> Sequence[Tuple[float, Message]]:
+    def read_trace(self, file: str, trace_type: Optional[TraceTypeEnum] = None) -> Sequence[Tuple[float, Message]]:
         """
         从文件中读取并生成可以发送的trace列表
 
         :param file: trace文件
 
-        :param trace_type:  存trace的类型，支持vspy3和cantools以及pcan， canoe存的log
+        :param trace_type:  存trace的类型，支持vspy3和cantools以及pcan， canoe存的log，为空的时候根据文件头自动检测
 
         :return: trace 列表
         """
-        module_name, class_name = trace_type.value
-        # 动态导入模块
-        module = importlib.import_module(f"automotive.core.can.trace_reader.{module_name}")
-        # 实例化模块的类名
-        reader = getattr(module, class_name)()
+        reader = get_reader(trace_type if trace_type else detect_trace_type(file))
         logger.info(f"read all messages in trace file[{file}]")
         # 由于统一了接口，调用统一的方法就可以实现读取的功能
         traces = reader.read(file)
@@ -86,12 +239,20 @@ class TracePlayback(object):
         """
         # 初始的时间
         logger.info("start to send message")
+        # 时间相同的消息合并成一批发送
+        batches = []
         for index, trace in enumerate(traces):
             sleep_time, msg = trace
+            if index != 0 and sleep_time == 0:
+                batches[-1][1].append(msg)
+            else:
+                batches.append((sleep_time, [msg]))
+        for index, batch in enumerate(batches):
+            sleep_time, messages = batch
             if index != 0:
                 sleep(sleep_time)
             try:
-                self.__can.transmit_one(msg)
-            except RuntimeError:
-                logger.error(f"the {index + 1} message transmit failed")
+                self.__can.transmit_many(messages)
+            except RuntimeError as e:
+                logger.error(f"the {index + 1} batch messages transmit failed, error is {e}")
         logger.info("message send done")
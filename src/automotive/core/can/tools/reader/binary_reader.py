@@ -0,0 +1,49 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        binary_reader.py
+# @Author:      lizhe
+# @Created:     2023/4/6 - 21:10
+# --------------------------------------------------------
+from typing import Tuple, Optional, Iterator, List
+
+import numpy as np
+
+from .trace_reader import TraceReader, DEFAULT_CHUNK_SIZE, get_frame_dtype
+from ...common.recorder import CanLog, FLAG_TRANSMIT, FLAG_EXTENDED, FLAG_FD
+
+
+class BinaryReader(TraceReader):
+    """
+    读取CanRecorder录制的二进制日志，文件通过memmap映射，不需要逐行解析，position是记录的序号
+    """
+    width = 64
+
+    def __init__(self, include_transmit: bool = True):
+        """
+        :param include_transmit: 是否包含录制时发送的帧
+        """
+        self.__include_transmit = include_transmit
+
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes]]:
+        raise RuntimeError("binary log can not be parsed by line")
+
+    def build_index(self, file: str, step: int = 1000) -> List[Tuple[float, int]]:
+        time_stamps = CanLog(file).records["time_stamp"]
+        positions = range(0, len(time_stamps), step)
+        return list(zip(time_stamps[::step].tolist(), positions))
+
+    def iter_chunks(self, file: str, chunk_size: int = DEFAULT_CHUNK_SIZE, position: int = 0) -> Iterator[np.ndarray]:
+        records = CanLog(file).records
+        for start in range(position, len(records), chunk_size):
+            # 每次只从memmap中读取一个chunk
+            records_chunk = records[start:start + chunk_size]
+            if not self.__include_transmit:
+                records_chunk = records_chunk[(records_chunk["flags"] & FLAG_TRANSMIT) == 0]
+            chunk = np.empty(len(records_chunk), dtype=get_frame_dtype(self.width))
+            for name in chunk.dtype.names:
+                chunk[name] = records_chunk[name]
+            # 只保留扩展帧和CANFD的标志位
+            chunk["flags"] &= FLAG_EXTENDED | FLAG_FD
+            yield chunk
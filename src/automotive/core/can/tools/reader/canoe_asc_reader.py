@@ -6,43 +6,30 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:44
 # --------------------------------------------------------
-import re
-from typing import Sequence, Tuple
+from typing import Tuple, Optional
 
-from automotive.core.can.message import Message
 from .trace_reader import TraceReader
-from automotive.logger.logger import logger
+from ...common.recorder import FLAG_EXTENDED
 
 
 class CanoeAscReader(TraceReader):
 
-    def read(self, file: str) -> Sequence[Tuple[float, Message]]:
-        contents = self.__filter_content(file)
-        logger.debug(f"trace size = {len(contents)}")
-        return self.__convert(contents)
-
-    @staticmethod
-    def __filter_content(file: str):
-        with open(file, "r") as f:
-            lines = f.readlines()
-            return list(filter(lambda x: len(x.split(" ")) == 41, lines))
-
-    @staticmethod
-    def __convert(contents: Sequence[str]) -> Sequence[Tuple[float, Message]]:
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes, int]]:
         """
-        解析content，并生成message对象
+        解析一行内容，按照空白分割
           10.868138 1  406             Rx   d 8 06 01 00 00 00 00 00 00  Length = 237910 BitCount = 123 ID = 1030
-        :param contents:
-        :return: List<Message>
+        :param line: 一行内容
+        :return: (时间，帧ID，数据，flags)
         """
-        trace = []
-        for content in contents:
-            time = re.search(r"\d+\.\d{6}", content).group(0)
-            data = re.search(r"(\s\w{2}){8}", content).group(0).strip().split(" ")
-            msg_id = re.search(r"ID\s=\s\d+", content).group(0).split("=")[1]
-            logger.debug(f"{time}, {data}, {msg_id}")
-            message = Message()
-            message.msg_id = int(msg_id)
-            message.data = list(map(lambda x: int(x, 16), data))
-            trace.append((float(time), message))
-        return trace
+        values = line.split()
+        # 只处理数据帧
+        if len(values) < 6 or values[4] != "d":
+            return None
+        dlc = int(values[5], 16)
+        # 扩展帧的ID以x结尾
+        flags = FLAG_EXTENDED if values[2][-1] in "xX" else 0
+        msg_id = int(values[2].rstrip("xX"), 16)
+        data = bytes.fromhex("".join(values[6:6 + dlc]))
+        if len(data) != dlc:
+            raise ValueError(f"data length {len(data)} is not equal dlc {dlc}")
+        return float(values[0]), msg_id, data, flags
@@ -6,43 +6,25 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:44
 # --------------------------------------------------------
-import re
-from typing import Tuple, Sequence
+from typing import Tuple, Optional
 
-from automotive.core.can.message import Message
 from .trace_reader import TraceReader
-from automotive.logger.logger import logger
 
 
 class PCanReader(TraceReader):
 
-    def read(self, file: str) -> Sequence[Tuple[float, Message]]:
-        contents = self.__filter_content(file)
-        logger.debug(f"trace size = {len(contents)}")
-        return self.__convert(contents)
-
-    @staticmethod
-    def __filter_content(file: str):
-        with open(file, "r") as f:
-            lines = f.readlines()
-            return list(filter(lambda x: "Rx" in x, lines))
-
-    @staticmethod
-    def __convert(contents: Sequence[str]) -> Sequence[Tuple[float, Message]]:
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes]]:
         """
-        解析content，并生成message对象
+        解析一行内容，按照空白分割，时间的单位是毫秒
              3)    216628.2  Rx         0406  8  06 01 00 00 00 00 00 00
-        :param contents:
-        :return: List<Message>
+        :param line: 一行内容
+        :return: (时间，帧ID，数据)
         """
-        trace = []
-        for content in contents:
-            time = re.search(r"\s\d+\.\d+\s", content).group(0)
-            data = re.search(r"(\s\w{2}){8}", content).group(0).strip().split(" ")
-            msg_id = re.search(r"\s\w{4}\s", content).group(0)
-            logger.debug(f"{time}, {data}, {msg_id}")
-            message = Message()
-            message.msg_id = int(msg_id, 16)
-            message.data = list(map(lambda x: int(x, 16), data))
-            trace.append((float(time) / 1000, message))
-        return trace
+        values = line.split()
+        if len(values) < 5 or values[2] != "Rx":
+            return None
+        dlc = int(values[4])
+        data = bytes.fromhex("".join(values[5:5 + dlc]))
+        if len(data) != dlc:
+            raise ValueError(f"data length {len(data)} is not equal dlc {dlc}")
+        return float(values[1]) / 1000, int(values[3], 16), data
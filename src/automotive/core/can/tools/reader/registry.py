@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        registry.py
+# @Author:      lizhe
+# @Created:     2023/4/8 - 10:26
+# --------------------------------------------------------
+import importlib
+from bisect import bisect_left
+from itertools import islice
+from threading import Lock
+from typing import Dict, Optional, List, Tuple, Iterator
+
+import numpy as np
+
+from automotive.logger.logger import logger
+from .trace_reader import TraceReader, DEFAULT_CHUNK_SIZE, get_messages
+from ...common.enums import TraceTypeEnum
+from ...common.recorder import is_can_log
+from ...message import Message
+
+"""
+TraceReader的注册表
+
+每种trace类型的reader只导入和实例化一次，reader本身是无状态的，可以在多个线程中共用。
+
+detect_trace_type通过文件头判断trace的类型，二进制日志检查magic，文本格式的trace用每种reader解析文件开头的若干行，能解析最多行的就是该类型。
+
+Trace是延迟解析的trace对象，第一次seek的时候才建立稀疏的时间索引(每隔index_step行记录一次时间和位置)，
+
+seek的时候通过索引找到目标时间之前最近的位置开始读取，不需要从文件开头解析，要求trace中的时间是递增的。
+"""
+
+# 检测类型的时候的优先顺序，CANoe和SPY3的ASC格式相同，优先认为是CANoe
+_detect_order = (TraceTypeEnum.CANOE_ASC, TraceTypeEnum.SPY3_ASC, TraceTypeEnum.PCAN, TraceTypeEnum.USB_CAN,
+                 TraceTypeEnum.SPY3_CSV)
+
+_readers = dict()  # type: Dict[TraceTypeEnum, TraceReader]
+_readers_lock = Lock()
+
+
+def get_reader(trace_type: TraceTypeEnum) -> TraceReader:
+    """
+    获取trace类型对应的reader，只在第一次获取的时候导入模块
+
+    :param trace_type: trace类型
+
+    :return: TraceReader
+    """
+    with _readers_lock:
+        if trace_type not in _readers:
+            module_name, class_name = trace_type.value
+            # 动态导入模块
+            module = importlib.import_module(f"{__package__}.{module_name}")
+            # 实例化模块的类名
+            _readers[trace_type] = getattr(module, class_name)()
+        return _readers[trace_type]
+
+
+def detect_trace_type(file: str, sample_size: int = 100) -> TraceTypeEnum:
+    """
+    通过文件头检测trace的类型
+
+    :param file: trace文件
+
+    :param sample_size: 用于检测的行数
+
+    :return: trace类型
+    """
+    if is_can_log(file):
+        return TraceTypeEnum.BINARY
+    with open(file, "r", errors="ignore") as f:
+        lines = list(islice(f, sample_size))
+    best_type, best_count = None, 0
+    for trace_type in _detect_order:
+        reader = get_reader(trace_type)
+        count = 0
+        for line in lines:
+            try:
+                if reader._parse_line(line) is not None:
+                    count += 1
+            except (ValueError, IndexError):
+                continue
+        if count > best_count:
+            best_type, best_count = trace_type, count
+    if best_type is None:
+        raise ValueError(f"trace type of {file} can not be detected")
+    logger.debug(f"{file} is {best_type.name}, {best_count} of {len(lines)} lines can be parsed")
+    return best_type
+
+
+class Trace(object):
+    """
+    延迟解析、可以跳转的trace
+    """
+
+    def __init__(self, file: str, trace_type: Optional[TraceTypeEnum] = None, index_step: int = 1000):
+        """
+        :param file: trace文件
+
+        :param trace_type: trace类型，为空的时候自动检测
+
+        :param index_step: 时间索引的间隔行数(二进制日志是记录数)
+        """
+        self.__file = file
+        self.__trace_type = trace_type if trace_type else detect_trace_type(file)
+        self.__reader = get_reader(self.__trace_type)
+        self.__index_step = index_step
+        # 时间索引，第一次seek的时候建立
+        self.__index_times = None  # type: Optional[List[float]]
+        self.__index_positions = None  # type: Optional[List[int]]
+        # 开始读取的位置和时间
+        self.__position = 0
+        self.__start_time = None  # type: Optional[float]
+
+    @property
+    def file(self) -> str:
+        return self.__file
+
+    @property
+    def trace_type(self) -> TraceTypeEnum:
+        return self.__trace_type
+
+    @property
+    def reader(self) -> TraceReader:
+        return self.__reader
+
+    @property
+    def start_time(self) -> Optional[float]:
+        """
+        seek的时间，没有seek的时候为None
+        """
+        return self.__start_time
+
+    def __build_index(self):
+        if self.__index_times is None:
+            index = self.__reader.build_index(self.__file, self.__index_step)
+            self.__index_times = [x[0] for x in index]
+            self.__index_positions = [x[1] for x in index]
+            logger.debug(f"build time index of {self.__file}, size is {len(index)}")
+
+    def get_index(self) -> List[Tuple[float, int]]:
+        """
+        获取时间索引
+
+        :return: [(时间，position), ...]
+        """
+        self.__build_index()
+        return list(zip(self.__index_times, self.__index_positions))
+
+    def seek(self, time_stamp: Optional[float]):
+        """
+        跳转到某个时间，之后读取的帧的时间都大于等于该时间
+
+        :param time_stamp: trace中的时间，为None的时候回到文件开头
+        """
+        if time_stamp is None:
+            self.__position = 0
+            self.__start_time = None
+            return
+        self.__build_index()
+        # 时间小于time_stamp的最后一个索引，同一时间的帧可能跨过索引，所以不能用等于的索引
+        index = bisect_left(self.__index_times, time_stamp) - 1
+        self.__position = self.__index_positions[index] if index >= 0 else 0
+        self.__start_time = time_stamp
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[np.ndarray]:
+        """
+        从seek的位置开始逐块读取
+
+        :param chunk_size: 每个chunk最多的帧数
+
+        :return: 结构化数组的生成器，字段参考trace_reader.frame_dtype
+        """
+        start_time = self.__start_time
+        for chunk in self.__reader.iter_chunks(self.__file, chunk_size, self.__position):
+            if start_time is not None:
+                # 索引的位置在start_time之前，去掉前面的帧
+                chunk = chunk[np.searchsorted(chunk["time_stamp"], start_time):]
+                if len(chunk) == 0:
+                    continue
+                start_time = None
+            yield chunk
+
+    def __iter__(self) -> Iterator[Tuple[float, Message]]:
+        for chunk in self.iter_chunks():
+            for message in get_messages(chunk):
+                yield message.time_stamp, message
+
+
+def open_trace(file: str, trace_type: Optional[TraceTypeEnum] = None, index_step: int = 1000) -> Trace:
+    """
+    打开trace文件，不会读取文件内容
+
+    :param file: trace文件
+
+    :param trace_type: trace类型，为空的时候自动检测
+
+    :param index_step: 时间索引的间隔行数
+
+    :return: Trace
+    """
+    return Trace(file, trace_type, index_step)
@@ -6,15 +6,202 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:45
 # --------------------------------------------------------
+import locale
 from abc import ABCMeta, abstractmethod
-from typing import Tuple, Sequence
+from typing import Tuple, Sequence, Iterator, Optional, List
+
+import numpy as np
 
 from automotive.core.can.message import Message
+from automotive.logger.logger import logger
+from ...common.recorder import FLAG_EXTENDED, FLAG_FD
+
+"""
+trace文件的读取
+
+所有的TraceReader都通过iter_chunks逐行读取文件，每chunk_size帧生成一个NumPy结构化数组，字段如下：
+
+    time_stamp: 时间，单位秒
+
+    msg_id: 帧ID
+
+    flags: 帧的标志位，和CanRecorder的FLAG_EXTENDED、FLAG_FD相同，trace中没有记录的时候为0
+
+    dlc: 数据长度
+
+    data: 数据，长度不足的部分补0
+
+这样读取很长的trace也只占用一个chunk的内存，read则保留原来返回(时间，Message对象)列表的接口
+
+position是reader定义的读取位置，文本格式的trace是行在文件中的字节偏移，可以从build_index得到的位置开始读取，实现跳转
+"""
+
+# 默认每个chunk的帧数
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def get_frame_dtype(width: int = 8) -> np.dtype:
+    """
+    获取帧的结构化数组类型
+
+    :param width: data的长度，CAN为8，CANFD为64
+
+    :return: NumPy的dtype
+    """
+    return np.dtype([("time_stamp", np.float64), ("msg_id", np.uint32), ("flags", np.uint8), ("dlc", np.uint8),
+                     ("data", np.uint8, (width,))])
+
+
+# CAN帧的结构化数组类型
+frame_dtype = get_frame_dtype(8)
+# CANFD帧的结构化数组类型
+fd_frame_dtype = get_frame_dtype(64)
+
+
+def get_messages(chunk: np.ndarray) -> List[Message]:
+    """
+    把结构化数组转换成Message对象
+
+    :param chunk: iter_chunks生成的结构化数组
+
+    :return: 消息列表，时间保存在time_stamp中
+    """
+    # 一次性转换成bytes，每一帧的数据只需要切片
+    width = chunk["data"].shape[1]
+    buffer = chunk["data"].tobytes()
+    messages = []
+    for index, (time_stamp, msg_id, flags, dlc) in enumerate(zip(chunk["time_stamp"].tolist(),
+                                                                 chunk["msg_id"].tolist(),
+                                                                 chunk["flags"].tolist(), chunk["dlc"].tolist())):
+        message = Message()
+        message.msg_id = msg_id
+        # 没有标志位的时候由Message根据ID和数据长度判断
+        message.external_flag = 1 if flags & FLAG_EXTENDED else 0
+        message.is_fd = bool(flags & FLAG_FD)
+        message.data = buffer[index * width:index * width + dlc]
+        message.data_length = dlc
+        message.time_stamp = time_stamp
+        messages.append(message)
+    return messages
 
 
 class TraceReader(metaclass=ABCMeta):
+    # data的长度，超过该长度的帧会被跳过
+    width = 8
+    # 读取文件的编码，为空则使用系统默认的编码
+    encoding = None
 
     @abstractmethod
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes]]:
+        """
+        解析一行内容
+
+        :param line: 一行内容
+
+        :return: (时间，帧ID，数据)，trace中记录了扩展帧或者CANFD的时候返回(时间，帧ID，数据，flags)，
+
+            不是数据帧的时候返回None，格式不对的时候可以直接抛出ValueError或者IndexError
+        """
+        pass
+
+    def _get_lines(self, lines: Iterator[Tuple[int, str]], position: int) -> Iterator[Tuple[int, str]]:
+        """
+        获取需要解析的行，默认是所有行，有表头等需要跳过的时候重写该方法
+
+        :param lines: (字节偏移，行)的迭代器
+
+        :param position: 开始读取的字节偏移，为0表示从文件开头读取
+
+        :return: (字节偏移，行)的迭代器
+        """
+        return lines
+
+    def __read_lines(self, file: str, position: int) -> Iterator[Tuple[int, str]]:
+        """
+        以二进制的方式读取文件，这样才能知道每一行的字节偏移
+        """
+        encoding = self.encoding if self.encoding else locale.getpreferredencoding(False)
+        with open(file, "rb") as f:
+            f.seek(position)
+            for line in f:
+                yield position, line.decode(encoding, errors="ignore")
+                position += len(line)
+
+    def build_index(self, file: str, step: int = 1000) -> List[Tuple[float, int]]:
+        """
+        建立稀疏的时间索引，每隔step行解析一行的时间，不需要解析所有的行
+
+        :param file: trace文件
+
+        :param step: 索引的间隔行数
+
+        :return: [(时间，position), ...]，按照文件中的顺序排列
+        """
+        index = []
+        count = 0
+        for offset, line in self._get_lines(self.__read_lines(file, 0), 0):
+            count -= 1
+            if count > 0:
+                continue
+            try:
+                frame = self._parse_line(line)
+            except (ValueError, IndexError):
+                continue
+            if frame is not None:
+                index.append((frame[0], offset))
+                count = step
+        return index
+
+    def __get_chunk(self, time_stamps: List[float], msg_ids: List[int], flags: List[int],
+                    datas: List[bytes]) -> np.ndarray:
+        size = len(time_stamps)
+        chunk = np.empty(size, dtype=get_frame_dtype(self.width))
+        chunk["time_stamp"] = time_stamps
+        chunk["msg_id"] = msg_ids
+        chunk["flags"] = flags
+        chunk["dlc"] = [len(x) for x in datas]
+        # 一次性把所有的数据转换成二维数组
+        buffer = b"".join(x.ljust(self.width, b"\x00") for x in datas)
+        chunk["data"] = np.frombuffer(buffer, dtype=np.uint8).reshape(size, self.width)
+        return chunk
+
+    def iter_chunks(self, file: str, chunk_size: int = DEFAULT_CHUNK_SIZE, position: int = 0) -> Iterator[np.ndarray]:
+        """
+        逐行读取trace文件，每chunk_size帧生成一个结构化数组
+
+        :param file: trace文件
+
+        :param chunk_size: 每个chunk最多的帧数
+
+        :param position: 开始读取的位置，必须是0或者build_index返回的位置
+
+        :return: 结构化数组的生成器，字段参考frame_dtype
+        """
+        time_stamps, msg_ids, flags, datas = [], [], [], []
+        skip_count = 0
+        for _, line in self._get_lines(self.__read_lines(file, position), position):
+            try:
+                frame = self._parse_line(line)
+            except (ValueError, IndexError):
+                skip_count += 1
+                continue
+            if frame is None:
+                continue
+            time_stamp, msg_id, data = frame[:3]
+            if len(data) > self.width:
+                skip_count += 1
+                continue
+            time_stamps.append(time_stamp)
+            msg_ids.append(msg_id)
+            flags.append(frame[3] if len(frame) > 3 else 0)
+            datas.append(data)
+            if len(time_stamps) == chunk_size:
+                yield self.__get_chunk(time_stamps, msg_ids, flags, datas)
+                time_stamps, msg_ids, flags, datas = [], [], [], []
+        if time_stamps:
+            yield self.__get_chunk(time_stamps, msg_ids, flags, datas)
+        logger.debug(f"skip {skip_count} lines in {file}")
+
     def read(self, file: str) -> Sequence[Tuple[float, Message]]:
         """
         从文件中读取内容，并生成一个Message对象的列表，
@@ -22,4 +209,8 @@ class TraceReader(metaclass=ABCMeta):
         :param file: trace文件
         :return: 有序列表
         """
-        pass
+        traces = []
+        for chunk in self.iter_chunks(file):
+            traces.extend((message.time_stamp, message) for message in get_messages(chunk))
+        logger.debug(f"trace size = {len(traces)}")
+        return traces
@@ -6,54 +6,34 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:45
 # --------------------------------------------------------
-import re
-from typing import Sequence, Tuple
+from typing import Tuple, Optional, Iterator
 
-from automotive.core.can.message import Message
 from .trace_reader import TraceReader
-from automotive.logger.logger import logger
 
 
 class UsbCanReader(TraceReader):
 
-    def read(self, file: str) -> Sequence[Tuple[float, Message]]:
-        contents = self.__filter_content(file)
-        logger.debug(f"trace size = {len(contents)}")
-        return self.__convert(contents)
+    def _get_lines(self, lines: Iterator[Tuple[int, str]], position: int) -> Iterator[Tuple[int, str]]:
+        # 第一行是表头
+        if position == 0:
+            next(lines, None)
+        return lines
 
-    @staticmethod
-    def __filter_content(file: str):
-        with open(file, "r") as f:
-            lines = f.readlines()
-            lines.pop(0)
-            return lines
-
-    def __convert(self, contents: Sequence) -> Sequence[Tuple[float, Message]]:
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes]]:
         """
-        解析content，并生成message对象
+        解析一行内容，按照逗号分割
         00345,="09:35:34.992",0x376549,ch1,接收,0x0406,数据帧,标准帧,0x08,x| 06 01 00 00 00 00 00 00
-        :param contents:
-        :return: List<Message>
+        :param line: 一行内容
+        :return: (时间，帧ID，数据)
         """
-        trace = []
-        for content in contents:
-            time = re.search(r"\d{2}:\d{2}:\d{2}\.\d{3}", content).group(0)
-            data = re.search(r"(\s\w{2}){8}", content).group(0).strip().split(" ")
-            msg_id = re.search(r"0x\w{4},", content).group(0)[:-1]
-            logger.debug(f"{time}, {data}, {msg_id}")
-            message = Message()
-            message.msg_id = int(msg_id, 16)
-            message.data = list(map(lambda x: int(x, 16), data))
-            trace.append((self.__get_time(time), message))
-        return trace
+        values = line.split(",")
+        dlc = int(values[8], 16)
+        data = bytes.fromhex(values[9].split("|")[1])[:dlc]
+        return self.__get_time(values[1].strip('="')), int(values[5], 16), data
 
     @staticmethod
-    def __get_time(hex_time):
-        splits = hex_time.split(".")
-        date_time = splits[0].split(":")
-        hour = date_time[0]
-        minutes = date_time[1]
-        seconds = date_time[2]
-        millisecond = splits[1]
+    def __get_time(hex_time: str) -> float:
+        date_time, millisecond = hex_time.split(".")
+        hour, minutes, seconds = date_time.split(":")
         current_time = (int(hour) * 60 * 60 + int(minutes) * 60 + int(seconds)) * 1000 + int(millisecond)
         return current_time / 1000
@@ -6,53 +6,30 @@
 # @Author:      lizhe
 # @Created:     2021/5/1 - 23:45
 # --------------------------------------------------------
-from typing import Sequence, Tuple
+from typing import Tuple, Optional, Iterator
 
-from automotive.core.can.message import Message
 from .trace_reader import TraceReader
-from automotive.logger.logger import logger
 
 
 class VspyCsvReader(TraceReader):
 
-    def read(self, file: str) -> Sequence[Tuple[float, Message]]:
-        contents = self.__filter_content(file)
-        logger.debug(f"trace size = {len(contents)}")
-        return self.__convert(contents)
+    def _get_lines(self, lines: Iterator[Tuple[int, str]], position: int) -> Iterator[Tuple[int, str]]:
+        # 每一帧有两行，隔一行取一个数据(去掉重复的部分)，position一定是保留的那一行，所以从position开始重新计数
+        count = 0
+        for offset, line in lines:
+            values = line.split(",")
+            if len(values) < 23 or not values[0].isdigit():
+                continue
+            if count % 2 == 0:
+                yield offset, line
+            count += 1
 
-    @staticmethod
-    def __filter_content(file: str):
-        with open(file, "r") as f:
-            lines = f.readlines()
-            return list(filter(lambda x: len(x.split(",")) >= 23, lines))
-
-    @staticmethod
-    def __convert(contents: Sequence) -> Sequence[Tuple[float, Message]]:
+    def _parse_line(self, line: str) -> Optional[Tuple[float, int, bytes]]:
         """
-        解析content，并生成message对象
+        解析一行内容，按照逗号分割
         2,0.281,0,67108866,F,T,PDC_1,HS CAN,BCM1,25C,F,F,00,00,00,00,00,00,00,00,,,SysSt_PDC,Off,
-        :param contents:
-        :return: List<Message>
+        :param line: 一行内容
+        :return: (时间，帧ID，数据)
         """
-        traces = []
-        for content in contents:
-            values = content.split(",")
-            try:
-                index = int(values[0])
-                time = float(values[1])
-                msg_id = int(values[9], 16)
-                logger.debug(f"{index}, {time}, {msg_id}")
-                message = Message()
-                message.msg_id = int(msg_id)
-                message.data = []
-                for i in range(8):
-                    message.data.append(int(values[i + 12], 16))
-                traces.append((time, message))
-            except ValueError:
-                logger.debug("skip handle, because index is no integer")
-        dates = []
-        # 隔一行取一个数据(去掉重复的部分)
-        for index, trace in enumerate(traces):
-            if index % 2 == 0:
-                dates.append(trace)
-        return dates
+        values = line.split(",")
+        return float(values[1]), int(values[9], 16), bytes.fromhex("".join(values[12:20]))
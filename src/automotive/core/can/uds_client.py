@@ -0,0 +1,320 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# Copyright (C), 2016-2020, lizhe, All rights reserved
+# --------------------------------------------------------
+# @Name:        uds_client.py
+# @Author:      lizhe
+# @Created:     2023/4/4 - 21:08
+# --------------------------------------------------------
+import asyncio
+from typing import Dict, List, Sequence, Callable, Optional, Awaitable, Any
+
+from automotive.logger.logger import logger
+from .can_service import Can
+from .common.isotp import IsoTpTransport
+
+"""
+基于asyncio的UDS诊断客户端
+
+同一个CAN通道上可以同时对多个ECU(多对请求ID和响应ID)进行诊断，每个ECU一个UdsSession，
+
+同一个ECU的请求按顺序执行，不同ECU之间的请求并发执行，如:
+
+    client = UdsClient(can)
+    client.add_ecu("BCM", 0x740, 0x748)
+    client.add_ecu("HU", 0x7A0, 0x7A8)
+    values = asyncio.run(client.read_dids({"BCM": [0xF190], "HU": [0xF190, 0xF18C]}))
+
+会话可以在后台周期发送3E 80(tester present)保持，复位/切换会话以后通过wait_until_ready轮询ECU是否可以响应，不再固定等待。
+"""
+
+# 肯定响应的偏移
+_positive_offset = 0x40
+# 否定响应
+_negative_response = 0x7F
+
+
+class UdsSession(object):
+    """
+    一个ECU的诊断会话
+    """
+
+    def __init__(self, name: str, transport: IsoTpTransport):
+        """
+        :param name: ECU的名字
+
+        :param transport: ECU诊断ID上的ISO-TP收发
+        """
+        self.__name = name
+        self.__transport = transport
+        # 同一个ECU同一时间只能有一个请求，需要在事件循环中创建
+        self.__lock = None  # type: Optional[asyncio.Lock]
+        self.__tester_present = None  # type: Optional[asyncio.Task]
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def transport(self) -> IsoTpTransport:
+        return self.__transport
+
+    def __get_lock(self) -> asyncio.Lock:
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        return self.__lock
+
+    async def request(self, payload: Sequence[int], check: bool = True) -> List[int]:
+        """
+        发送诊断请求并等待响应
+
+        :param payload: 请求数据
+
+        :param check: 是否检查肯定响应，否定响应的时候抛出异常
+
+        :return: 响应数据
+        """
+        async with self.__get_lock():
+            response = await self.__transport.request_async(payload)
+        logger.debug(f"{self.__name} request {[hex(x) for x in payload]}, response {[hex(x) for x in response]}")
+        if check:
+            if len(response) >= 3 and response[0] == _negative_response:
+                raise RuntimeError(f"{self.__name} negative response {hex(response[2])} for service {hex(response[1])}")
+            if len(response) == 0 or response[0] != (payload[0] + _positive_offset) & 0xFF:
+                raise RuntimeError(f"{self.__name} unexpected response {[hex(x) for x in response]}")
+        return response
+
+    async def diagnostic_session_control(self, session: int) -> List[int]:
+        """
+        0x10 切换会话
+
+        :param session: 会话类型，如0x03扩展会话
+
+        :return: 响应数据
+        """
+        return await self.request([0x10, session])
+
+    async def ecu_reset(self, reset_type: int = 0x01) -> List[int]:
+        """
+        0x11 ECU复位
+
+        :param reset_type: 复位类型，默认0x01硬复位
+
+        :return: 响应数据
+        """
+        return await self.request([0x11, reset_type])
+
+    async def security_access(self, level: int, compute_key: Callable[[List[int]], Sequence[int]]) -> bool:
+        """
+        0x27 安全访问，先请求种子再发送计算出的密钥
+
+        :param level: 请求种子的等级(奇数)，发送密钥的等级为level + 1
+
+        :param compute_key: 根据种子计算密钥的函数
+
+        :return: True表示解锁成功(已经解锁的情况下种子为全0，直接返回)
+        """
+        response = await self.request([0x27, level])
+        seed = response[2:]
+        if not any(seed):
+            logger.debug(f"{self.__name} security level {hex(level)} is already unlocked")
+            return True
+        key = list(compute_key(seed))
+        await self.request([0x27, level + 1] + key)
+        return True
+
+    async def read_data_by_identifier(self, did: int) -> List[int]:
+        """
+        0x22 读取DID
+
+        :param did: DID，如0xF190
+
+        :return: DID的数据
+        """
+        response = await self.request([0x22, did >> 8, did & 0xFF])
+        return response[3:]
+
+    async def write_data_by_identifier(self, did: int, data: Sequence[int]) -> List[int]:
+        """
+        0x2E 写入DID
+
+        :param did: DID，如0xF190
+
+        :param data: 写入的数据
+
+        :return: 响应数据
+        """
+        return await self.request([0x2E, did >> 8, did & 0xFF] + list(data))
+
+    async def read_dids(self, dids: Sequence[int]) -> Dict[int, List[int]]:
+        """
+        依次读取多个DID
+
+        :param dids: DID列表
+
+        :return: 其中key是DID，value是数据
+        """
+        result = dict()
+        for did in dids:
+            result[did] = await self.read_data_by_identifier(did)
+        return result
+
+    async def write_dids(self, values: Dict[int, Sequence[int]]) -> Dict[int, List[int]]:
+        """
+        依次写入多个DID
+
+        :param values: 其中key是DID，value是写入的数据
+
+        :return: 其中key是DID，value是响应数据
+        """
+        result = dict()
+        for did, data in values.items():
+            result[did] = await self.write_data_by_identifier(did, data)
+        return result
+
+    async def wait_until_ready(self, timeout: float = 5, interval: float = 0.05) -> float:
+        """
+        通过3E 00轮询ECU，直到ECU给出肯定响应，用于复位或者切换会话以后代替固定的等待
+
+        :param timeout: 超时时间，单位秒
+
+        :param interval: 两次轮询之间的间隔，单位秒
+
+        :return: 等待的时间，单位秒
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        while True:
+            try:
+                await self.request([0x3E, 0x00])
+                return loop.time() - start_time
+            except RuntimeError as e:
+                logger.trace(f"{self.__name} is not ready, error is {e}")
+            if loop.time() - start_time > timeout:
+                raise RuntimeError(f"{self.__name} is not ready in {timeout}s")
+            await asyncio.sleep(interval)
+
+    async def __keep_tester_present(self, interval: float):
+        while True:
+            async with self.__get_lock():
+                try:
+                    # 3E 80不需要ECU响应
+                    await self.__transport.send_async([0x3E, 0x80])
+                except RuntimeError as e:
+                    logger.debug(f"{self.__name} send tester present failed, error is {e}")
+            await asyncio.sleep(interval)
+
+    def start_tester_present(self, interval: float = 2):
+        """
+        在后台周期发送3E 80保持会话，需要在事件循环中调用
+
+        :param interval: 发送的周期，单位秒
+        """
+        if self.__tester_present is None or self.__tester_present.done():
+            self.__tester_present = asyncio.ensure_future(self.__keep_tester_present(interval))
+
+    async def stop_tester_present(self):
+        """
+        停止发送3E 80
+        """
+        if self.__tester_present:
+            self.__tester_present.cancel()
+            try:
+                await self.__tester_present
+            except asyncio.CancelledError:
+                pass
+            self.__tester_present = None
+
+
+class UdsClient(object):
+    """
+    同一个CAN通道上多个ECU的诊断客户端
+    """
+
+    def __init__(self, can: Can):
+        """
+        :param can: 已经打开的Can或者CANService
+        """
+        self.__can = can
+        self.__sessions = dict()  # type: Dict[str, UdsSession]
+
+    @property
+    def sessions(self) -> Dict[str, UdsSession]:
+        return self.__sessions
+
+    def add_ecu(self, name: str, request_id: int, response_id: int, **kwargs) -> UdsSession:
+        """
+        增加一个ECU
+
+        :param name: ECU的名字
+
+        :param request_id: 请求ID
+
+        :param response_id: 响应ID
+
+        :param kwargs: IsoTpTransport的其他参数，如p2、st_min
+
+        :return: UdsSession
+        """
+        transport = self.__can.get_transport(request_id, response_id, **kwargs)
+        session = UdsSession(name, transport)
+        self.__sessions[name] = session
+        return session
+
+    def get_session(self, name: str) -> UdsSession:
+        if name not in self.__sessions:
+            raise RuntimeError(f"ecu {name} is not added")
+        return self.__sessions[name]
+
+    async def run_all(self, function: Callable[[UdsSession], Awaitable[Any]],
+                      names: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """
+        对多个ECU并发执行同一个操作
+
+        :param function: 参数是UdsSession的协程函数
+
+        :param names: ECU的名字，默认全部
+
+        :return: 其中key是ECU名字，value是执行结果，执行失败的时候是异常对象
+        """
+        names = list(self.__sessions) if names is None else list(names)
+        results = await asyncio.gather(*(function(self.get_session(name)) for name in names), return_exceptions=True)
+        return dict(zip(names, results))
+
+    async def read_dids(self, requests: Dict[str, Sequence[int]]) -> Dict[str, Any]:
+        """
+        并发读取多个ECU的DID
+
+        :param requests: 其中key是ECU名字，value是DID列表
+
+        :return: 其中key是ECU名字，value是{DID: 数据}，读取失败的时候是异常对象
+        """
+        return await self.run_all(lambda session: session.read_dids(requests[session.name]), list(requests))
+
+    async def write_dids(self, requests: Dict[str, Dict[int, Sequence[int]]]) -> Dict[str, Any]:
+        """
+        并发写入多个ECU的DID
+
+        :param requests: 其中key是ECU名字，value是{DID: 数据}
+
+        :return: 其中key是ECU名字，value是{DID: 响应数据}，写入失败的时候是异常对象
+        """
+        return await self.run_all(lambda session: session.write_dids(requests[session.name]), list(requests))
+
+    def start_tester_present(self, interval: float = 2):
+        """
+        所有ECU在后台周期发送3E 80，需要在事件循环中调用
+
+        :param interval: 发送的周期，单位秒
+        """
+        for session in self.__sessions.values():
+            session.start_tester_present(interval)
+
+    async def close(self):
+        """
+        停止所有ECU的3E 80并移除对应的ISO-TP收发
+        """
+        for session in self.__sessions.values():
+            await session.stop_tester_present()
+            self.__can.can_bus.remove_transport(session.transport.response_id)
+        self.__sessions.clear()
@@ -8,7 +8,7 @@
 # --------------------------------------------------------
 import os
 import sys
-from typing import Sequence, Tuple, Optional
+from typing import Sequence, Tuple, Optional, List
 
 import yaml
 
@@ -26,12 +26,67 @@ from loguru import logger as _logger
     其中yml中包含level和log_folder、log_level用于定义log等级及log存放文件路径
 
     3、 如果找不到配置文件，默认使用info级别输出log，并且不保存log内容到文件
+
+热点路径(每一帧都会执行的代码)中的日志：
+
+    1、 先判断log_level再格式化，等级不够的时候只有一次属性判断，log_level在set_logger的时候计算一次
+
+        if log_level.trace:
+            logger.trace(f"msg id is {hex(msg_id)}")
+
+    2、 lazy_logger延迟格式化，参数是函数，只有日志会被输出的时候才调用，适用于打印图片数组等很大的对象
+
+        lazy_logger.debug("image is {}", lambda: image)
+
+    3、 HOT_TRACE是CAN编解码的trace日志开关，由环境变量AUTOMOTIVE_HOT_TRACE=1在导入的时候打开，
+
+        默认关闭，关闭的时候即使日志等级是trace也不会输出编解码的trace日志
 """
 
 config_file_name = "config.yml"
 current_path = os.getcwd()
 default_level = "info"
 log_level_type = "trace", "debug", "info", "warning", "error"
+# CAN编解码中的trace日志开关，只在导入的时候读取一次
+HOT_TRACE = os.environ.get("AUTOMOTIVE_HOT_TRACE", "0") == "1"
+
+
+class LogLevel(object):
+    """
+    各个日志等级是否会被输出，set_logger的时候计算一次，热点路径中在格式化日志之前判断
+    """
+
+    __slots__ = ("trace", "debug", "info")
+
+    def __init__(self):
+        self.trace = True
+        self.debug = True
+        self.info = True
+
+    def update(self, *levels: Optional[str]):
+        """
+        根据所有输出的等级计算开关，只要有一个输出会打印该等级，该等级的开关就打开
+
+        :param levels: 控制台和文件的日志等级，为None的时候忽略
+        """
+        minimum = min(_logger.level(x.upper()).no for x in levels if x)
+        self.trace = minimum <= _logger.level("TRACE").no
+        self.debug = minimum <= _logger.level("DEBUG").no
+        self.info = minimum <= _logger.level("INFO").no
+
+
+log_level = LogLevel()
+
+
+def hex_list(data: Sequence[int]) -> List[str]:
+    """
+    把数据转换成十六进制字符串的列表，用于打印CAN数据
+
+    :param data: 数据
+
+    :return: 如['0x1', '0xff']
+    """
+    return [hex(x) for x in data]
 
 
 def set_logger(level: str = default_level, folder: Optional[str] = None, folder_level: Optional[str] = default_level):
@@ -69,6 +124,9 @@ def set_logger(level: str = default_level, folder: Optional[str] = None, folder_
             file_log_level = default_level
         _logger.add(os.path.join(file_path, "log_{time}.log"), level=file_log_level.upper(), format=formats,
                     rotation=rotation, encoding="utf-8", errors="ignore")
+        log_level.update(level, file_log_level)
+    else:
+        log_level.update(level)
 
 
 def get_files(folder: str) -> Sequence[str]:
@@ -165,3 +223,5 @@ if file_folder_level.lower() not in log_level_type:
 set_logger(logger_level, logger_folder, file_folder_level)
 # 返回logger对象
 logger = _logger
+# 延迟格式化的logger，参数都是函数
+lazy_logger = _logger.opt(lazy=True)
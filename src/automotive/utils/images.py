@@ -22,7 +22,7 @@ from airtest.aircv.template_matching import TemplateMatching
 from airtest.aircv import NoModuleError, find_template
 from .common.enums import FindTypeEnum, HammingCompareTypeEnum, ImageCompareTypeEnum
 from ..common.typehints import NumpyArray, Position, ImageFile, CompareResult, RGB, AirTestResult
-from ..logger.logger import logger
+from ..logger.logger import logger, lazy_logger
 
 
 class Images(object):
@@ -294,8 +294,9 @@ class Images(object):
 
             total_pixel: 两张图片每一张的总像素点的个数
         """
-        logger.debug(f"image1 = {image1}")
-        logger.debug(f"image2 = {image2}")
+        # 图片可能是数组，只有需要输出的时候才格式化
+        lazy_logger.debug("image1 = {}", lambda: image1)
+        lazy_logger.debug("image2 = {}", lambda: image2)
         image1 = self.__get_image_matrix(image=image1, position=position1, gray=gray)
         image2 = self.__get_image_matrix(image=image2, position=position2, gray=gray)
         return self.__compare_by_matrix(image1, image2, gray, threshold)
@@ -516,7 +517,7 @@ class Images(object):
         """
         if isinstance(compare_type, str):
             compare_type = HammingCompareTypeEnum.from_value(compare_type)
-        logger.debug(f"img1 = {img1} and img2 = {img2}")
+        lazy_logger.debug("img1 = {} and img2 = {}", lambda: img1, lambda: img2)
         image1 = self.__get_image_nd_array(img1)
         image2 = self.__get_image_nd_array(img2)
         a_hash1 = str(self.__average_hash(image1))